@@ -66,6 +66,9 @@ function InvoiceList({ userData }) {
         <img src={`data:image/jpeg;base64,${base64String}`} alt={alt} />
     );
 
+    // PDFs are shown by the thumbnail of their first page
+    const displayImage = (item) => item.file_type === "pdf" ? item.invoice_thumbnail_base64 : item.invoice_image_base64;
+
     return (
         <>
             {contextHolder}
@@ -122,11 +125,11 @@ function InvoiceList({ userData }) {
                     }}>
                         {invoices.map((item, index) => (
                             <div className="invoice__item" key={index}>
-                                {item.invoice_image_base64 &&
-                                    <Base64Image base64String={item.invoice_image_base64} alt={`Invoice ${index + 1}`} />
+                                {displayImage(item) &&
+                                    <Base64Image base64String={displayImage(item)} alt={`Invoice ${index + 1}`} />
                                 }
                                 <div className="invoice__item-overlay">
-                                    <PhotoView src={`data:image/jpeg;base64,${item.invoice_image_base64}`}>
+                                    <PhotoView src={`data:image/jpeg;base64,${displayImage(item)}`}>
                                         <button className="zoom-btn"><MdOutlineZoomOutMap /></button>
                                     </PhotoView>
                                     <button className="delete-btn" onClick={() => handleDeleteInvoice(item._id)}>
@@ -0,0 +1,202 @@
+import sys
+sys.path.append("")
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Optional
+
+
+def hash_bytes(*parts) -> str:
+    """Return a sha256 hex digest of the given bytes/str parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(part)
+        digest.update(b"\x00")  # Separator so ("ab", "c") != ("a", "bc")
+    return digest.hexdigest()
+
+
+class MemoryCacheStore:
+    """In-process LRU store with an optional time to live (seconds)."""
+    def __init__(self, max_size: int = 512, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at and expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while self.max_size and len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskCacheStore:
+    """One JSON file per key in cache_dir, expired by file mtime, oldest files pruned past max_size."""
+    def __init__(self, cache_dir: str, max_size: Optional[int] = None, ttl: Optional[float] = None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.ttl = ttl
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        try:
+            if self.ttl and os.path.getmtime(path) + self.ttl < time.time():
+                os.remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key: str, value: Any):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)  # Atomic, readers never see a partial file
+        self._prune()
+
+    def _prune(self):
+        if not self.max_size:
+            return
+        files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".json")]
+        if len(files) <= self.max_size:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len([name for name in os.listdir(self.cache_dir) if name.endswith(".json")])
+
+
+class MongoCacheStore:
+    """Entries in a MongoDB collection, expired by a TTL index on created_at."""
+    def __init__(self, uri: str, database: str, collection: str, ttl: Optional[float] = None):
+        from pymongo import MongoClient
+
+        self.client = MongoClient(uri, directConnection=True)
+        self.collection = self.client[database][collection]
+        self.ttl = ttl
+        if self.ttl:
+            self.collection.create_index("created_at", expireAfterSeconds=int(self.ttl))
+
+    def get(self, key: str) -> Optional[Any]:
+        document = self.collection.find_one({"_id": key})
+        if not document:
+            return None
+        # The TTL monitor only runs every minute, double check the age here
+        if self.ttl:
+            created_at = document["created_at"].replace(tzinfo=timezone.utc)
+            if created_at + timedelta(seconds=self.ttl) < datetime.now(timezone.utc):
+                return None
+        return document["value"]
+
+    def set(self, key: str, value: Any):
+        self.collection.replace_one({"_id": key},
+                                    {"_id": key, "value": value, "created_at": datetime.now(timezone.utc)},
+                                    upsert=True)
+
+    def __len__(self):
+        return self.collection.estimated_document_count()
+
+
+class CacheStats:
+    """Thread-safe hit and miss counters."""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def to_dict(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+def create_cache_store(cache_config: dict, mongo_config: dict = None):
+    """
+    Build a cache store from a config section like:
+        backend: memory # memory | disk | mongo
+        max_size: 512
+        ttl: 604800 # seconds, Null to keep forever
+        cache_dir: cache/ocr # disk only
+        collection: ocr_cache # mongo only
+    """
+    backend = cache_config.get('backend', 'memory')
+    max_size = cache_config.get('max_size')
+    ttl = cache_config.get('ttl')
+
+    if backend == 'memory':
+        return MemoryCacheStore(max_size=max_size or 512, ttl=ttl)
+    elif backend == 'disk':
+        return DiskCacheStore(cache_dir=cache_config['cache_dir'], max_size=max_size, ttl=ttl)
+    elif backend == 'mongo':
+        if not mongo_config:
+            raise ValueError("The mongo cache backend needs the 'mongodb' config section")
+        return MongoCacheStore(uri=str(mongo_config['uri']), database=mongo_config['database'],
+                               collection=cache_config['collection'], ttl=ttl)
+    else:
+        raise ValueError(f"Unsupported cache backend: {backend}")
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    for store in [MemoryCacheStore(max_size=2), DiskCacheStore(cache_dir=tempfile.mkdtemp(), max_size=2)]:
+        stats = CacheStats()
+        for key in ["a", "b", "c", "a"]:
+            key = hash_bytes(key)
+            value = store.get(key)
+            stats.record(hit=value is not None)
+            if value is None:
+                store.set(key, {"text": key})
+        print(type(store).__name__, len(store), stats.to_dict())
+        assert len(store) == 2
+
+    store = MemoryCacheStore(ttl=0.01)
+    store.set("key", "value")
+    time.sleep(0.02)
+    assert store.get("key") is None
+    print("Expired entries are dropped")
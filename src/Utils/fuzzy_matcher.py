@@ -0,0 +1,150 @@
+import sys
+sys.path.append("")
+
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+import Levenshtein
+
+
+def fuzzy_ratio(a: str, b: str) -> int:
+    """fuzz.ratio of two already lowercased strings, computed by Levenshtein directly."""
+    if a == b:
+        return 100
+    if not a or not b:
+        return 0
+    return int(round(100 * Levenshtein.ratio(a, b)))
+
+
+class FuzzyMatcher:
+    """
+    Index of candidate strings for the closest match of a text, same result as
+    find_best_match_fuzzy: highest fuzz.ratio on the lowercased strings, first one on ties.
+
+    The candidates are lowercased once and their character n-grams kept in an inverted index.
+    The n-grams a text shares with a candidate bound the ratio they can reach, so only the
+    candidates whose bound beats the best score so far are scored, most promising first.
+    """
+    def __init__(self, candidates: Sequence[str], ngram_size: int = 2):
+        self.candidates = tuple(candidates)
+        self.ngram_size = ngram_size
+        self.normalized = tuple(candidate.lower() for candidate in self.candidates)
+        self.lengths = np.array([len(candidate) for candidate in self.normalized], dtype=np.int64)
+        self.gram_counts = self.lengths - ngram_size + 1
+
+        # Inverted index: the row of an n-gram flags the candidates containing it
+        self.vocabulary = {}
+        postings = []
+        for idx, candidate in enumerate(self.normalized):
+            for gram in set(self._ngrams(candidate)):
+                postings.append((self.vocabulary.setdefault(gram, len(self.vocabulary)), idx))
+        self.index = np.zeros((len(self.vocabulary), len(self.candidates)), dtype=np.int64)
+        for column, idx in postings:
+            self.index[column, idx] = 1
+
+    def __len__(self) -> int:
+        return len(self.candidates)
+
+    def _ngrams(self, text: str) -> list:
+        return [text[i:i + self.ngram_size] for i in range(len(text) - self.ngram_size + 1)]
+
+    def _upper_bounds(self, text: str) -> np.ndarray:
+        """Highest score every candidate can reach against text."""
+        # At least the n-grams both strings have, one row per n-gram occurrence in the text
+        rows = [self.vocabulary[gram] for gram in self._ngrams(text) if gram in self.vocabulary]
+        shared = self.index[rows].sum(axis=0)
+
+        # An edit removes at most ngram_size n-grams, and the indel distance is at least the length difference
+        text_length = len(text)
+        missing = np.maximum(self.gram_counts, text_length - self.ngram_size + 1) - shared
+        min_distance = np.maximum(-(-missing // self.ngram_size), np.abs(self.lengths - text_length))
+        return np.rint(100 - 100 * min_distance / np.maximum(self.lengths + text_length, 1))
+
+    def match(self, text: str) -> Tuple[Optional[int], Optional[str], int]:
+        """
+        :return: Position of the best match in the candidates, the best match and its score (0-100).
+                 (None, None, 0) when no candidate scores above 0.
+        """
+        text = text.lower()
+        if not self.candidates:
+            return None, None, 0
+        bounds = self._upper_bounds(text)
+
+        best_idx, best_score = None, 0
+        # Highest bound first, lowest position first among equal bounds
+        for idx in np.argsort(-bounds, kind='stable').tolist():
+            bound = bounds[idx]
+            if bound < best_score or bound == 0 or (bound == best_score and idx > best_idx):
+                break
+            score = fuzzy_ratio(text, self.normalized[idx])
+            if score > best_score or (score == best_score and best_idx is not None and idx < best_idx):
+                best_idx, best_score = idx, score
+
+        if best_idx is None:
+            return None, None, 0
+        return best_idx, self.candidates[best_idx], best_score
+
+
+if __name__ == "__main__":
+    import random
+    import time
+    from fuzzywuzzy import fuzz
+    from src.Utils.utils import read_config, get_land_and_city_list
+    from src.employee_name import EmployeeNames
+
+    def linear_best_match_fuzzy(string_list, text):
+        # The linear fuzzywuzzy scan the matcher replaces
+        text = text.lower()
+        best_idx, best_score = None, 0
+        for idx, item in enumerate(string_list):
+            score = fuzz.ratio(text, item.lower())
+            if score > best_score:
+                best_score = score
+                best_idx = idx
+        if best_idx is None:
+            return None, None, 0
+        return best_idx, string_list[best_idx], best_score
+
+    def perturb(text, rng):
+        chars = list(text)
+        for _ in range(rng.randint(0, 3)):
+            position = rng.randrange(len(chars) + 1)
+            operation = rng.choice(["insert", "delete", "replace"])
+            if operation == "insert" or not chars:
+                chars.insert(position, rng.choice("abcdefghijklmnopqrstuvwxyzäöü "))
+            elif operation == "delete":
+                del chars[min(position, len(chars) - 1)]
+            else:
+                chars[min(position, len(chars) - 1)] = rng.choice("abcdefghijklmnopqrstuvwxyz")
+        return "".join(chars)
+
+    assert FuzzyMatcher(["Paris", "Berlin"]).match("berln") == (1, "Berlin", 91)
+    assert FuzzyMatcher(["ab", "ba"]).match("xy") == (None, None, 0)
+    assert FuzzyMatcher(["", "a"]).match("") == (0, "", 100)
+
+    config = read_config(path="config/config.yaml")
+    lands, cities = get_land_and_city_list(file_path=config['country_and_city']['file_path'],
+                                           sheet_name=config['country_and_city']['sheet_name'])
+    employees = EmployeeNames.from_workbook(config)._name_list
+
+    rng = random.Random(0)
+    for name, candidates in [("cities", cities), ("employees", employees)]:
+        queries = [perturb(rng.choice(candidates), rng) for _ in range(2000)]
+        queries += ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz ", k=rng.randint(1, 20))) for _ in range(500)]
+
+        start_time = time.perf_counter()
+        matcher = FuzzyMatcher(candidates)
+        build_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        expected = [linear_best_match_fuzzy(candidates, query) for query in queries]
+        linear_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        results = [matcher.match(query) for query in queries]
+        indexed_time = time.perf_counter() - start_time
+
+        assert results == expected, [(q, r, e) for q, r, e in zip(queries, results, expected) if r != e][:5]
+        print(f"{name}: {len(candidates)} candidates, {len(queries)} queries, index built in {build_time * 1000:.2f} ms, "
+              f"linear {linear_time / len(queries) * 1e6:.1f} us/query, "
+              f"indexed {indexed_time / len(queries) * 1e6:.1f} us/query ({linear_time / indexed_time:.1f}x)")
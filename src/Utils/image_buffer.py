@@ -0,0 +1,147 @@
+import sys
+sys.path.append("")
+
+import base64
+import cv2
+import numpy as np
+from typing import Optional, Tuple
+from PIL import Image
+from src.Utils.utils import rotate_bound
+
+
+class ImageBuffer:
+    """
+    A decoded image shared by every stage of the extraction pipeline.
+
+    The pixels are decoded once, on first use, into an RGB ndarray. The PIL, grayscale
+    and BGR views and the encoded forms (PNG, JPEG, base64) are created lazily and cached,
+    so OCR, orientation detection, language detection and the LLM payload reuse the same
+    buffer instead of converting the image back and forth.
+    """
+    def __init__(self, array: Optional[np.ndarray] = None, source_bytes: Optional[bytes] = None):
+        if array is None and source_bytes is None:
+            raise ValueError("Either 'array' or 'source_bytes' must be provided")
+        # RGB uint8 array, shape (height, width, 3)
+        self._array = array
+        # The original file content when the buffer was decoded from an upload
+        self.source_bytes = source_bytes
+        self._pil = None
+        self._gray = None
+        self._bgr = None
+        self._encoded = {}
+
+    @classmethod
+    def from_bytes(cls, image_bytes: bytes) -> "ImageBuffer":
+        # Decoded on first access, so a buffer only forwarded as bytes is never decoded
+        return cls(source_bytes=image_bytes)
+
+    @classmethod
+    def from_base64(cls, base64_img: str) -> "ImageBuffer":
+        return cls.from_bytes(base64.b64decode(base64_img))
+
+    @classmethod
+    def from_pil(cls, image: Image.Image) -> "ImageBuffer":
+        buffer = cls(np.asarray(image.convert("RGB")))
+        if image.mode == "RGB":
+            buffer._pil = image
+        return buffer
+
+    @classmethod
+    def from_path(cls, path: str) -> "ImageBuffer":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    @property
+    def array(self) -> np.ndarray:
+        if self._array is None:
+            bgr = cv2.imdecode(np.frombuffer(self.source_bytes, np.uint8), cv2.IMREAD_COLOR)
+            if bgr is None:
+                raise ValueError("Invalid image data")
+            self._bgr = bgr
+            self._array = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        return self._array
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """(width, height), like PIL.Image.size."""
+        return self.array.shape[1], self.array.shape[0]
+
+    @property
+    def pil(self) -> Image.Image:
+        if self._pil is None:
+            self._pil = Image.fromarray(self.array)
+        return self._pil
+
+    @property
+    def gray(self) -> np.ndarray:
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.array, cv2.COLOR_RGB2GRAY)
+        return self._gray
+
+    @property
+    def bgr(self) -> np.ndarray:
+        if self._bgr is None:
+            self._bgr = cv2.cvtColor(self.array, cv2.COLOR_RGB2BGR)
+        return self._bgr
+
+    def resized(self, target_size: int) -> "ImageBuffer":
+        """Resize so the longest side is target_size, keeping the aspect ratio (see resize_same_ratio)."""
+        width, height = self.size
+        if height > width:
+            new_width, new_height = int((width / height) * target_size), target_size
+        else:
+            new_width, new_height = target_size, int((height / width) * target_size)
+
+        if (new_width, new_height) == (width, height):
+            return self
+
+        interpolation = cv2.INTER_AREA if new_width < width else cv2.INTER_CUBIC
+        return ImageBuffer(cv2.resize(self.array, (new_width, new_height), interpolation=interpolation))
+
+    def rotated(self, angle: int) -> "ImageBuffer":
+        """Rotate by an angle returned from the orientation detection (see rotate_by_angle)."""
+        if not angle:
+            return self
+        return ImageBuffer(rotate_bound(self.array, angle=angle))
+
+    def encode(self, extension: str = ".png", params: tuple = (), grayscale: bool = False) -> bytes:
+        """Encode with cv2.imencode, e.g. encode(".jpg", (cv2.IMWRITE_JPEG_QUALITY, 85)). Cached per format."""
+        key = (extension, tuple(params), grayscale)
+        if key not in self._encoded:
+            success, buffer = cv2.imencode(extension, self.gray if grayscale else self.bgr, list(params))
+            if not success:
+                raise ValueError(f"Could not encode image as {extension}")
+            self._encoded[key] = buffer.tobytes()
+        return self._encoded[key]
+
+    def to_base64(self, extension: str = ".png", params: tuple = (), grayscale: bool = False) -> str:
+        key = ("base64", extension, tuple(params), grayscale)
+        if key not in self._encoded:
+            self._encoded[key] = base64.b64encode(self.encode(extension, params, grayscale)).decode("utf-8")
+        return self._encoded[key]
+
+    def __getstate__(self):
+        # Only ship the pixels (or the still encoded upload) between processes
+        return {"array": self._array if self.source_bytes is None else None, "source_bytes": self.source_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["array"], source_bytes=state["source_bytes"])
+
+
+if __name__ == "__main__":
+    import pickle
+
+    buffer = ImageBuffer.from_path("fr_1.png")
+    print("size", buffer.size, "gray", buffer.gray.shape)
+
+    png_base64 = buffer.to_base64()
+    assert buffer.to_base64() is png_base64  # Cached
+    assert np.array_equal(ImageBuffer.from_base64(png_base64).array, buffer.array)  # Lossless round trip
+
+    resized = buffer.resized(640)
+    print("resized", resized.size, "rotated", resized.rotated(90).size)
+    assert max(resized.size) == 640
+
+    restored = pickle.loads(pickle.dumps(resized))
+    assert np.array_equal(restored.array, resized.array)
+    print("ImageBuffer OK")
@@ -0,0 +1,220 @@
+import sys
+sys.path.append("")
+
+import re
+import ast
+import json
+from typing import List, Optional, Sequence, Type
+from pydantic import BaseModel, ValidationError
+
+# Pydantic error types that mean the JSON does not have the shape of the model.
+# Value errors (dates as dd/mm/yyyy, "12,50" amounts...) are fixed later by validate_invoice.
+STRUCTURAL_ERROR_TYPES = {"missing", "model_type", "model_attributes_type", "dict_type", "list_type"}
+# Value errors validate_invoice fixes, dates as the LLM writes them
+NORMALIZED_ERROR_TYPES = {"datetime_parsing", "datetime_from_date_parsing", "date_parsing", "date_from_datetime_parsing"}
+
+
+class IncrementalJsonParser:
+    """
+    Follows a JSON object as the chunks of a streamed completion arrive.
+
+    Strings, escapes and brackets are tracked incrementally, so the parser knows the moment
+    the top-level object is closed (the rest of the stream can be dropped) and, when the
+    stream stops early, which brackets are still open. Text before the first '{', like a
+    ```json fence, is ignored.
+    """
+    def __init__(self):
+        self.text = ""
+        self.start = None  # Index of the opening '{' of the top-level object
+        self.end = None  # Index after its closing '}'
+        self._stack = []  # Open brackets
+        self._in_string = False
+        self._escape = False
+        # (index, open brackets) of every ',' between two members, the last safe cut points
+        self._cut_points = []
+
+    @property
+    def complete(self) -> bool:
+        return self.end is not None
+
+    def feed(self, chunk: str) -> bool:
+        """Add a chunk of the completion, return True once the top-level object is complete."""
+        offset = len(self.text)
+        self.text += chunk
+        if self.complete:
+            return True
+
+        for i, char in enumerate(chunk, start=offset):
+            if self.start is None:
+                if char == '{':
+                    self.start = i
+                    self._stack.append('{')
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._stack.append(char)
+            elif char in '}]':
+                self._stack.pop()
+                if not self._stack:
+                    self.end = i + 1
+                    return True
+            elif char == ',':
+                self._cut_points.append((i, tuple(self._stack)))
+        return False
+
+    @property
+    def json_text(self) -> str:
+        """The top-level object seen so far."""
+        if self.start is None:
+            return ""
+        return self.text[self.start:self.end]
+
+    def result(self) -> dict:
+        if not self.complete:
+            raise ValueError("The JSON object is not complete")
+        return json.loads(self.json_text)
+
+    @staticmethod
+    def _close(stack) -> str:
+        return "".join('}' if bracket == '{' else ']' for bracket in reversed(stack))
+
+    def repair(self, max_attempts: int = 20) -> Optional[dict]:
+        """
+        Close a truncated object. The text is cut after the last complete member and the
+        open brackets are closed, so only the member being written when the stream stopped is lost.
+        """
+        if self.start is None:
+            return None
+        if self.complete:
+            return self.result()
+
+        # The stream may have stopped right after a complete value or inside a string
+        candidates = [self.json_text + ('"' if self._in_string else '') + self._close(self._stack)]
+        for index, stack in reversed(self._cut_points[-max_attempts:]):
+            candidates.append(self.text[self.start:index] + self._close(stack))
+
+        for candidate in candidates:
+            try:
+                return json.loads(candidate)
+            except ValueError:
+                continue
+        return None
+
+
+def parse_json_answer(text: str) -> dict:
+    """
+    The object of an LLM answer, from the first '{' to the last '}'. Almost-JSON answers
+    (single quotes, True/None) are read as Python literals with ast.literal_eval, nothing
+    in the answer is ever evaluated. Raises ValueError when neither reads a dict.
+    """
+    json_string = text[text.find('{'):text.rfind('}') + 1]
+    try:
+        return json.loads(json_string)
+    except ValueError:
+        pass
+    for candidate in (json_string, re.sub(r'\b(true|false|null)\b',
+                                          lambda m: {"true": "True", "false": "False", "null": "None"}[m.group(1)],
+                                          json_string)):
+        try:
+            result = ast.literal_eval(candidate)
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            continue
+        if isinstance(result, dict):
+            return result
+    raise ValueError(f"No JSON object in the answer: {text[:100]!r}")
+
+
+def find_structural_errors(data: dict, response_model: Type[BaseModel]) -> List[str]:
+    """Validate data against a Pydantic model, only report errors about the shape of the JSON."""
+    try:
+        response_model.model_validate(data)
+    except ValidationError as e:
+        return [f"{'.'.join(str(loc) for loc in error['loc'])}: {error['msg']}"
+                for error in e.errors() if error['type'] in STRUCTURAL_ERROR_TYPES]
+    return []
+
+
+def find_invalid_fields(data: dict, response_model: Type[BaseModel], container: str = "invoice_info",
+                        required_fields: Sequence[str] = ()) -> Optional[List[str]]:
+    """
+    Fields of data[container] that fail validation against the model, leaving out the errors
+    validate_invoice fixes, plus the required fields data[container] is missing. None when data
+    doesn't have the shape of the model at all: no container object, key names that are not in
+    the model or none of the required fields.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get(container), dict):
+        return None
+    fields = response_model.model_fields[container].annotation.model_fields
+    if set(data[container]) - set(fields):
+        return None
+    missing_fields = {field for field in required_fields if field not in data[container]}
+    if required_fields and len(missing_fields) == len(set(required_fields)):
+        # Nothing to keep from the answer, e.g. an empty object
+        return None
+    try:
+        response_model.model_validate(data)
+    except ValidationError as e:
+        invalid_fields = {str(error['loc'][1]) if len(error['loc']) > 1 and error['loc'][0] == container else None
+                          for error in e.errors() if error['type'] not in NORMALIZED_ERROR_TYPES}
+        # Errors raised inside model validators don't point at a field
+        if invalid_fields - set(fields):
+            return None
+        return sorted(invalid_fields | missing_fields)
+    return sorted(missing_fields)
+
+if __name__ == "__main__":
+    from src.validate_invoice import Invoice3
+
+    completion = '```json\n{"invoice_info": {"amount": 32.0, "currency": "EUR", "merchant_name": "G\\u00e9ant \\"Casino\\"", ' \
+                 '"lines": [{"description": "Glasses {1}", "lineitems": [{"title": "Glasses", "amount": 22.0}]}]}}\n```'
+
+    parser = IncrementalJsonParser()
+    chunks = [completion[i:i + 7] for i in range(0, len(completion), 7)]
+    for count, chunk in enumerate(chunks, start=1):
+        if parser.feed(chunk):
+            break
+    print(f"Complete after {count}/{len(chunks)} chunks:", parser.result())
+    assert parser.result()["invoice_info"]["merchant_name"] == 'Géant "Casino"'
+    assert find_structural_errors(parser.result(), Invoice3) == []
+
+    # Stop the stream in the middle of the second line item
+    truncated = IncrementalJsonParser()
+    truncated.feed(completion[:completion.index('"amount": 22.0') + 6])
+    repaired = truncated.repair()
+    print("Repaired:", repaired)
+    assert repaired["invoice_info"]["currency"] == "EUR"
+    assert repaired["invoice_info"]["lines"][0]["lineitems"] == [{"title": "Glasses"}]
+
+    # Dates and amounts as the LLM writes them are not structural errors, a list instead of an object is
+    assert find_structural_errors({"invoice_info": {"purchasedate": "28/06/2008"}}, Invoice3) == []
+    assert find_structural_errors({"invoice_info": []}, Invoice3)
+
+    # Field level validation for the post-processing fast path
+    assert find_invalid_fields({"invoice_info": {"amount": 32.0, "purchasedate": "28/06/2008"}}, Invoice3) == []
+    assert find_invalid_fields({"invoice_info": {"amount": "a lot", "lines": {}}}, Invoice3) == ["amount", "lines"]
+    assert find_invalid_fields({"invoice_info": {"total": 32.0}}, Invoice3) is None
+    # Missing required fields need post-processing, an answer without any of them is not used
+    required_fields = ["amount", "currency", "purchasedate", "merchant_name"]
+    assert find_invalid_fields({"invoice_info": {}}, Invoice3, required_fields=required_fields) is None
+    assert find_invalid_fields({"invoice_info": {"amount": 32.0, "currency": "EUR"}}, Invoice3,
+                               required_fields=required_fields) == ["merchant_name", "purchasedate"]
+    assert find_invalid_fields({"invoice_info": {"amount": "a lot", "currency": "EUR", "purchasedate": "28/06/2008",
+                                                 "merchant_name": "Casino"}}, Invoice3, required_fields=required_fields) == ["amount"]
+    # Python literal answers are read, never evaluated
+    assert parse_json_answer("Sure: {'invoice_info': {'paid': true, 'tip': None}}") == {"invoice_info": {"paid": True, "tip": None}}
+    for answer in ["{'a': __import__('os').getcwd()}", "no object", "{[1, 2]}"]:
+        try:
+            parse_json_answer(answer)
+            raise AssertionError(answer)
+        except ValueError:
+            pass
+    print("IncrementalJsonParser OK")
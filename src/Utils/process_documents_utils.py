@@ -2,12 +2,15 @@ import sys
 sys.path.append("")
 
 
-from typing import Dict
+from typing import Dict, List, Tuple
 import os
+import asyncio
 from src.egw_export import export_egw_file
 from src.export_excel.main import export_json_to_excel
-from src.Utils.utils import find_pairs_of_docs
-from src.invoice_extraction import extract_invoice_info
+import base64
+from src.Utils.utils import find_pairs_of_docs, is_pdf, get_current_time
+from src.invoice_extraction import (extract_invoice_info, aextract_invoice_info, get_pdf_text,
+                                    prepare_invoice, finalize_invoice_info)
 
 
 def get_egw_file(mongo_db, start_of_month, config, logger):
@@ -98,7 +101,8 @@ def get_excel_files(mongo_db, start_of_month, logger):
 
 
 def process_single_document(ocr_reader, invoice_extractor, 
-                            config, mongo_db, logger, document: dict):
+                            config, mongo_db, logger, document: dict,
+                            ocr_result: dict = None, rotated_image = None):
     try:
         document_id = document['_id']
         base64_img = document['invoice_image_base64']
@@ -110,7 +114,9 @@ def process_single_document(ocr_reader, invoice_extractor,
             invoice_extractor=invoice_extractor,
             config=config,
             logger=logger,
-            file_name=file_name
+            file_name=file_name,
+            ocr_result=ocr_result,
+            rotated_image=rotated_image
         )
 
         mongo_db.update_document_by_id(str(document_id), new_data)
@@ -120,4 +126,268 @@ def process_single_document(ocr_reader, invoice_extractor,
         print(msg)
         if logger:
             logger.error(msg = msg)
-    
+
+
+def ocr_documents(ocr_reader, documents: List[dict], config, logger, include_pdfs: bool = False) -> list:
+    """
+    OCR a batch of documents together, so their languages are detected in one forward pass
+    (or, with the process pool backend, the documents are OCR'd in parallel).
+    Returns one (ocr_result, rotated_image) tuple per document, (None, None) when the
+    document is left to extract_invoice_info.
+    """
+    ocr_results = [(None, None)] * len(documents)
+    try:
+        files = [base64.b64decode(document['invoice_image_base64']) for document in documents]
+        # PDFs are OCR'd page by page
+        image_indices = [i for i, file in enumerate(files) if not is_pdf(file)]
+        batch_results = ocr_reader.get_texts([files[i] for i in image_indices], return_image=True)
+        for i, batch_result in zip(image_indices, batch_results):
+            ocr_results[i] = batch_result
+
+        if include_pdfs:
+            for i, file in enumerate(files):
+                if is_pdf(file):
+                    ocr_results[i] = get_pdf_text(ocr_reader, file, config=config)
+        del files
+    except Exception as e:
+        # Fall back to OCR inside extract_invoice_info
+        logger.error(msg = f"Error on batch OCR: {str(e)}")
+    return ocr_results
+
+
+def route_document(invoice_type: str, document: dict, config) -> str:
+    """"batch" for the invoice types configured as non-urgent, else "realtime"."""
+    batch_config = config['llm_extract'].get('batch') or {}
+    if not batch_config.get('enabled', False):
+        return "realtime"
+    # A document whose batch request failed is extracted in real time
+    if (document.get('batch_info') or {}).get('failed'):
+        return "realtime"
+    if invoice_type in batch_config.get('invoice_types', []):
+        return "batch"
+    return "realtime"
+
+
+def collect_batch_requests(ocr_reader, invoice_extractor, config, logger,
+                           documents: List[dict], ocr_results: list) -> Tuple[list, list, list]:
+    """
+    Split OCR'd documents between the Batch API and real-time extraction.
+
+    Returns:
+        Tuple[list, list, list]: The (document, ocr_result, invoice_type, batch request) of the
+        batch routed documents, then the real-time documents and their OCR results.
+    """
+    if not hasattr(invoice_extractor, 'build_batch_request') or \
+            not (config['llm_extract'].get('batch') or {}).get('enabled', False):
+        return [], documents, ocr_results
+
+    batch_items, realtime_documents, realtime_ocr_results = [], [], []
+    for document, (ocr_result, rotated_image) in zip(documents, ocr_results):
+        try:
+            if ocr_result is None:
+                raise ValueError("Document not OCR'd yet")
+            ocr_result, rotated_image, invoice_type, invoice_template = prepare_invoice(
+                base64_img=document['invoice_image_base64'], ocr_reader=ocr_reader, config=config,
+                ocr_result=ocr_result, rotated_image=rotated_image)
+            if route_document(invoice_type, document, config) == "batch":
+                request = invoice_extractor.build_batch_request(
+                    str(document['_id']), ocr_text=ocr_result['text'], image=rotated_image,
+                    invoice_template=invoice_template)
+                batch_items.append((document, ocr_result, invoice_type, request))
+                continue
+        except Exception as e:
+            logger.error(msg = f"Error preparing document {document['_id']} for batch: {str(e)}")
+        realtime_documents.append(document)
+        realtime_ocr_results.append((ocr_result, rotated_image))
+    return batch_items, realtime_documents, realtime_ocr_results
+
+
+def submit_batch_documents(invoice_extractor, config, mongo_db, logger, batch_items: list) -> list:
+    """
+    Submit the batch routed documents as one batch job and mark them "batch submitted".
+    Returns the documents left to real-time extraction when the job can't be submitted.
+    """
+    if not batch_items:
+        return []
+    try:
+        batch_id = invoice_extractor.submit_batch([request for _, _, _, request in batch_items])
+    except Exception as e:
+        logger.error(msg = f"Error submitting batch of {len(batch_items)} documents: {str(e)}")
+        return [document for document, _, _, _ in batch_items]
+
+    submitted_at = get_current_time(timezone=config['timezone'])
+    for document, ocr_result, invoice_type, _ in batch_items:
+        # Keep the OCR result, the batch results are validated without running OCR again
+        mongo_db.update_document_by_id(str(document['_id']), {
+            "status": "batch submitted",
+            "batch_info": {"batch_id": batch_id, "submitted_at": submitted_at},
+            "ocr_info": ocr_result,
+            "invoice_type": invoice_type,
+        })
+    logger.info(msg = f"Batch {batch_id}: {len(batch_items)} documents submitted")
+    return []
+
+
+def poll_batch_jobs(ocr_reader, invoice_extractor, config, mongo_db, logger):
+    """
+    Check the batch jobs of the "batch submitted" documents. The results of finished jobs are
+    validated and stored like real-time extractions; documents without a usable result are
+    extracted in real time.
+    """
+    documents, _ = mongo_db.get_documents(filters={"status": "batch submitted"}, limit=500)
+    documents_by_batch = {}
+    for document in documents:
+        documents_by_batch.setdefault(document['batch_info']['batch_id'], []).append(document)
+
+    for batch_id, batch_documents in documents_by_batch.items():
+        try:
+            results = invoice_extractor.get_batch_results(batch_id)
+        except Exception as e:
+            logger.error(msg = f"Error polling batch {batch_id}: {str(e)}")
+            results = {}
+        if results is None:
+            logger.debug(f"Batch {batch_id} is still running")
+            continue
+
+        failed_documents = []
+        for document in batch_documents:
+            document_id = str(document['_id'])
+            invoice_info = results.get(document_id)
+            try:
+                if invoice_info is None or isinstance(invoice_info, Exception):
+                    raise ValueError(invoice_info or "No result in the batch output")
+                new_data = finalize_invoice_info(invoice_info, ocr_result=document['ocr_info'],
+                                                 invoice_type=document['invoice_type'], ocr_reader=ocr_reader,
+                                                 invoice_extractor=invoice_extractor, config=config,
+                                                 logger=logger, file_name=document['file_name'])
+                new_data['batch_info'] = {**document['batch_info'],
+                                          "completed_at": get_current_time(timezone=config['timezone'])}
+                mongo_db.update_document_by_id(document_id, new_data)
+            except Exception as e:
+                logger.error(msg = f"Batch {batch_id}, document {document_id} failed: {str(e)}")
+                document['batch_info'] = {**document['batch_info'], "failed": True}
+                mongo_db.update_document_by_id(document_id, {"status": "not extracted",
+                                                             "batch_info": document['batch_info']})
+                failed_documents.append(document)
+        logger.info(msg = f"Batch {batch_id}: {len(batch_documents) - len(failed_documents)} documents completed, "
+                          f"{len(failed_documents)} left to real-time extraction")
+
+        for document in failed_documents:
+            process_single_document(ocr_reader=ocr_reader, invoice_extractor=invoice_extractor,
+                                    config=config, mongo_db=mongo_db, logger=logger, document=document,
+                                    ocr_result=document['ocr_info'])
+
+
+def process_documents(ocr_reader, invoice_extractor, 
+                      config, mongo_db, logger, documents: List[dict]):
+    """
+    OCR a batch of pending documents together, submit the non-urgent ones as a batch job,
+    then extract and store each of the other documents.
+    """
+    ocr_results = ocr_documents(ocr_reader, documents, config=config, logger=logger)
+
+    batch_items, documents, ocr_results = collect_batch_requests(ocr_reader, invoice_extractor, config, logger,
+                                                                 documents=documents, ocr_results=ocr_results)
+    for document in submit_batch_documents(invoice_extractor, config, mongo_db, logger, batch_items):
+        documents.append(document)
+        ocr_results.append((None, None))
+
+    for document, (ocr_result, rotated_image) in zip(documents, ocr_results):
+        # Pause the queue while the LLM provider is down instead of failing every document
+        if hasattr(invoice_extractor, 'resilience'):
+            invoice_extractor.resilience.breaker.wait_until_ready()
+        process_single_document(
+            ocr_reader=ocr_reader,
+            invoice_extractor=invoice_extractor,
+            config=config,
+            mongo_db=mongo_db,
+            logger=logger,
+            document=document,
+            ocr_result=ocr_result,
+            rotated_image=rotated_image
+        )
+    log_retry_metrics(invoice_extractor, logger)
+
+
+def log_retry_metrics(invoice_extractor, logger):
+    if hasattr(invoice_extractor, 'get_retry_metrics'):
+        logger.info(msg = f"LLM retry metrics: {invoice_extractor.get_retry_metrics()}")
+    if hasattr(invoice_extractor, 'get_usage_stats'):
+        logger.info(msg = f"LLM token usage: {invoice_extractor.get_usage_stats()}")
+    if hasattr(invoice_extractor, 'get_tier_stats'):
+        logger.info(msg = f"LLM tier stats: {invoice_extractor.get_tier_stats()}")
+    if hasattr(invoice_extractor, 'get_postprocess_stats'):
+        logger.info(msg = f"Post-processing stats: {invoice_extractor.get_postprocess_stats()}")
+
+
+async def aprocess_single_document(ocr_reader, invoice_extractor, 
+                                   config, mongo_db, logger, document: dict,
+                                   ocr_result: dict = None, rotated_image = None):
+    try:
+        document_id = document['_id']
+
+        new_data = await aextract_invoice_info(
+            base64_img=document['invoice_image_base64'],
+            ocr_reader=ocr_reader,
+            invoice_extractor=invoice_extractor,
+            config=config,
+            logger=logger,
+            file_name=document['file_name'],
+            ocr_result=ocr_result,
+            rotated_image=rotated_image
+        )
+
+        await asyncio.to_thread(mongo_db.update_document_by_id, str(document_id), new_data)
+
+    except Exception as e:
+        msg = f"Error processing document {document_id}: {str(e)}"
+        print(msg)
+        if logger:
+            logger.error(msg = msg)
+
+
+async def process_documents_async(ocr_reader, invoice_extractor, 
+                                  config, mongo_db, logger, documents: List[dict]):
+    """
+    Pipeline OCR and LLM extraction. Documents are OCR'd ocr_batch_size at a time in a
+    thread, and the extraction of each document starts as soon as its OCR is done, so the
+    async extractor keeps several LLM calls in flight while the next documents are OCR'd.
+    """
+    batch_size = config['llm_extract'].get('ocr_batch_size', 2)
+    tasks = []
+    # Non-urgent documents of every chunk go in one batch job
+    batch_items = []
+    for start in range(0, len(documents), batch_size):
+        batch = documents[start:start + batch_size]
+        ocr_results = await asyncio.to_thread(ocr_documents, ocr_reader, batch, 
+                                              config=config, logger=logger, include_pdfs=True)
+        chunk_batch_items, batch, ocr_results = await asyncio.to_thread(
+            collect_batch_requests, ocr_reader, invoice_extractor, config, logger,
+            documents=batch, ocr_results=ocr_results)
+        batch_items.extend(chunk_batch_items)
+        for document, (ocr_result, rotated_image) in zip(batch, ocr_results):
+            # Pause the queue while the LLM provider is down instead of failing every document
+            await invoice_extractor.resilience.breaker.await_ready()
+            tasks.append(asyncio.create_task(aprocess_single_document(
+                ocr_reader=ocr_reader,
+                invoice_extractor=invoice_extractor,
+                config=config,
+                mongo_db=mongo_db,
+                logger=logger,
+                document=document,
+                ocr_result=ocr_result,
+                rotated_image=rotated_image
+            )))
+    unsubmitted = await asyncio.to_thread(submit_batch_documents, invoice_extractor, config,
+                                          mongo_db, logger, batch_items)
+    for document in unsubmitted:
+        tasks.append(asyncio.create_task(aprocess_single_document(
+            ocr_reader=ocr_reader,
+            invoice_extractor=invoice_extractor,
+            config=config,
+            mongo_db=mongo_db,
+            logger=logger,
+            document=document
+        )))
+    await asyncio.gather(*tasks)
+    log_retry_metrics(invoice_extractor, logger)
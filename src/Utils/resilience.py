@@ -0,0 +1,354 @@
+import sys
+sys.path.append("")
+
+import time
+import random
+import asyncio
+import threading
+from functools import wraps
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Optional
+
+# Failures that say something about the provider, they count towards opening the circuit
+PROVIDER_FAILURES = {"rate_limit", "timeout", "server_error", "connection", "error"}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider that is known to be down."""
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"Circuit '{name}' is open, retry in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+def classify_error(error: Exception) -> str:
+    """
+    Map an exception from openai, httpx or requests to a retry reason:
+    rate_limit, timeout, server_error, connection, parse_error, fatal or error.
+    """
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+
+    status_code = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    if status_code is None and response is not None:
+        status_code = getattr(response, "status_code", None)
+    if status_code is not None:
+        if status_code == 429:
+            return "rate_limit"
+        if status_code == 408:
+            return "timeout"
+        if status_code >= 500:
+            return "server_error"
+        if status_code >= 400:
+            # Bad request, authentication... retrying won't help
+            return "fatal"
+
+    # Match by class name, the client libraries are optional here
+    class_names = [cls.__name__ for cls in type(error).__mro__]
+    if isinstance(error, TimeoutError) or any("Timeout" in name for name in class_names):
+        return "timeout"
+    if isinstance(error, ConnectionError) or any("Connection" in name for name in class_names):
+        return "connection"
+    if isinstance(error, (ValueError, SyntaxError, KeyError)):
+        return "parse_error"
+    return "error"
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Seconds asked for by the Retry-After (or retry-after-ms) header of an HTTP error response."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        # HTTP date
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryMetrics:
+    """Thread-safe counters of calls, retries and failures by reason."""
+    def __init__(self):
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, event: str, reason: str = None):
+        with self._lock:
+            self.counters[event] += 1
+            if reason:
+                self.counters[f"{event}_{reason}"] += 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive provider failures. While open every call fails
+    fast with CircuitOpenError. After recovery_timeout seconds one trial call is let through:
+    a success closes the circuit, a failure opens it again.
+    """
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 60,
+                 metrics: RetryMetrics = None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.metrics = metrics or RetryMetrics()
+        self.state = "closed"  # closed | open | half_open
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def seconds_until_retry(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.opened_at + self.recovery_timeout - time.monotonic())
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "open":
+                retry_in = self.seconds_until_retry()
+                if retry_in > 0:
+                    self.metrics.record("short_circuited")
+                    raise CircuitOpenError(self.name, retry_in)
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._trial_in_flight:
+                    self.metrics.record("short_circuited")
+                    raise CircuitOpenError(self.name, self.recovery_timeout)
+                self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self, provider_failure: bool = True):
+        with self._lock:
+            was_trial = self._trial_in_flight
+            self._trial_in_flight = False
+            if not provider_failure:
+                # The provider answered, the failure was ours (e.g. unparsable output)
+                if was_trial:
+                    self.state = "closed"
+                    self.failures = 0
+                return
+            self.failures += 1
+            if was_trial or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.metrics.record("circuit_opened")
+                    print(f"Circuit '{self.name}' opened after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def seconds_until_ready(self) -> float:
+        """0 when a call would be let through, else how long to wait before checking again."""
+        with self._lock:
+            if self.state == "half_open" and self._trial_in_flight:
+                # Wait for the outcome of the trial call
+                return min(1.0, self.recovery_timeout)
+            return self.seconds_until_retry()
+
+    def wait_until_ready(self):
+        """Block while the circuit is open, pausing the caller's queue instead of failing its items."""
+        retry_in = self.seconds_until_ready()
+        while retry_in > 0:
+            print(f"Circuit '{self.name}' is {self.state}, pausing for {retry_in:.0f}s")
+            time.sleep(retry_in)
+            retry_in = self.seconds_until_ready()
+
+    async def await_ready(self):
+        retry_in = self.seconds_until_ready()
+        while retry_in > 0:
+            print(f"Circuit '{self.name}' is {self.state}, pausing for {retry_in:.0f}s")
+            await asyncio.sleep(retry_in)
+            retry_in = self.seconds_until_ready()
+
+
+class Resilience:
+    """
+    Retries with exponential backoff and jitter, honouring Retry-After, behind a circuit breaker.
+    Unparsable answers are retried at once, fatal client errors (4xx) and open circuits are not retried.
+    """
+    def __init__(self, name: str, max_attempts: int = 3, base_delay: float = 1.0, max_delay: float = 30,
+                 max_retry_after: float = 120, failure_threshold: int = 5, recovery_timeout: float = 60):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.metrics = RetryMetrics()
+        self.breaker = CircuitBreaker(name, failure_threshold=failure_threshold,
+                                      recovery_timeout=recovery_timeout, metrics=self.metrics)
+
+    @classmethod
+    def from_config(cls, name: str, config: dict = None) -> "Resilience":
+        config = config or {}
+        return cls(name,
+                   max_attempts=config.get('max_attempts', 3),
+                   base_delay=config.get('base_delay', 1.0),
+                   max_delay=config.get('max_delay', 30),
+                   max_retry_after=config.get('max_retry_after', 120),
+                   failure_threshold=config.get('failure_threshold', 5),
+                   recovery_timeout=config.get('recovery_timeout', 60))
+
+    def retry_delay(self, attempt: int, error: Exception, reason: str) -> float:
+        if reason == "parse_error":
+            return 0.0
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        # Equal jitter: half of the exponential delay, plus a random share of the other half
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _on_failure(self, attempt: int, error: Exception) -> Optional[float]:
+        """Record a failed attempt, return the delay before the next one or None to give up."""
+        reason = classify_error(error)
+        if reason == "circuit_open":
+            return None
+        self.breaker.record_failure(provider_failure=reason in PROVIDER_FAILURES)
+        self.metrics.record("failures", reason)
+        if reason == "fatal" or attempt >= self.max_attempts:
+            self.metrics.record("gave_up", reason)
+            return None
+        if self.breaker.state == "open":
+            # The provider is down, stop here instead of waiting on it
+            self.metrics.record("gave_up", "circuit_open")
+            return None
+        delay = self.retry_delay(attempt, error, reason)
+        self.metrics.record("retries", reason)
+        print(f"{self.name} attempt {attempt} failed ({reason}): {error}, retrying in {delay:.1f}s")
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.before_call()
+            self.metrics.record("calls")
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = self._on_failure(attempt, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def acall(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.before_call()
+            self.metrics.record("calls")
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._on_failure(attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    def get_metrics(self) -> dict:
+        metrics = self.metrics.to_dict()
+        metrics['circuit_state'] = self.breaker.state
+        return metrics
+
+
+def resilient(func):
+    """Run a method through the Resilience of its instance (self.resilience)."""
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return self.resilience.call(func, self, *args, **kwargs)
+    return wrapper
+
+
+def async_resilient(func):
+    """Same as resilient for coroutine methods."""
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        return await self.resilience.acall(func, self, *args, **kwargs)
+    return wrapper
+
+
+if __name__ == "__main__":
+    class HttpError(Exception):
+        def __init__(self, status_code, headers=None):
+            super().__init__(f"HTTP {status_code}")
+            self.status_code = status_code
+            self.response = type("Response", (), {"headers": headers or {}, "status_code": status_code})()
+
+    class FlakyProvider:
+        def __init__(self, errors):
+            self.errors = list(errors)
+            self.resilience = Resilience("flaky", max_attempts=3, base_delay=0.01, max_delay=0.05,
+                                         failure_threshold=2, recovery_timeout=0.2)
+
+        @resilient
+        def complete(self):
+            if self.errors:
+                raise self.errors.pop(0)
+            return "ok"
+
+    assert classify_error(HttpError(429)) == "rate_limit" and classify_error(HttpError(401)) == "fatal"
+    assert classify_error(ValueError("bad json")) == "parse_error"
+    assert get_retry_after(HttpError(429, {"retry-after": "0.05"})) == 0.05
+
+    # A rate limit with Retry-After then a parse error, the third attempt succeeds
+    provider = FlakyProvider([HttpError(429, {"retry-after": "0.05"}), ValueError("bad json")])
+    start_time = time.perf_counter()
+    assert provider.complete() == "ok"
+    assert time.perf_counter() - start_time >= 0.05
+    print("Metrics:", provider.resilience.get_metrics())
+
+    # Fatal errors are not retried
+    provider = FlakyProvider([HttpError(401)])
+    try:
+        provider.complete()
+    except HttpError:
+        pass
+    assert provider.resilience.metrics.to_dict()["calls"] == 1
+
+    # Two server errors open the circuit, calls fail fast until the recovery timeout
+    provider = FlakyProvider([HttpError(503), HttpError(503), HttpError(503)])
+    try:
+        provider.complete()
+    except HttpError:
+        pass
+    assert provider.resilience.breaker.state == "open"
+    try:
+        provider.complete()
+    except CircuitOpenError as e:
+        print("Short circuited:", e)
+    provider.resilience.breaker.wait_until_ready()
+    provider.errors = []
+    assert provider.complete() == "ok" and provider.resilience.breaker.state == "closed"
+    print("Metrics:", provider.resilience.get_metrics())
@@ -14,14 +14,16 @@ import re
 import base64
 import numpy as np
 import binascii
+from typing import Union
 import pytz
 from pytesseract import Output
 import pytesseract
 from collections import Counter
 from io import BytesIO
 import openpyxl
-from fuzzywuzzy import fuzz
+from src.Utils.fuzzy_matcher import fuzzy_ratio
 from threading import Timer
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
 import zipfile
 from dotenv import load_dotenv
@@ -115,6 +117,42 @@ def pdf_to_images(pdf_file):
     return images
 
 
+def is_pdf(file_bytes: bytes) -> bool:
+    return file_bytes[:5] == b"%PDF-"
+
+def iter_pdf_pages(pdf_bytes: bytes, dpi: int = 150):
+    """
+    Lazily renders the pages of a PDF as PNG bytes, so only the page being
+    rendered is held in memory instead of the whole document.
+
+    Args:
+        pdf_bytes (bytes): The PDF file content.
+        dpi (int): Rendering resolution.
+
+    Yields:
+        bytes: One PNG encoded page at a time, in page order.
+    """
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page in doc:
+            pix = page.get_pixmap(dpi=dpi)
+            yield pix.tobytes("png")
+            del pix
+
+
+def pdf_thumbnail_base64(pdf_bytes: bytes, target_size: int = 640, dpi: int = 72) -> Union[str, None]:
+    """
+    Renders the first page of a PDF as a base64 JPEG, for the invoice list to display.
+
+    Returns:
+        str: The base64 JPEG, or None when the PDF has no page.
+    """
+    for page_bytes in iter_pdf_pages(pdf_bytes, dpi=dpi):
+        img = resize_same_ratio(Image.open(BytesIO(page_bytes)).convert("RGB"), target_size=target_size)
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=85)
+        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+    return None
+
 def resize_same_ratio(img: Image.Image, target_size: int = 640) -> Image.Image:
     """
     Resizes an image to maintain aspect ratio either by height or width.
@@ -230,7 +268,7 @@ def valid_base64_image(data_url: str) -> str:
     :param data_url: The data URL string containing the image data.
     :return: The base64 encoded image string.
     """
-    if data_url.startswith("data:image"):
+    if data_url.startswith("data:image") or data_url.startswith("data:application/pdf"):
         # Find the comma and return the substring after it
         return data_url.split(",")[1]
     else:
@@ -321,64 +359,139 @@ def rotate_bound(image, angle):
     # perform the actual rotation and return the image
     return cv2.warpAffine(image, M, (nW, nH))
 
-def get_rotation_angle(img: Image.Image) -> int:
+def get_rotation_angle(img: Union[Image.Image, np.ndarray]) -> int:
     try:
         """
         Gets the rotation angle of the image using Tesseract's OSD.
 
         Args:
-            img (PIL.Image.Image): The image to analyze.
+            img (PIL.Image.Image or numpy.ndarray): The image to analyze, an RGB or grayscale array.
 
         Returns:
             int: The rotation angle.
         """
-        # Convert PIL image to OpenCV format
-        image_cv = np.array(img)
-        image_cv = cv2.cvtColor(image_cv, cv2.COLOR_RGB2BGR)
+        # Tesseract reads the array directly, no color conversion is needed
+        image_cv = np.asarray(img)
         
         # Use pytesseract to get orientation information
-        rgb = cv2.cvtColor(image_cv, cv2.COLOR_BGR2RGB)
-        results = pytesseract.image_to_osd(rgb, output_type=Output.DICT, config='--psm 0 -c min_characters_to_try=5')
+        results = pytesseract.image_to_osd(image_cv, output_type=Output.DICT, config='--psm 0 -c min_characters_to_try=5')
         
         return results["rotate"]
     except Exception as e:
         return 0
 
-def rotate_image(img: Image.Image) -> Image.Image:
+def resize_array_same_ratio(img: np.ndarray, target_size: int = 640) -> np.ndarray:
+    """Same as resize_same_ratio for an OpenCV/numpy image."""
+    height, width = img.shape[:2]
+    if height > width:
+        new_width, new_height = int((width / height) * target_size), target_size
+    else:
+        new_width, new_height = target_size, int((height / width) * target_size)
+    interpolation = cv2.INTER_AREA if new_width < width else cv2.INTER_CUBIC
+    return cv2.resize(img, (new_width, new_height), interpolation=interpolation)
+
+def estimate_text_metrics(gray: np.ndarray, probe_size: int = 800) -> dict:
     """
-    Rotates an image to correct its orientation based on the detected rotation angle
-    by analyzing the image at different sizes and choosing the most frequent angle.
-    
+    Estimates the text size on a cheap downscaled copy of a grayscale image.
+    Glyph-like connected components of the Otsu binarized probe give the median
+    character height (in pixels of the full image) and the share of the page covered by text.
+    """
+    height, width = gray.shape[:2]
+    scale = min(1.0, probe_size / max(height, width))
+    probe = resize_array_same_ratio(gray, target_size=probe_size) if scale < 1.0 else gray
+
+    # Dark text on light paper becomes the foreground
+    _, binary = cv2.threshold(probe, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+    areas = stats[1:, cv2.CC_STAT_AREA]
+
+    # Drop specks, table rules, logos and photos
+    glyphs = (heights >= 2) & (heights <= probe.shape[0] * 0.1) & (widths <= probe.shape[1] * 0.2)
+    if not glyphs.any():
+        return {"char_height": None, "density": 0.0, "components": 0}
+
+    return {
+        "char_height": round(float(np.median(heights[glyphs])) / scale, 1),
+        "density": round(float(areas[glyphs].sum()) / binary.size, 4),
+        "components": int(glyphs.sum()),
+    }
+
+def get_rotation_angles(img: Union[Image.Image, np.ndarray], target_sizes: list, workers: int = 1) -> list:
+    """
+    Runs Tesseract OSD on the image resized to each target size.
+    Tesseract releases the GIL, so with workers > 1 the sizes are analyzed in parallel.
+    """
+    def get_angle(size):
+        if isinstance(img, np.ndarray):
+            return get_rotation_angle(resize_array_same_ratio(img, target_size=size))
+        return get_rotation_angle(resize_same_ratio(img, target_size=size))
+
+    if workers > 1 and len(target_sizes) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(get_angle, target_sizes))
+    return [get_angle(size) for size in target_sizes]
+
+def detect_rotation_angle(img: Union[Image.Image, np.ndarray], early_exit: bool = True, workers: int = 1) -> int:
+    """
+    Detects the orientation of an image by analyzing it at different sizes
+    and choosing the most frequent angle.
+
     Args:
-        img (PIL.Image.Image): The image to be rotated.
+        img (PIL.Image.Image or numpy.ndarray): The image to analyze, a grayscale array is enough.
+        early_exit (bool): Skip the 2000px pass when the 640px and 1080px passes agree,
+                           the vote cannot change in that case.
+        workers (int): Number of threads running Tesseract OSD in parallel.
 
     Returns:
-        PIL.Image.Image: The rotated image.
+        int: The angle to rotate the image by, 0 when no rotation is needed.
     """
-    
     # Resize the image to different target sizes
     target_sizes = [640, 1080, 2000]
-    rotation_angles = []
 
-    for size in target_sizes:
-        resized_img = resize_same_ratio(img, target_size=size)
-        rotation_angle = get_rotation_angle(resized_img)
-        rotation_angles.append(rotation_angle)
+    if early_exit:
+        rotation_angles = get_rotation_angles(img, target_sizes[:2], workers=workers)
+        if rotation_angles[0] != rotation_angles[1]:
+            rotation_angles += get_rotation_angles(img, target_sizes[2:])
+    else:
+        rotation_angles = get_rotation_angles(img, target_sizes, workers=workers)
 
     # Find the most common rotation angle
     most_common_angle = Counter(rotation_angles).most_common(1)[0][0]
 
     if abs(most_common_angle) in [0, 180]:
-        return img, 0
+        return 0
+    return most_common_angle
+
+def rotate_image(img: Image.Image, early_exit: bool = True, workers: int = 1) -> Image.Image:
+    """
+    Rotates an image to correct its orientation based on the detected rotation angle
+    by analyzing the image at different sizes and choosing the most frequent angle.
+    
+    Args:
+        img (PIL.Image.Image): The image to be rotated.
+        early_exit (bool): Skip the 2000px pass when the 640px and 1080px passes agree.
+        workers (int): Number of threads running Tesseract OSD in parallel.
 
-    # Rotate the original image using the most common angle
+    Returns:
+        PIL.Image.Image: The rotated image.
+    """
+    angle = detect_rotation_angle(img, early_exit=early_exit, workers=workers)
+    return rotate_by_angle(img, angle), angle
+
+def rotate_by_angle(img: Image.Image, angle: int) -> Image.Image:
+    """Rotates a PIL image by an already known angle, as returned by rotate_image."""
+    if not angle:
+        return img
+
+    # Rotate the original image using the angle
     image_cv = np.array(img)
     image_cv = cv2.cvtColor(image_cv, cv2.COLOR_RGB2BGR)
-    rotated = rotate_bound(image_cv, angle=most_common_angle)
+    rotated = rotate_bound(image_cv, angle=angle)
     
     # Convert the rotated image back to PIL format
-    rotated_pil = Image.fromarray(cv2.cvtColor(rotated, cv2.COLOR_BGR2RGB))
-    return rotated_pil, most_common_angle
+    return Image.fromarray(cv2.cvtColor(rotated, cv2.COLOR_BGR2RGB))
 
 def convert_base64_to_pil_image(base64_img: str) -> Image.Image:
     """
@@ -452,10 +565,10 @@ def convert_iso_to_string(data, format:str = '%d/%m/%Y'):
         return convert_single_value(data)
 
 def get_currencies_from_txt(file_path:str ="config/currencies.txt"):
-    # Read the file and return a list of currency codes
+    # Read the file and return a list of currency codes, unique and in file order
     with open(file_path, 'r') as f:
         currencies = [line.strip() for line in f.readlines() if line.strip()]
-    return list(set(currencies))
+    return list(dict.fromkeys(currencies))
 
 def get_land_and_city_list(file_path:str = "config/travel_expenses-2024.xlsx", 
                               sheet_name=None):
@@ -468,8 +581,9 @@ def get_land_and_city_list(file_path:str = "config/travel_expenses-2024.xlsx",
     else:
         sheet = workbook[sheet_name]
 
-    cities = set()  # Use set to store unique cities
-    lands = set()  # Use set to store unique countries
+    # Dicts keep the names unique in workbook order, fuzzy matching ties go to the first one
+    cities = {}
+    lands = {}
 
     # Iterate through rows and extract city/country names
     for row in sheet.iter_rows(min_row=4, min_col=1, max_col=1):
@@ -480,37 +594,37 @@ def get_land_and_city_list(file_path:str = "config/travel_expenses-2024.xlsx",
                 city = cell_value[1:].strip()  # Remove em dash and spaces
                 if city == "im Übrigen":  # Replace city name if it's 'im Übrigen'
                     city = 'Other'
-                cities.add(city)  # Add to set to ensure uniqueness
+                cities.setdefault(city)
             else:
-                lands.add(cell_value)  # Add to set to ensure uniqueness
+                lands.setdefault(cell_value)
 
     workbook.close()
     
-    # Convert sets back to lists before returning
-    return list(lands), list(cities) 
+    return list(lands), list(cities)
 
 def find_best_match_fuzzy(string_list: list[str], text:str):
     """
-    Find the closest match to text using fuzzy matching.
+    Find the closest match to text using fuzzy matching, a linear scan of string_list.
+    Lists matched again and again should be kept as a FuzzyMatcher, as the reference data does.
     :param text: string text (possibly incorrect)
     :param list: List of string to find
     :return: Position of best matching name in the original list, best matching name, and highest similarity score.
+             (None, None, 0) when no candidate scores above 0.
     """
     # Preprocess the OCR output
     text = text.lower()
 
-    # Extract the closest match using fuzzy matching (search over both last-first and first-last formats)
     best_idx, best_score = None, 0
-
     for idx, item in enumerate(string_list):
-        score = fuzz.ratio(text, item.lower())
+        score = fuzzy_ratio(text, item.lower())
         if score > best_score:
             best_score = score
             best_idx = idx
 
+    if best_idx is None:
+        return None, None, 0
     # Return the index of the original name in the list, the best match, and the score
-    original_name = string_list[best_idx]
-    return best_idx, original_name, best_score
+    return best_idx, string_list[best_idx], best_score
 
 
 def debounce(func, delay):
@@ -5,8 +5,10 @@ import uvicorn
 import time
 import os
 import json
+import base64
 import threading
 import gc
+import asyncio
 import shutil
 from fastapi import (FastAPI, Request, Depends,
                      status, HTTPException, Query)
@@ -19,18 +21,22 @@ from contextlib import asynccontextmanager
 
 from src.mongo_database import MongoDatabase
 from src.ocr_reader import OcrReader, GoogleTranslator
-from src.base_extractors import OpenAIExtractor 
+from src.ocr_pool import OcrProcessPool
+from src.base_extractors import OpenAIExtractor, AsyncOpenAIExtractor
 # from src.qwen2_extract import Qwen2Extractor
 
 from src.ldap_authen import (User, get_current_user, ldap_authen, 
                              Token, create_access_token)
 from src.Utils.utils import (read_config, get_current_time, is_base64, 
                              valid_base64_image, convert_datetime_to_iso, convert_iso_to_string,
-                             get_land_and_city_list, get_currencies_from_txt, debounce, create_zip_file)
+                             debounce, create_zip_file, pdf_thumbnail_base64)
 from src.invoice_extraction import validate_invoice
+from src.template_classifier import get_template_classifier
+from src.reference_data import get_reference_data
 from src.Utils.logger import create_logger
 from src.mail import EmailSender
-from src.Utils.process_documents_utils import get_egw_file, get_excel_files, process_single_document
+from src.Utils.process_documents_utils import (get_egw_file, get_excel_files, process_documents, 
+                                               process_documents_async, poll_batch_jobs)
 from src.rate_limiter import RateLimiter
 
 
@@ -53,21 +59,37 @@ mongo_db = MongoDatabase(config_path=config_path, logger=logger)
 change_stream = None
 change_stream_thread = None
 
-ocr_reader = OcrReader(config_path=config_path, translator=GoogleTranslator(), logger=logger)
-invoice_extractor = OpenAIExtractor(config_path=config_path)
+if config['ocr'].get('backend') == 'process':
+    # OCR runs in child processes, each with its own warm OcrReader
+    ocr_reader = OcrProcessPool(config_path=config_path, logger=logger)
+else:
+    ocr_reader = OcrReader(config_path=config_path, translator=GoogleTranslator(config_path=config_path), logger=logger)
+if config['llm_extract'].get('mode') == 'async':
+    # Several LLM calls in flight while the next documents are OCR'd
+    invoice_extractor = AsyncOpenAIExtractor(config_path=config_path, logger=logger)
+else:
+    invoice_extractor = OpenAIExtractor(config_path=config_path, logger=logger)
+
+# Fit the document type classifier at startup instead of on the first German document
+get_template_classifier(config['invoice_txt_template'])
+# Parse the currencies, lands, cities and employee workbook once, validation reads the snapshots
+get_reference_data(config).warm_up()
 
 email_sender = EmailSender(config=config, logger=logger)
 
 max_files_per_min = config['rate_limit']['max_files_per_min']
 rate_limiter = RateLimiter(max_files_per_min)
 
+# The change stream worker and the batch poller share the OCR reader and the extractor
+extraction_lock = threading.Lock()
+
 
 def generate_and_send_files():
     """Generate EGW and Excel files for the month, zip them, send an email, and clean up."""
-    # Check if any documents remain with status "not extracted"
-    documents, _ = mongo_db.get_documents(filters={"status": "not extracted"}, limit = 10)
+    # Check if any documents remain with status "not extracted" or waiting on a batch job
+    documents, _ = mongo_db.get_documents(filters={"status": {"$in": ["not extracted", "batch submitted"]}}, limit = 10)
     if len(documents) > 0:
-        logger.debug(f"Skipping file generation: {len(documents)} documents still 'not extracted'")
+        logger.debug(f"Skipping file generation: {len(documents)} documents still 'not extracted' or 'batch submitted'")
         return
 
     output_folder = None
@@ -149,6 +171,8 @@ debounced_insert_generate_and_send = debounce(generate_and_send_files, config['d
 debounced_update_generate_and_send = debounce(generate_and_send_files, config['debounce_time']['update'])  # 60 seconds
 
 def process_change_stream(config):
+    # One event loop for the lifetime of the worker, the async extractor's connections are bound to it
+    loop = asyncio.new_event_loop()
     with mongo_db.start_change_stream() as change_stream:
         for change in change_stream:
             if change['operationType'] == 'insert':
@@ -159,18 +183,26 @@ def process_change_stream(config):
                     if not documents:
                         continue
                     
-                    # Process each document in the batch
-                    for document in documents:
-                        process_single_document(
-                            ocr_reader=ocr_reader,
-                            invoice_extractor=invoice_extractor,
-                            config=config,
-                            mongo_db=mongo_db,
-                            logger=logger,
-                            document=document
-                        )
-                        del document
-                        gc.collect()
+                    # Process the batch, detecting the languages in one forward pass
+                    with extraction_lock:
+                        if isinstance(invoice_extractor, AsyncOpenAIExtractor):
+                            loop.run_until_complete(process_documents_async(
+                                ocr_reader=ocr_reader,
+                                invoice_extractor=invoice_extractor,
+                                config=config,
+                                mongo_db=mongo_db,
+                                logger=logger,
+                                documents=documents
+                            ))
+                        else:
+                            process_documents(
+                                ocr_reader=ocr_reader,
+                                invoice_extractor=invoice_extractor,
+                                config=config,
+                                mongo_db=mongo_db,
+                                logger=logger,
+                                documents=documents
+                            )
 
                     del documents
                     gc.collect()
@@ -190,6 +222,17 @@ def process_change_stream(config):
                 except Exception as e:
                     logger.error(f"Error in update processing: {e}")
 
+def poll_batch_jobs_forever(config, stop_event: threading.Event):
+    """Poll the batch jobs of non-urgent documents every poll_interval seconds."""
+    poll_interval = config['llm_extract']['batch'].get('poll_interval', 300)
+    while not stop_event.wait(poll_interval):
+        try:
+            with extraction_lock:
+                poll_batch_jobs(ocr_reader=ocr_reader, invoice_extractor=invoice_extractor,
+                                config=config, mongo_db=mongo_db, logger=logger)
+        except Exception as e:
+            logger.error(f"Error polling batch jobs: {e}")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Set up the change stream processing thread within the lifespan
@@ -201,13 +244,22 @@ async def lifespan(app: FastAPI):
     
     # Start the thread when the app starts up
     change_stream_thread.start()
+
+    stop_batch_poller = threading.Event()
+    if (config['llm_extract'].get('batch') or {}).get('enabled', False):
+        threading.Thread(target=poll_batch_jobs_forever, args=(config, stop_batch_poller), daemon=True).start()
     
     yield  # FastAPI continues running here
 
+    stop_batch_poller.set()
+
     # Cleanup: Wait for the change stream thread to complete
     if change_stream_thread.is_alive():
         change_stream_thread.join(timeout=5)  # Join with timeout to prevent indefinite wait
 
+    if isinstance(ocr_reader, OcrProcessPool):
+        ocr_reader.close()
+
 app = FastAPI(lifespan=lifespan)
 
 # Define allowed origins
@@ -288,23 +340,17 @@ async def read_users_me(current_user: User = Depends(get_current_user_dependency
 @app.get("/api/v1/frontend_defines")
 async def get_frontend_defines():
     try:
-        # Read the JSON file
-        frontend_fields_define_path = config['frontend_fields_define_path']
-        with open(frontend_fields_define_path, "r") as file:
-            frontend_defines = json.load(file)
-
-        # Get currencies, lands, and cities
-        currencies = get_currencies_from_txt()
-        lands, cities = get_land_and_city_list()
-
-        # Update the frontend defines with the retrieved data
-        for item in frontend_defines:
-            if item["key"] == "currency":
-                item["data"] = currencies
-            elif item["key"] == "city":
-                item["data"] = cities
-            elif item["key"] == "land":
-                item["data"] = lands
+        # Field definitions, currencies, lands, and cities are cached by the reference data service
+        reference_data = get_reference_data(config)
+        reference_lists = {
+            "currency": list(reference_data.currencies),
+            "city": list(reference_data.cities),
+            "land": list(reference_data.lands),
+        }
+
+        # Fill the frontend defines with the reference data, leave the cached snapshot as is
+        frontend_defines = [{**item, "data": reference_lists[item["key"]]} if item["key"] in reference_lists else item
+                            for item in reference_data.frontend_defines]
 
         msg={
                 "frontend_defines": frontend_defines,
@@ -342,7 +388,7 @@ async def upload_invoice(
         if not img or not is_base64(img):
             msg = {
                     "status": "error",
-                    "message": "Base64 image is required",
+                    "message": "Base64 image or PDF is required",
                 }
             logger.debug(msg=msg)
             return JSONResponse(
@@ -352,14 +398,21 @@ async def upload_invoice(
         # Generate invoice UUID
         img = valid_base64_image(img)       
         
+        # PDFs start with '%PDF-', which is 'JVBERi0' once base64 encoded
+        file_type = "pdf" if img.startswith("JVBERi0") else "image"
+        # The invoice list shows images, a PDF is shown by its rendered first page
+        thumbnail = await asyncio.to_thread(pdf_thumbnail_base64, base64.b64decode(img)) if file_type == "pdf" else None
+
         invoice_document = {
             "invoice_type": None,
+            "file_type": file_type,
             "created_at": get_current_time(timezone=config['timezone']),
             "created_by": user_uuid,
             "last_modified_at": None,
             "last_modified_by": None,
             "status": "not extracted",
             "invoice_image_base64": img,
+            "invoice_thumbnail_base64": thumbnail,
             "file_name": file_name,
             "invoice_info": {}
         }
@@ -491,7 +544,7 @@ async def get_invoices(
     created_by: Optional[str] = Query(None, description="Filter by user_uuid of the invoice creator"),
     invoice_type: Optional[str] = Query(None, description="Filter by type of invoice"),
     invoice_uuid: Optional[str] = Query(None, description="Filter by id of invoice"),
-    invoice_status: Optional[Literal['not extracted', 'completed']] = Query(None, description="Filter by invoice invoicestatus"),
+    invoice_status: Optional[Literal['not extracted', 'batch submitted', 'completed']] = Query(None, description="Filter by invoice invoicestatus"),
     page: int = Query(1, description="Page number for pagination", gt=0),
     limit: int = Query(10, description="Number of invoices per page", gt=0),
 ):
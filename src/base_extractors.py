@@ -5,22 +5,179 @@ import base64
 import os
 import cv2
 import numpy as np
-from typing import Union
-from llama_index.llms.ollama import Ollama
+import json
+import time
+import asyncio
+import threading
+from io import BytesIO
+from collections import Counter
+from typing import List, Optional, Tuple, Type, Union
+from pydantic import BaseModel
 from PIL import Image
-from src.Utils.utils import read_config, timeit, retry_on_failure, valid_base64_image
+from src.Utils.utils import read_config, timeit, valid_base64_image
+from src.Utils.resilience import Resilience, CircuitOpenError, resilient, async_resilient
+from src.Utils.image_buffer import ImageBuffer
+from src.Utils.cache import create_cache_store, hash_bytes, CacheStats
+from src.Utils.json_stream import IncrementalJsonParser, find_structural_errors, find_invalid_fields, parse_json_answer
+from src.prompt_builder import PromptBuilder
 
 from dotenv import load_dotenv
 load_dotenv()
 
+class ImagePayloadPolicy:
+    """
+    How the invoice image is sent to a multimodal LLM: longest side, format and quality,
+    grayscale and the OpenAI detail level. An upload that already has the right format and
+    size is sent as is, without decoding or re-encoding it.
+    """
+    # format: (extension, cv2 quality flag, mime type)
+    FORMATS = {
+        "jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY, "image/jpeg"),
+        "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY, "image/webp"),
+        "png": (".png", None, "image/png"),
+    }
+
+    def __init__(self, max_long_edge: int = 1600, format: str = "jpeg", quality: int = 85,
+                 grayscale: bool = False, detail: str = "auto"):
+        if format not in self.FORMATS:
+            raise ValueError(f"Unsupported image payload format: {format}")
+        self.max_long_edge = max_long_edge
+        self.format = format
+        self.quality = quality
+        self.grayscale = grayscale
+        self.detail = detail
+
+    @staticmethod
+    def _source_format(source_bytes: bytes) -> Optional[str]:
+        if source_bytes[:3] == b"\xff\xd8\xff":
+            return "jpeg"
+        if source_bytes[:8] == b"\x89PNG\r\n\x1a\n":
+            return "png"
+        if source_bytes[:4] == b"RIFF" and source_bytes[8:12] == b"WEBP":
+            return "webp"
+        return None
+
+    def _source_fits(self, image: ImageBuffer) -> bool:
+        if image.source_bytes is None or self.grayscale:
+            return False
+        if self._source_format(image.source_bytes) != self.format:
+            return False
+        # Only the header is read, the pixels are not decoded
+        width, height = Image.open(BytesIO(image.source_bytes)).size
+        return not self.max_long_edge or max(width, height) <= self.max_long_edge
+
+    def encode(self, image: ImageBuffer) -> dict:
+        """Return {"base64", "mime_type", "detail", "size_bytes", "encode_time", "reused_source"}."""
+        start_time = time.perf_counter()
+        extension, quality_flag, mime_type = self.FORMATS[self.format]
+
+        reused_source = self._source_fits(image)
+        if reused_source:
+            payload_bytes = image.source_bytes
+        else:
+            if self.max_long_edge and max(image.size) > self.max_long_edge:
+                image = image.resized(self.max_long_edge)
+            params = (quality_flag, int(self.quality)) if quality_flag is not None else ()
+            payload_bytes = image.encode(extension, params, grayscale=self.grayscale)
+
+        return {
+            "base64": base64.b64encode(payload_bytes).decode("utf-8"),
+            "mime_type": mime_type,
+            "detail": self.detail,
+            "size_bytes": len(payload_bytes),
+            "encode_time": round(time.perf_counter() - start_time, 4),
+            "reused_source": reused_source,
+        }
+
+
+class TieredPolicy:
+    """
+    Two-tier extraction: a text-only completion first for the configured invoice types, scored
+    on the coverage of the required fields and its validity against the invoice model. The
+    image-bearing completion is only made when the score is below min_score.
+    """
+    def __init__(self, enabled: bool = False, invoice_types: List[str] = None,
+                 required_fields: dict = None, min_score: float = 0.75):
+        self.enabled = enabled
+        self.invoice_types = set(invoice_types or [])
+        self.required_fields = required_fields or {}
+        self.min_score = min_score
+
+    @classmethod
+    def from_config(cls, config: dict = None) -> "TieredPolicy":
+        config = config or {}
+        return cls(enabled=config.get('enabled', False),
+                   invoice_types=config.get('invoice_types'),
+                   required_fields=config.get('required_fields'),
+                   min_score=config.get('min_score', 0.75))
+
+    def applies(self, invoice_type: str) -> bool:
+        return self.enabled and invoice_type in self.invoice_types
+
+    def score(self, invoice_info: dict, response_model: Type[BaseModel] = None, invoice_type: str = None) -> float:
+        """Share of the required fields with a valid value, times the share of valid fields. 0 for the wrong shape."""
+        invalid_fields = find_invalid_fields(invoice_info, response_model) if response_model is not None else []
+        if invalid_fields is None or not isinstance(invoice_info.get('invoice_info'), dict):
+            return 0.0
+        values = invoice_info['invoice_info']
+        required_fields = self.required_fields.get(invoice_type) or []
+        covered = [field for field in required_fields
+                   if values.get(field) not in (None, "", [], {}) and field not in invalid_fields]
+        coverage = len(covered) / len(required_fields) if required_fields else 1.0
+        validity = 1 - len(invalid_fields) / max(1, len(values))
+        return round(coverage * validity, 3)
+
+
 class BaseExtractor:
-    def __init__(self, config_path: str = "config/config.yaml"):
+    def __init__(self, config_path: str = "config/config.yaml", logger=None):
         self.config_path = config_path
         self.config = read_config(path=self.config_path)['llm_extract']
+        self.logger = logger
+        # Static instructions and template first, so the provider can cache the prompt prefix
+        self.prompt_builder = PromptBuilder.from_config_path(config_path)
+
+        # Backoff, Retry-After and circuit breaker around the provider calls
+        self.resilience = Resilience.from_config(type(self).__name__, self.config.get('resilience'))
+
+        payload_config = self.config.get('image_payload') or {}
+        self.payload_policy = ImagePayloadPolicy(max_long_edge=payload_config.get('max_long_edge', 1600),
+                                                 format=payload_config.get('format', 'jpeg'),
+                                                 quality=payload_config.get('quality', 85),
+                                                 grayscale=payload_config.get('grayscale', False),
+                                                 detail=payload_config.get('detail', 'auto'))
+
+    def to_image_buffer(self, image_input: Union[str, np.ndarray, Image.Image, ImageBuffer]) -> ImageBuffer:
+        if isinstance(image_input, ImageBuffer):
+            return image_input
+        elif isinstance(image_input, str):
+            if os.path.isfile(image_input):
+                return ImageBuffer.from_path(image_input)
+            return ImageBuffer.from_base64(valid_base64_image(data_url=image_input))
+        elif isinstance(image_input, np.ndarray):
+            # Same convention as encode_image, arrays are BGR
+            return ImageBuffer(cv2.cvtColor(image_input, cv2.COLOR_BGR2RGB))
+        elif isinstance(image_input, Image.Image):
+            return ImageBuffer.from_pil(image_input)
+        else:
+            raise ValueError("Unsupported image input type. Please provide a file path, base64 string, NumPy array, PIL Image or ImageBuffer.")
+
+    def encode_image_payload(self, image_input: Union[str, np.ndarray, Image.Image, ImageBuffer]) -> dict:
+        """Encode the image following the payload policy and log the request size and encode time."""
+        payload = self.payload_policy.encode(self.to_image_buffer(image_input))
+        msg = (f"Image payload: {payload['size_bytes'] / 1024:.1f} KB {payload['mime_type']}, "
+               f"encoded in {payload['encode_time']}s, reused upload: {payload['reused_source']}")
+        print(msg)
+        if self.logger:
+            self.logger.debug(msg)
+        return payload
 
     
-    def encode_image(self, image_input: Union[str, np.ndarray, Image.Image]) -> str:
-        if isinstance(image_input, str):
+    def encode_image(self, image_input: Union[str, np.ndarray, Image.Image, ImageBuffer]) -> str:
+        if isinstance(image_input, ImageBuffer):
+            # The buffer caches its encoded forms
+            return image_input.to_base64('.png')
+
+        elif isinstance(image_input, str):
             try:  # Check if it's a local file path
                 with open(image_input, "rb") as image_file:
                     return base64.b64encode(image_file.read()).decode("utf-8")
@@ -40,11 +197,15 @@ class BaseExtractor:
             return base64.b64encode(buffer).decode("utf-8")
         
         else:
-            raise ValueError("Unsupported image input type. Please provide a file path, base64 string, NumPy array, or PIL Image.")
+            raise ValueError("Unsupported image input type. Please provide a file path, base64 string, NumPy array, PIL Image or ImageBuffer.")
+
 
+    def get_retry_metrics(self) -> dict:
+        return self.resilience.get_metrics()
 
-    @retry_on_failure(max_retries=3, delay=1.0)
-    def extract_invoice(self, text, image: Union[str, np.ndarray]) -> dict:
+    @resilient
+    def extract_invoice(self, text, image: Union[str, np.ndarray], invoice_template:str = None,
+                        response_model = None, invoice_type: str = None) -> dict:
         raise NotImplementedError("This method should be implemented by subclasses")
 
 class InvoicePostProcessing:
@@ -54,14 +215,21 @@ class InvoicePostProcessing:
 
         self.model_name=self.config['model_name'] 
         self.request_timeout=self.config['request_timeout'] 
-        self.llm = Ollama(model=self.model_name, request_timeout= self.request_timeout, json_mode=True)
+        self.base_url = self.config.get('base_url', 'http://localhost:11434')
+        self.keep_alive = self.config.get('keep_alive', '5m')
+
+        import httpx
+        # One client for every call, the connection to Ollama is kept alive between documents
+        self.client = httpx.Client(base_url=self.base_url, timeout=self.request_timeout,
+                                   limits=httpx.Limits(max_connections=self.config.get('max_connections', 4),
+                                                       max_keepalive_connections=self.config.get('max_connections', 4)))
         self._load_dummy_data()
 
     
     def _load_dummy_data(self):
         # Dummy OCR text
         try:
-            response = self.llm.complete("who are you")
+            response = self.complete("who are you")
             # Print the response for verification
             print(f"Dummy data processing output:{response}")
         except Exception as e:
@@ -83,8 +251,22 @@ class InvoicePostProcessing:
         """
 
         # Generate the response from the LLM
-        response = self.llm.complete(prompt)
-        return response.text
+        return self.complete(prompt)
+
+    def complete(self, prompt: str) -> str:
+        """JSON mode completion on the Ollama generate endpoint."""
+        response = self.client.post("/api/generate", json={
+            "model": self.model_name,
+            "prompt": prompt,
+            "format": "json",
+            "stream": False,
+            "keep_alive": self.keep_alive,
+        })
+        response.raise_for_status()
+        return response.json()["response"]
+
+    def close(self):
+        self.client.close()
     
     def __getitem__(self, item):
         if item == "post_processor":
@@ -92,53 +274,344 @@ class InvoicePostProcessing:
         else:
             raise KeyError(f"No such key: {item}")
     
+class BatchJobError(Exception):
+    """A batch job ended without producing results."""
+
+
 class OpenAIExtractor(BaseExtractor):
-    def __init__(self, config_path: str = "config/config.yaml"):
-        super().__init__(config_path)
+    # Streamed chunks read after the JSON object is closed, waiting for the usage chunk
+    MAX_TAIL_CHUNKS = 8
 
+    def __init__(self, config_path: str = "config/config.yaml", logger=None):
+        super().__init__(config_path, logger=logger)
+
+        cache_config = self.config.get('cache') or {}
+        self.batch_config = self.config.get('batch') or {}
         self.config = self.config['openai']
         self.model = self.config['model_name']
         self.temperature = self.config['temperature']
         self.max_tokens = self.config['max_tokens']
+        # Stream the completion and parse the JSON as it arrives
+        self.stream = self.config.get('stream', False)
+        self.max_continuations = self.config.get('max_continuations', 1)
 
         self.OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
         from openai import OpenAI
-        self.client = OpenAI(api_key=self.OPENAI_API_KEY)
+        # Null uses the OpenAI API (or the OPENAI_BASE_URL environment variable)
+        self.base_url = self.config.get('base_url')
+        # Retries are handled by self.resilience
+        self.client = OpenAI(api_key=self.OPENAI_API_KEY, base_url=self.base_url, max_retries=0)
+
+        self.usage_stats = Counter()
+        self._usage_lock = threading.Lock()
+
+        # Text-only completion first for clean documents, the image only when it scores low
+        self.tier_policy = TieredPolicy.from_config(read_config(path=self.config_path)['llm_extract'].get('tiered'))
+        self.tier_stats = Counter()
+
+        # Cache raw completions by prompt inputs, re-uploads and reprocessing skip the LLM call
+        self.cache_store = None
+        self.cache_stats = CacheStats()
+        if cache_config.get('enabled', False):
+            self.cache_store = create_cache_store(cache_config, mongo_config=read_config(path=self.config_path).get('mongodb'))
+
+    def _build_messages(self, ocr_text, image_payload:dict, invoice_template:str) -> list:
+        return self.prompt_builder.build_messages(ocr_text, image_payload, invoice_template)
+
+    @staticmethod
+    def _messages_tier(messages: list) -> str:
+        """"multimodal" when the messages carry an image, else "text"."""
+        has_image = any(isinstance(message['content'], list) and
+                        any(part.get('type') == 'image_url' for part in message['content'])
+                        for message in messages)
+        return "multimodal" if has_image else "text"
+
+    def _record_usage(self, usage, tier: str = "multimodal"):
+        """Add the token usage of a response, cached_tokens is the prompt prefix the provider had cached."""
+        if usage is None:
+            return
+        if not isinstance(usage, dict):
+            usage = usage.model_dump()
+        cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+        with self._usage_lock:
+            self.usage_stats['requests'] += 1
+            self.usage_stats['prompt_tokens'] += usage.get('prompt_tokens') or 0
+            self.usage_stats['cached_tokens'] += cached_tokens
+            self.usage_stats['completion_tokens'] += usage.get('completion_tokens') or 0
+            self.usage_stats[f'{tier}_prompt_tokens'] += usage.get('prompt_tokens') or 0
+            self.usage_stats[f'{tier}_completion_tokens'] += usage.get('completion_tokens') or 0
+        msg = f"LLM usage ({tier}): {usage.get('prompt_tokens')} prompt tokens ({cached_tokens} cached), {usage.get('completion_tokens')} completion tokens"
+        print(msg)
+        if self.logger:
+            self.logger.debug(msg)
+
+    def get_usage_stats(self) -> dict:
+        with self._usage_lock:
+            stats = dict(self.usage_stats)
+        stats['cached_ratio'] = round(stats['cached_tokens'] / stats['prompt_tokens'], 3) if stats.get('prompt_tokens') else None
+        return stats
+
+    def _record_tier(self, tier: str, latency: float, escalated: bool = None):
+        with self._usage_lock:
+            self.tier_stats[f'{tier}_calls'] += 1
+            self.tier_stats[f'{tier}_latency'] += latency
+            if escalated is not None:
+                self.tier_stats['tiered_documents'] += 1
+                self.tier_stats['escalations'] += int(escalated)
+
+    def get_tier_stats(self) -> dict:
+        """Calls, mean latency and tokens of each tier, and the share of tiered documents escalated to the image."""
+        with self._usage_lock:
+            tier_stats = dict(self.tier_stats)
+            usage_stats = dict(self.usage_stats)
+        stats = {}
+        for tier in ("text", "multimodal"):
+            calls = tier_stats.get(f'{tier}_calls', 0)
+            stats[tier] = {
+                "calls": calls,
+                "mean_latency": round(tier_stats[f'{tier}_latency'] / calls, 3) if calls else None,
+                "prompt_tokens": usage_stats.get(f'{tier}_prompt_tokens', 0),
+                "completion_tokens": usage_stats.get(f'{tier}_completion_tokens', 0),
+            }
+        tiered_documents = tier_stats.get('tiered_documents', 0)
+        stats['tiered_documents'] = tiered_documents
+        stats['escalation_rate'] = round(tier_stats.get('escalations', 0) / tiered_documents, 3) if tiered_documents else None
+        return stats
+
+    def _cache_key(self, ocr_text, image_payload:dict, invoice_template:str) -> str:
+        # Prompt inputs plus every model parameter that changes the completion
+        image_key = (hash_bytes(image_payload['base64']), image_payload['detail']) if image_payload else ("text only",)
+        return hash_bytes(hash_bytes(ocr_text), *image_key, hash_bytes(invoice_template),
+                          self.model, str(self.temperature), str(self.max_tokens))
+
+    def get_cache_stats(self) -> dict:
+        stats = self.cache_stats.to_dict()
+        stats['size'] = len(self.cache_store) if self.cache_store is not None else 0
+        return stats
+
+    def _get_cached_completion(self, cache_key: str):
+        if self.cache_store is None:
+            return None
+        completion = self.cache_store.get(cache_key)
+        self.cache_stats.record(hit=completion is not None)
+        return completion
+
+    def _parse_completion(self, completion: str, cache_key: str, cache_hit: bool,
+                          response_model: Type[BaseModel] = None, repaired: bool = False) -> dict:
+        invoice_info = self.extract_json(completion)
+        if response_model is not None:
+            errors = find_structural_errors(invoice_info, response_model)
+            if errors:
+                raise ValueError(f"The completion does not match {response_model.__name__}: {errors[:5]}")
+        # Only completions that parse are cached, so a retry after a parse error calls the LLM again.
+        # A repaired truncated answer is not cached either, the next upload asks the LLM again
+        if self.cache_store is not None and not cache_hit and not repaired:
+            self.cache_store.set(cache_key, completion)
+        invoice_info['llm_cache'] = {"enabled": self.cache_store is not None, "hit": cache_hit, "key": cache_key,
+                                     "repaired": repaired}
+        return invoice_info
+
+    def _continuation_messages(self, messages: list, partial_text: str) -> list:
+        # Ask only for the missing tail of a cut off answer
+        return messages + [
+            {"role": "assistant", "content": partial_text},
+            {"role": "user", "content": "Your answer was cut off. Continue the JSON exactly where it stopped. "
+                                        "Output only the missing characters, don't repeat anything."},
+        ]
+
+    def _finish_stream(self, parser: IncrementalJsonParser) -> Tuple[str, bool]:
+        """The completion and whether it was repaired from a truncated answer."""
+        if parser.complete:
+            return parser.json_text, False
+        repaired = parser.repair()
+        if repaired is None:
+            raise ValueError("The streamed completion has no JSON object to repair")
+        print("Repaired a truncated JSON completion")
+        return json.dumps(repaired, ensure_ascii=False), True
+
+    def _stream_completion(self, messages: list, parser: IncrementalJsonParser):
+        """Feed a streamed completion to the parser, stop reading as soon as the JSON object is closed."""
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            tail_chunks = 0
+            for chunk in stream:
+                if chunk.usage is not None:
+                    self._record_usage(chunk.usage, tier=self._messages_tier(messages))
+                    break
+                if parser.complete:
+                    # Only the final usage chunk is still of interest, don't wait on a long tail
+                    tail_chunks += 1
+                    if tail_chunks > self.MAX_TAIL_CHUNKS:
+                        break
+                elif chunk.choices and chunk.choices[0].delta.content:
+                    parser.feed(chunk.choices[0].delta.content)
+        finally:
+            stream.close()
+
+    def _stream_invoice_llm(self, ocr_text, image_payload:dict, invoice_template:str) -> Tuple[str, bool]:
+        messages = self._build_messages(ocr_text, image_payload, invoice_template)
+        parser = IncrementalJsonParser()
+        for attempt in range(self.max_continuations + 1):
+            try:
+                self._stream_completion(messages if attempt == 0 else self._continuation_messages(messages, parser.text),
+                                        parser)
+            except Exception as e:
+                if not parser.text:
+                    raise  # Nothing received, retry the whole call
+                print(f"Completion stream interrupted: {e}")
+            if parser.complete:
+                break
+        return self._finish_stream(parser)
+
+    def _extract_invoice_llm(self, ocr_text, image_payload:dict, invoice_template:str) -> Tuple[str, bool]:
+        """The completion and whether it was repaired from a truncated stream."""
+        if self.stream:
+            return self._stream_invoice_llm(ocr_text, image_payload, invoice_template)
 
-    def _extract_invoice_llm(self, ocr_text, base64_image:str, invoice_template:str):
         response = self.client.chat.completions.create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": """You are a helpful assistant that responds in JSON format with the invoice information in English. 
-                                            Don't add any annotations there. Remember to close any bracket. And just output the field that has value, 
-                                            don't return field that are empty. number, price and amount should be number, date should be convert to dd/mm/yyyy, 
-                                            time should be convert to HH:mm:ss, currency should be 3 chracters like VND, USD, EUR"""},
-                {"role": "user", "content": [
-                    {"type": "text", "text": f"From the image of the bill and the text from OCR, extract the information. The ocr text is: {ocr_text} \n. Return the key names as in the template is a MUST. The invoice template: \n {invoice_template}"},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}"}}
-                ]}
-            ],
+            messages=self._build_messages(ocr_text, image_payload, invoice_template),
             temperature=self.temperature,
             max_tokens=self.max_tokens,
         )
-        return response.choices[0].message.content
+        self._record_usage(response.usage, tier="text" if image_payload is None else "multimodal")
+        return response.choices[0].message.content, False
 
     def extract_json(self, text: str) -> dict:
-        start_index = text.find('{')
-        end_index = text.rfind('}') + 1
-        json_string = text[start_index:end_index]
-        json_string = json_string.replace('true', 'True').replace('false', 'False').replace('null', 'None')
-        result = eval(json_string)
-        return result
-
-    @retry_on_failure(max_retries=3, delay=1.0)
-    def extract_invoice(self, ocr_text, image: Union[str, np.ndarray], invoice_template:str) -> dict:
-        base64_image = self.encode_image(image)
-        invoice_info = self._extract_invoice_llm(ocr_text, base64_image, 
-                                                 invoice_template=invoice_template)
-        invoice_info = self.extract_json(invoice_info)
+        return parse_json_answer(text)
+
+    @resilient
+    def _extract_invoice_tier(self, ocr_text, image, invoice_template:str,
+                              response_model: Type[BaseModel] = None) -> dict:
+        """One completion, text only when image is None."""
+        image_payload = self.encode_image_payload(image) if image is not None else None
+        cache_key = self._cache_key(ocr_text, image_payload, invoice_template)
+        completion = self._get_cached_completion(cache_key)
+        cache_hit, repaired = completion is not None, False
+        if not cache_hit:
+            completion, repaired = self._extract_invoice_llm(ocr_text, image_payload, 
+                                                             invoice_template=invoice_template)
+        return self._parse_completion(completion, cache_key=cache_key, cache_hit=cache_hit,
+                                      response_model=response_model, repaired=repaired)
+
+    def _score_text_tier(self, invoice_info: dict, response_model, invoice_type: str, latency: float) -> bool:
+        """Score the text-only answer, record the tier and return True when it is good enough."""
+        score = self.tier_policy.score(invoice_info, response_model, invoice_type)
+        accepted = score >= self.tier_policy.min_score
+        self._record_tier("text", latency, escalated=not accepted)
+        invoice_info['llm_tier'] = {"tier": "text" if accepted else "multimodal", "text_score": score}
+        msg = f"Text-only extraction of {invoice_type} scored {score}, {'accepted' if accepted else 'escalating to the image'}"
+        print(msg)
+        if self.logger:
+            self.logger.debug(msg)
+        return accepted
+
+    def _text_tier_failed(self, error: Exception, invoice_type: str, latency: float) -> dict:
+        """Record a text-only completion that failed as an escalation with score 0."""
+        self._record_tier("text", latency, escalated=True)
+        msg = f"Text-only extraction of {invoice_type} failed ({error}), escalating to the image"
+        print(msg)
+        if self.logger:
+            self.logger.warning(msg)
+        return {"tier": "multimodal", "text_score": 0.0, "text_error": str(error)}
+
+    def extract_invoice(self, ocr_text, image: Union[str, np.ndarray], invoice_template:str,
+                        response_model: Type[BaseModel] = None, invoice_type: str = None) -> dict:
+        text_tier = None
+        if self.tier_policy.applies(invoice_type):
+            start_time = time.perf_counter()
+            # Validated by the score, a text answer with the wrong shape escalates instead of being retried
+            try:
+                invoice_info = self._extract_invoice_tier(ocr_text, None, invoice_template)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                # Unparsable answer or failed call, the image may still get a good one
+                text_tier = self._text_tier_failed(e, invoice_type, time.perf_counter() - start_time)
+            else:
+                if self._score_text_tier(invoice_info, response_model, invoice_type, time.perf_counter() - start_time):
+                    return invoice_info
+                text_tier = invoice_info['llm_tier']
+
+        start_time = time.perf_counter()
+        invoice_info = self._extract_invoice_tier(ocr_text, image, invoice_template, response_model=response_model)
+        self._record_tier("multimodal", time.perf_counter() - start_time)
+        invoice_info['llm_tier'] = text_tier or {"tier": "multimodal"}
         return invoice_info
-    
+
+    def build_batch_request(self, custom_id: str, ocr_text, image, invoice_template:str) -> dict:
+        """One line of a Batch API input file, the same chat completion as the real-time call."""
+        image_payload = self.encode_image_payload(image)
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": self.model,
+                "messages": self._build_messages(ocr_text, image_payload, invoice_template),
+                "temperature": self.temperature,
+                "max_tokens": self.max_tokens,
+            },
+        }
+
+    @resilient
+    def submit_batch(self, batch_requests: List[dict]) -> str:
+        """Upload the requests as a JSONL file and start a batch job, return the batch id."""
+        jsonl = "\n".join(json.dumps(request, ensure_ascii=False) for request in batch_requests).encode("utf-8")
+        input_file = self.client.files.create(file=("invoices.jsonl", jsonl, "application/jsonl"), purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id,
+                                           endpoint="/v1/chat/completions",
+                                           completion_window=self.batch_config.get('completion_window', '24h'))
+        print(f"Submitted batch {batch.id} with {len(batch_requests)} invoices")
+        if self.logger:
+            self.logger.info(f"Submitted batch {batch.id} with {len(batch_requests)} invoices")
+        return batch.id
+
+    @resilient
+    def get_batch_results(self, batch_id: str) -> Optional[dict]:
+        """
+        Poll a batch job.
+
+        Returns:
+            Optional[dict]: None while the job is running, else the invoice info of every
+            custom_id, or the exception explaining why that request has no usable result.
+        """
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status in ("validating", "in_progress", "finalizing", "cancelling"):
+            return None
+
+        results = {}
+        if batch.output_file_id:
+            for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                output = json.loads(line)
+                try:
+                    response = output.get("response") or {}
+                    if response.get("status_code") != 200:
+                        raise ValueError(f"Request failed with status {response.get('status_code')}: {output.get('error')}")
+                    self._record_usage(response["body"].get("usage"))
+                    completion = response["body"]["choices"][0]["message"]["content"]
+                    results[output["custom_id"]] = self.extract_json(completion)
+                except Exception as e:
+                    results[output["custom_id"]] = e
+        if batch.error_file_id:
+            for line in self.client.files.content(batch.error_file_id).text.splitlines():
+                if line.strip():
+                    output = json.loads(line)
+                    results.setdefault(output["custom_id"], ValueError(f"Batch request failed: {output.get('error')}"))
+        if batch.status != "completed" and not results:
+            # failed, expired or cancelled without any output
+            raise BatchJobError(f"Batch {batch_id} ended with status {batch.status}")
+        return results
+
     def __getitem__(self, item):
         if item == "llm_extractor":
             return self.model
@@ -148,6 +621,146 @@ class OpenAIExtractor(BaseExtractor):
             raise KeyError(f"No such key: {item}")
 
 
+class AsyncOpenAIExtractor(OpenAIExtractor):
+    """
+    OpenAIExtractor on the AsyncOpenAI client. The LLM call is pure network wait, so up to
+    max_concurrency extractions are kept in flight over a shared pool of max_connections
+    HTTP connections. The HTTP client is bound to the event loop it is first used in, so
+    callers keep one loop for the lifetime of the extractor (see process_documents_async).
+    The synchronous extract_invoice is still available.
+    """
+    def __init__(self, config_path: str = "config/config.yaml", logger=None):
+        super().__init__(config_path, logger=logger)
+
+        self.max_concurrency = self.config.get('max_concurrency', 4)
+        self.max_connections = self.config.get('max_connections', 8)
+        self.timeout = self.config.get('timeout', 120)
+
+        import httpx
+        from openai import AsyncOpenAI
+        self.async_client = AsyncOpenAI(api_key=self.OPENAI_API_KEY, base_url=self.base_url,
+                                        timeout=self.timeout, max_retries=0,
+                                        http_client=httpx.AsyncClient(limits=httpx.Limits(
+                                            max_connections=self.max_connections,
+                                            max_keepalive_connections=self.max_connections)))
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Created on first use so it belongs to the running event loop
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def _astream_completion(self, messages: list, parser: IncrementalJsonParser):
+        stream = await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            tail_chunks = 0
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    self._record_usage(chunk.usage, tier=self._messages_tier(messages))
+                    break
+                if parser.complete:
+                    tail_chunks += 1
+                    if tail_chunks > self.MAX_TAIL_CHUNKS:
+                        break
+                elif chunk.choices and chunk.choices[0].delta.content:
+                    parser.feed(chunk.choices[0].delta.content)
+        finally:
+            await stream.close()
+
+    async def _astream_invoice_llm(self, ocr_text, image_payload:dict, invoice_template:str) -> Tuple[str, bool]:
+        messages = self._build_messages(ocr_text, image_payload, invoice_template)
+        parser = IncrementalJsonParser()
+        for attempt in range(self.max_continuations + 1):
+            try:
+                await self._astream_completion(messages if attempt == 0 else self._continuation_messages(messages, parser.text),
+                                               parser)
+            except Exception as e:
+                if not parser.text:
+                    raise  # Nothing received, retry the whole call
+                print(f"Completion stream interrupted: {e}")
+            if parser.complete:
+                break
+        return self._finish_stream(parser)
+
+    async def _aextract_invoice_llm(self, ocr_text, image_payload:dict, invoice_template:str):
+        async with self.semaphore:
+            if self.stream:
+                return await self._astream_invoice_llm(ocr_text, image_payload, invoice_template)
+
+            response = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=self._build_messages(ocr_text, image_payload, invoice_template),
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+            )
+        self._record_usage(response.usage, tier="text" if image_payload is None else "multimodal")
+        return response.choices[0].message.content, False
+
+    @async_resilient
+    async def _aextract_invoice_tier(self, ocr_text, image, invoice_template:str,
+                                     response_model: Type[BaseModel] = None) -> dict:
+        image_payload = self.encode_image_payload(image) if image is not None else None
+        cache_key = self._cache_key(ocr_text, image_payload, invoice_template)
+        # Disk and mongo stores block, keep them off the event loop
+        completion = await asyncio.to_thread(self._get_cached_completion, cache_key)
+        cache_hit, repaired = completion is not None, False
+        if not cache_hit:
+            completion, repaired = await self._aextract_invoice_llm(ocr_text, image_payload,
+                                                                    invoice_template=invoice_template)
+        return await asyncio.to_thread(self._parse_completion, completion, cache_key=cache_key, cache_hit=cache_hit,
+                                       response_model=response_model, repaired=repaired)
+
+    async def aextract_invoice(self, ocr_text, image: Union[str, np.ndarray, ImageBuffer], invoice_template:str,
+                               response_model: Type[BaseModel] = None, invoice_type: str = None) -> dict:
+        text_tier = None
+        if self.tier_policy.applies(invoice_type):
+            start_time = time.perf_counter()
+            try:
+                invoice_info = await self._aextract_invoice_tier(ocr_text, None, invoice_template)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                text_tier = self._text_tier_failed(e, invoice_type, time.perf_counter() - start_time)
+            else:
+                if self._score_text_tier(invoice_info, response_model, invoice_type, time.perf_counter() - start_time):
+                    return invoice_info
+                text_tier = invoice_info['llm_tier']
+
+        start_time = time.perf_counter()
+        invoice_info = await self._aextract_invoice_tier(ocr_text, image, invoice_template, response_model=response_model)
+        self._record_tier("multimodal", time.perf_counter() - start_time)
+        invoice_info['llm_tier'] = text_tier or {"tier": "multimodal"}
+        return invoice_info
+
+    async def extract_many(self, requests: List[dict]) -> list:
+        """
+        Extract several invoices concurrently, at most max_concurrency at a time.
+
+        Args:
+            requests (List[dict]): aextract_invoice keyword arguments (ocr_text, image, invoice_template).
+
+        Returns:
+            list: The invoice info of each request in input order, or the exception it raised.
+        """
+        return await asyncio.gather(*[self.aextract_invoice(**request) for request in requests],
+                                    return_exceptions=True)
+
+    async def aclose(self):
+        await self.async_client.close()
+
+
 def test_post_processing():
     ocr_text = "Géant Casino Annecy Welcome to our Caisse014 Date28/06/28 store, your store welcomes you Monday to Saturday from 8:30 a.m. to 9:30 pm Tel.04.50.88.20.00 Glasses 22.00e Hats 10.00e = Total (2) 32.00E CB EMV 32.00E you had the loyalty card, you would have accumulated 11SMILES Cashier000148/Time 17:46:26 Ticket number: 000130 Speed, comfort of purchase bude and controlled.. Scan'Express is waiting for you!!! Thank you for your visit See you soon"
     model_text = """- Store name: Géant Casino
@@ -192,7 +805,118 @@ def test_openai_invoice():
                                              invoice_template=invoice_template)
     print(invoice_data)
 
+    # The same inputs are served from the cache
+    invoice_data = extractor.extract_invoice(ocr_text=ocr_text, image=image_path, 
+                                             invoice_template=invoice_template)
+    print("LLM cache:", invoice_data['llm_cache'], extractor.get_cache_stats())
+
+def test_async_openai_invoice():
+    from src.validate_invoice import Invoice3
+    config_path = "config/config.yaml"
+    ocr_text = "Géant Casino Annecy Welcome to our Caisse014 Date28/06/28 Glasses 22.00e Hats 10.00e = Total (2) 32.00E CB EMV 32.00E Cashier000148/Time 17:46:26 Ticket number: 000130"
+    config = read_config(path = config_path)
+    with open(config['invoice_dict']['invoice 3'], 'r') as file:
+        invoice_template = file.read()
+
+    async def run():
+        extractor = AsyncOpenAIExtractor(config_path=config_path)
+        try:
+            request = {"ocr_text": ocr_text, "image": "fr_1.png", "invoice_template": invoice_template,
+                       "response_model": Invoice3}
+            return await extractor.extract_many([request, request])
+        finally:
+            await extractor.aclose()
+
+    for invoice_data in asyncio.run(run()):
+        print(invoice_data)
+
+def test_openai_batch():
+    """Submit, poll and read a batch job on a local stand-in for the OpenAI files and batches endpoints."""
+    import tempfile
+    import threading
+    import yaml
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    files = {}
+    batches = {}
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        def _send(self, body: dict, content_type: str = "application/json"):
+            data = body.encode("utf-8") if isinstance(body, str) else json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            if self.path.endswith("/files"):
+                # Multipart upload, keep the JSONL lines
+                lines = [line for line in body.decode("utf-8").splitlines() if line.startswith('{"custom_id"')]
+                file_id = f"file-{len(files)}"
+                files[file_id] = lines
+                self._send({"id": file_id, "object": "file", "bytes": len(body), "created_at": 0,
+                            "filename": "invoices.jsonl", "purpose": "batch", "status": "processed"})
+            elif self.path.endswith("/batches"):
+                request = json.loads(body)
+                batch_id = f"batch-{len(batches)}"
+                batches[batch_id] = {"input_file_id": request["input_file_id"], "polls": 0}
+                self._send(self._batch(batch_id))
+
+        def do_GET(self):
+            if "/batches/" in self.path:
+                batch_id = self.path.rsplit("/", 1)[-1]
+                batches[batch_id]["polls"] += 1
+                self._send(self._batch(batch_id))
+            elif self.path.endswith("/content"):
+                output_lines = []
+                for line in files[self.path.split("/")[-2].replace("output-", "")]:
+                    request = json.loads(line)
+                    content = json.dumps({"invoice_info": {"name": request["custom_id"]}})
+                    output_lines.append(json.dumps({"custom_id": request["custom_id"], "error": None, "response": {
+                        "status_code": 200, "body": {"choices": [{"message": {"content": content}}]}}}))
+                self._send("\n".join(output_lines), content_type="application/jsonl")
+
+        def _batch(self, batch_id: str) -> dict:
+            batch = batches[batch_id]
+            # Still running on the first poll
+            completed = batch["polls"] > 1
+            return {"id": batch_id, "object": "batch", "endpoint": "/v1/chat/completions", "created_at": 0,
+                    "completion_window": "24h", "input_file_id": batch["input_file_id"],
+                    "status": "completed" if completed else "in_progress",
+                    "output_file_id": f"output-{batch['input_file_id']}" if completed else None}
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    config = read_config(path="config/config.yaml")
+    config['llm_extract']['openai']['base_url'] = f"http://127.0.0.1:{server.server_port}/v1"
+    config['llm_extract']['cache']['enabled'] = False
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        yaml.safe_dump(config, f)
+
+    try:
+        extractor = OpenAIExtractor(config_path=f.name)
+        batch_requests = [extractor.build_batch_request(custom_id, ocr_text="Stundennachweis", image="fr_1.png",
+                                                        invoice_template="{}")
+                          for custom_id in ["doc-1", "doc-2"]]
+        batch_id = extractor.submit_batch(batch_requests)
+        assert extractor.get_batch_results(batch_id) is None  # in_progress
+        results = extractor.get_batch_results(batch_id)
+        print("Batch results:", results)
+        assert results == {"doc-1": {"invoice_info": {"name": "doc-1"}}, "doc-2": {"invoice_info": {"name": "doc-2"}}}
+    finally:
+        server.shutdown()
+        os.remove(f.name)
+
+
 if __name__ == "__main__":
 
+    test_openai_batch()
     test_openai_invoice()
+    test_async_openai_invoice()
     test_post_processing()
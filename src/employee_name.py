@@ -2,9 +2,16 @@ import sys
 sys.path.append("")
 
 import os
+import json
+import time
 import openpyxl
-from typing import List, Tuple, Dict
-from src.Utils.utils import read_config, find_best_match_fuzzy
+from typing import Callable, List, Tuple, Dict
+from src.Utils.utils import read_config
+from src.Utils.cache import hash_bytes
+from src.Utils.fuzzy_matcher import FuzzyMatcher
+
+# Bump when the roster format or the way names are read changes
+ROSTER_VERSION = 1
 
 
 class EmployeeNameRetriever:
@@ -15,17 +22,32 @@ class EmployeeNameRetriever:
 
         if config_path:
             self.config_path = config_path
-            self.config = read_config(path=self.config_path)['excel']
+            self.config = read_config(path=self.config_path)['excel']['employee_name']
         elif config:
             self.config = config['excel']['employee_name']
 
-        # Load the Excel file and sheet
-        self.workbook = openpyxl.load_workbook(self.config['excel_file_path'], keep_vba=True)
-        self.sheet = self.workbook[self.config['sheet_name']]
+        # The Excel file is opened on first use, the names come from the roster
+        self._workbook = None
         self.nachname_position = None
         self.vorname_position = None
+        self._snapshot = None
         self.canonical_names = self._preprocess_names()
 
+    @property
+    def workbook(self):
+        if self._workbook is None:
+            self._workbook = openpyxl.load_workbook(self.config['excel_file_path'], keep_vba=True)
+        return self._workbook
+
+    @property
+    def sheet(self):
+        return self.workbook[self.config['sheet_name']]
+
+    def close(self):
+        if self._workbook is not None:
+            self._workbook.close()
+            self._workbook = None
+
     def _find_nachname_vorname_positions(self):
         """Find the row and column positions of 'nachname' and 'vorname'."""
         nachname_key = self.config['nachname_key'].lower()
@@ -114,14 +136,7 @@ class EmployeeNameRetriever:
         Preprocess the names by creating both first-last and last-first formats.
         :return: List of unique preprocessed names as strings with their original indices.
         """
-        corpus = []
-        names = self.get_user_names()
-        for idx, (last_name, first_name) in enumerate(names):
-            last_first = f"{last_name.lower()} {first_name.lower()}"
-            first_last = f"{first_name.lower()} {last_name.lower()}"
-            corpus.append((last_first, idx))
-            corpus.append((first_last, idx))
-        return corpus
+        return list(self.snapshot().canonical_names)
 
     def find_best_matching_name(self, name: str, name_thresh=None) -> Tuple[Tuple[str, str], float]:
         """
@@ -129,26 +144,98 @@ class EmployeeNameRetriever:
         :param name: Input name string (possibly incorrect)
         :return: Tuple containing the best matching name (nachname, vorname) and the similarity score
         """
-        name_list = [name for name, _ in self.canonical_names]
-        best_idx, best_match, best_score = find_best_match_fuzzy(string_list=name_list, 
-                                                           text=name)
-        
-        # Find the index of the best match in canonical_names
-        best_idx = next(idx for idx, (n, _) in enumerate(self.canonical_names) if n == best_match)
-        
-        # Get the original index of the name in the user_names list
-        original_idx = self.canonical_names[best_idx][1]
-        
-        # Get the original name tuple
+        return self.snapshot().find_best_matching_name(name, name_thresh=name_thresh)
+
+    def snapshot(self) -> "EmployeeNames":
+        """The names of the sheet, without the workbook. Read from the roster, the sheet only when it changed."""
+        if self._snapshot is None:
+            self._snapshot = load_roster(self.config, read_names=self.get_user_names)
+        return self._snapshot
+
+
+class EmployeeNames:
+    """Immutable employee names of the workbook, in both name orders for fuzzy matching."""
+    def __init__(self, names: List[Tuple[str, str]], name_thresh: float):
+        self.names = tuple(tuple(name) for name in names)
+        self.name_thresh = name_thresh
+        corpus = []
+        for idx, (last_name, first_name) in enumerate(self.names):
+            corpus.append((f"{last_name.lower()} {first_name.lower()}", idx))
+            corpus.append((f"{first_name.lower()} {last_name.lower()}", idx))
+        self.canonical_names = tuple(corpus)
+        self._name_list = [name for name, _ in self.canonical_names]
+        self.matcher = FuzzyMatcher(self._name_list)
+
+    @classmethod
+    def from_workbook(cls, config: dict) -> "EmployeeNames":
+        """The names of the workbook of config['excel']['employee_name'], from its roster when up to date."""
+        retriever = EmployeeNameRetriever(config=config)
+        names = retriever.snapshot()
+        retriever.close()
+        return names
+
+    def find_best_matching_name(self, name: str, name_thresh=None):
+        """
+        Find the closest match to the given name using fuzzy matching.
+        :return: The best matching name (nachname, vorname), or "" below the threshold
+        """
+        best_idx, best_match, best_score = self.matcher.match(name)
+
         if not name_thresh:
-            name_thresh = self.config['name_thresh']
-        
-        if best_score >= name_thresh:
-            return self.get_user_names()[original_idx]
+            name_thresh = self.name_thresh
+
+        if best_idx is not None and best_score >= name_thresh:
+            # Get the original index of the name in the names list
+            return self.names[self.canonical_names[best_idx][1]]
         else:
-            return ""  # Normalize score to be between 0 and 1
+            return ""
+
+
+
+def roster_key(config: dict) -> str:
+    """Hash of the workbook and of the settings its names are read with."""
+    with open(config['excel_file_path'], 'rb') as f:
+        return hash_bytes(f.read(), config['sheet_name'], config['nachname_key'], config['vorname_key'],
+                          str(ROSTER_VERSION))
+
+
+def load_roster(config: dict, read_names: Callable[[], List[Tuple[str, str]]]) -> EmployeeNames:
+    """
+    Load the employee names from the roster file, a JSON sidecar of the workbook keyed by its hash.
+    The names are read from the workbook with read_names and the roster rewritten when the key differs.
+    :param config: The employee_name section of the excel configuration, roster_path None disables the roster.
+    """
+    key = roster_key(config)
+    roster_path = config.get('roster_path')
+    if roster_path and os.path.exists(roster_path):
+        try:
+            with open(roster_path, 'r', encoding='utf-8') as f:
+                roster = json.load(f)
+            if roster.get('key') == key:
+                return EmployeeNames(roster['names'], name_thresh=config['name_thresh'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring unreadable employee roster {roster_path}: {e}")
+
+    start_time = time.perf_counter()
+    names = EmployeeNames(read_names(), name_thresh=config['name_thresh'])
+    print(f"Compiled employee roster of {config['excel_file_path']} in {time.perf_counter() - start_time:.2f}s")
+    if roster_path:
+        temp_path = f"{roster_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(roster_path) or ".", exist_ok=True)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"key": key, "workbook": config['excel_file_path'], "names": names.names}, f, ensure_ascii=False)
+            os.replace(temp_path, roster_path)
+        except OSError as e:
+            # The names are compiled, only the next start misses the roster
+            print(f"Could not write the employee roster {roster_path}: {e}")
+            if os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+    return names
 
- 
 
 def get_full_name(name_tuple):
     """
@@ -179,4 +266,26 @@ if __name__ == "__main__":
     for ocr_name in ocr_output:
         print(processor.find_best_matching_name(name = ocr_name, ))
 
+    # The roster is compiled once, then loaded without opening the workbook
+    import tempfile
+    with tempfile.TemporaryDirectory() as temp_dir:
+        employee_config = {**config['excel']['employee_name'], 'roster_path': os.path.join(temp_dir, "roster.json")}
+        compiled = load_roster(employee_config, read_names=processor.get_user_names)
+        start_time = time.perf_counter()
+        loaded = load_roster(employee_config, read_names=lambda: [])
+        print(f"Roster loaded in {(time.perf_counter() - start_time) * 1000:.2f} ms")
+        assert loaded.names == compiled.names == tuple(map(tuple, names))
+
+        # A roster of another workbook is compiled again
+        with open(employee_config['roster_path'], 'w', encoding='utf-8') as f:
+            json.dump({"key": "other", "names": []}, f)
+        assert load_roster(employee_config, read_names=processor.get_user_names).names == compiled.names
+
+
 
+        # A roster that can't be written still gives the names, without leaving a temp file behind
+        unwritable_path = os.path.join(temp_dir, "unwritable")
+        os.makedirs(os.path.join(unwritable_path, "in_the_way"))
+        unwritable_config = {**employee_config, 'roster_path': unwritable_path}
+        assert load_roster(unwritable_config, read_names=processor.get_user_names).names == compiled.names
+        assert sorted(os.listdir(temp_dir)) == ["roster.json", "unwritable"]
@@ -1,28 +1,31 @@
 import sys
 sys.path.append("") 
-import re
-import numpy as np
+import base64
 import asyncio
 
 from copy import deepcopy
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from typing import List, Optional
+from typing import List, Optional, Union, Tuple
 
 from src.ocr_reader import OcrReader, GoogleTranslator
-from src.base_extractors import OpenAIExtractor, BaseExtractor
+from src.ocr_pool import OcrProcessPool
+from src.base_extractors import OpenAIExtractor, AsyncOpenAIExtractor, BaseExtractor
 # from src.qwen2_extract import Qwen2Extractor
 from src.Utils.utils import (timeit, read_config, convert_img_path_to_base64, 
-                             get_current_time, convert_base64_to_pil_image, read_txt_file)
+                             get_current_time, convert_base64_to_pil_image,
+                             is_pdf, iter_pdf_pages)
+from src.Utils.image_buffer import ImageBuffer
+from src.Utils.resilience import CircuitOpenError
+from src.prompt_builder import get_prompt_builder
+from src.template_classifier import get_template_classifier
 from src.validate_invoice import (validate_invoice_3, validate_invoice_1,validate_invoice_2,
                                     Invoice3, Invoice2, Invoice1)
 
-def preprocess_text(text: str) -> str:
-    # Remove special characters and digits
-    text = re.sub(r'[^a-zA-Z\s]', '', text)
-    # Convert to lowercase and remove extra whitespace
-    return ' '.join(text.lower().split())
-
+# Pydantic model of the LLM output of each invoice type
+INVOICE_MODELS = {
+    "invoice 1": Invoice1,
+    "invoice 2": Invoice2,
+    "invoice 3": Invoice3,
+}
 
 def compare_with_templates(input_text: str, 
                         invoice_txt_template: dict, 
@@ -38,30 +41,8 @@ def compare_with_templates(input_text: str,
     Returns:
         Optional[str]: The key of the most similar template if it meets the threshold, otherwise None.
     """
-    
-    # Extract template paths from the dictionary
-    template_paths = list(invoice_txt_template.values())
-    template_keys = list(invoice_txt_template.keys())
-    
-    # Read and preprocess templates
-    templates = [read_txt_file(path) for path in template_paths]
-    preprocessed_templates = [preprocess_text(template) for template in templates]
-    preprocessed_input = preprocess_text(input_text)
-
-    # TF-IDF with cosine similarity
-    tfidf_vectorizer = TfidfVectorizer()
-    tfidf_matrix = tfidf_vectorizer.fit_transform(preprocessed_templates + [preprocessed_input])
-    cosine_similarities = cosine_similarity(tfidf_matrix[-1:], tfidf_matrix[:-1])[0]
-
-    # Find the index of the most similar template
-    max_score_index = np.argmax(cosine_similarities)
-    max_cosine_similarity = cosine_similarities[max_score_index]
-
-    # Check if the most similar template meets the threshold
-    if max_cosine_similarity < threshold:
-        return None
-    else:
-        return template_keys[max_score_index]
+    # The classifier is fitted on the templates once, and refitted when they change on disk
+    return get_template_classifier(invoice_txt_template).classify(input_text, threshold=threshold)
 
 
 def get_document_type(ocr_result: dict, config: dict) -> str:
@@ -98,23 +79,104 @@ def get_document_type(ocr_result: dict, config: dict) -> str:
 
 
 def get_document_template(document_type:str, config:dict):
-    invoice_dict=config['invoice_dict']
-    invoice_template = read_txt_file(invoice_dict[document_type])
-    return invoice_template
+    # Templates are read once by the shared prompt builder
+    return get_prompt_builder(config).get_template(document_type)
 
-def extract_invoice_info(base64_img:str, ocr_reader:OcrReader, 
-                         invoice_extractor:BaseExtractor, config:dict, 
-                         logger = None, file_name:str = None) -> dict:
-    result = {}
-    pil_img = convert_base64_to_pil_image(base64_img)
-    ocr_result = ocr_reader.get_text(pil_img)
+def merge_page_results(page_results: List[dict]) -> dict:
+    """
+    Merges the OCR results of the pages of one document. The text of every page is
+    concatenated in page order, the language and angle come from the first page with text.
+    """
+    if not page_results:
+        return {"ori_text": "", "ori_language": "", "text": "", "language": "", "angle": 0, "pages": 0}
+
+    pages_with_text = [page for page in page_results if page.get('ori_text')]
+    merged = dict(pages_with_text[0] if pages_with_text else page_results[0])
+    merged['ori_text'] = "\n".join(page['ori_text'] for page in pages_with_text)
+    merged['text'] = "\n".join(page['text'] for page in pages_with_text)
+    merged['pages'] = len(page_results)
+    return merged
+
+
+def get_pdf_text(ocr_reader, pdf_bytes: bytes, config: dict) -> Tuple[dict, Optional[object]]:
+    """
+    OCR a PDF page by page. Pages are rendered lazily and sent to the OCR reader
+    pages_in_flight at a time, so peak memory stays bounded to a few pages whatever the
+    length of the document. The pages of a batch are OCR'd in parallel with the process
+    pool backend only, the in-process OcrReader runs them one after another.
+
+    Returns:
+        Tuple[dict, ImageBuffer]: The merged OCR result and the rotated first page.
+    """
+    pdf_config = config.get('pdf') or {}
+    pages_in_flight = pdf_config.get('pages_in_flight', 4)
+    dpi = pdf_config.get('dpi', 150)
+
+    page_results = []
+    first_page_image = None
+    batch = []
+
+    def flush():
+        nonlocal first_page_image
+        for page_result, page_image in ocr_reader.get_texts(batch, return_image=True):
+            page_results.append(page_result)
+            if first_page_image is None and page_image is not None:
+                first_page_image = page_image
+        batch.clear()
+
+    for page_bytes in iter_pdf_pages(pdf_bytes, dpi=dpi):
+        batch.append(page_bytes)
+        if len(batch) >= pages_in_flight:
+            flush()
+    if batch:
+        flush()
+
+    return merge_page_results(page_results), first_page_image
+
+
+def prepare_invoice(base64_img:str, ocr_reader:Union[OcrReader, OcrProcessPool], config:dict,
+                    ocr_result: dict = None, rotated_image = None) -> Tuple[dict, object, str, str]:
+    """
+    Everything before the LLM call: OCR, orientation, invoice type and template.
+
+    Returns:
+        Tuple[dict, ImageBuffer, str, str]: The OCR result, the rotated image, the invoice type and its template.
+    """
+    # Decode the upload once, every stage works on the same ImageBuffer
+    image_bytes = base64.b64decode(base64_img)
+    image = None if is_pdf(image_bytes) else ImageBuffer.from_bytes(image_bytes)
+    # The worker may have already OCR'd a batch of documents
+    if ocr_result is None:
+        if image is None:
+            ocr_result, rotated_image = get_pdf_text(ocr_reader, image_bytes, config=config)
+        else:
+            ocr_result, rotated_image = ocr_reader.get_text(image, return_image=True)
 
     invoice_type=get_document_type(ocr_result, config = config)
     invoice_template = get_document_template(invoice_type, config=config)
 
-    rotate_image = ocr_reader.get_rotated_image(pil_img)
-    invoice_info = invoice_extractor.extract_invoice(ocr_text=ocr_result['text'], image=rotate_image, 
-                                                        invoice_template=invoice_template)
+    # Reuse the orientation-corrected image from OCR when available
+    if rotated_image is None:
+        if image is None:
+            # The first page is what the extractor sees of a PDF
+            image = ImageBuffer.from_bytes(next(iter_pdf_pages(image_bytes, dpi=(config.get('pdf') or {}).get('dpi', 150))))
+        rotated_image = ocr_reader.get_rotated_image(image)
+    elif image is not None:
+        # Give the extractor the full resolution upload, its image payload policy sizes it
+        # and sends the upload bytes as is when the page is upright and small enough
+        rotated_image = image.rotated(ocr_result.get('angle', 0))
+    return ocr_result, rotated_image, invoice_type, invoice_template
+
+
+def finalize_invoice_info(invoice_info: dict, ocr_result: dict, invoice_type: str,
+                          ocr_reader:Union[OcrReader, OcrProcessPool], invoice_extractor:BaseExtractor,
+                          config:dict, logger = None, file_name:str = None) -> dict:
+    """Everything after the LLM call: validation and the document stored in MongoDB."""
+    result = {}
+    # Report whether the LLM completion came from the cache
+    result['llm_cache'] = invoice_info.pop('llm_cache', None)
+    # Which tier answered, text only or with the image
+    result['llm_tier'] = invoice_info.pop('llm_tier', None)
     invoice_info['invoice_info']['file_name'] = file_name
     print('\ninvoice_info-1', invoice_info)
     invoice_info = validate_invoice(invoice_info=invoice_info, 
@@ -137,6 +199,56 @@ def extract_invoice_info(base64_img:str, ocr_reader:OcrReader,
 
     return result
 
+
+def extract_invoice_info(base64_img:str, ocr_reader:Union[OcrReader, OcrProcessPool], 
+                         invoice_extractor:BaseExtractor, config:dict, 
+                         logger = None, file_name:str = None, 
+                         ocr_result: dict = None, rotated_image = None) -> dict:
+    ocr_result, rotated_image, invoice_type, invoice_template = prepare_invoice(
+        base64_img=base64_img, ocr_reader=ocr_reader, config=config,
+        ocr_result=ocr_result, rotated_image=rotated_image)
+
+    invoice_info = invoice_extractor.extract_invoice(ocr_text=ocr_result['text'], image=rotated_image, 
+                                                        invoice_template=invoice_template,
+                                                        response_model=INVOICE_MODELS[invoice_type],
+                                                        invoice_type=invoice_type)
+    return finalize_invoice_info(invoice_info, ocr_result=ocr_result, invoice_type=invoice_type,
+                                 ocr_reader=ocr_reader, invoice_extractor=invoice_extractor,
+                                 config=config, logger=logger, file_name=file_name)
+
+
+async def aextract_invoice_info(base64_img:str, ocr_reader:Union[OcrReader, OcrProcessPool], 
+                                invoice_extractor:AsyncOpenAIExtractor, config:dict, 
+                                logger = None, file_name:str = None, 
+                                ocr_result: dict = None, rotated_image = None) -> dict:
+    """
+    extract_invoice_info with the LLM call awaited on the async extractor.
+    OCR (when not done yet) and validation run in a thread so the event loop stays free.
+    """
+    ocr_result, rotated_image, invoice_type, invoice_template = await asyncio.to_thread(
+        prepare_invoice, base64_img=base64_img, ocr_reader=ocr_reader, config=config,
+        ocr_result=ocr_result, rotated_image=rotated_image)
+
+    breaker = invoice_extractor.resilience.breaker if hasattr(invoice_extractor, 'resilience') else None
+    while True:
+        # Every task in flight pauses while the LLM provider is down, the OCR result is kept
+        if breaker is not None:
+            await breaker.await_ready()
+        try:
+            invoice_info = await invoice_extractor.aextract_invoice(ocr_text=ocr_result['text'], image=rotated_image, 
+                                                                    invoice_template=invoice_template,
+                                                                    response_model=INVOICE_MODELS[invoice_type],
+                                                                    invoice_type=invoice_type)
+            break
+        except CircuitOpenError as e:
+            if breaker is None:
+                raise
+            print(f"{e}, waiting to extract {file_name}")
+    return await asyncio.to_thread(finalize_invoice_info, invoice_info, ocr_result=ocr_result,
+                                   invoice_type=invoice_type, ocr_reader=ocr_reader,
+                                   invoice_extractor=invoice_extractor, config=config,
+                                   logger=logger, file_name=file_name)
+
 def validate_invoice(invoice_info: dict, invoice_type: str, config: dict) -> dict:
     # Create a deep copy of the invoice_info to avoid modifying the original
     invoice_info_copy = deepcopy(invoice_info)
@@ -161,7 +273,7 @@ def main():
     config_path = "config/config.yaml"
     config = read_config(config_path)
 
-    ocr_reader = OcrReader(config_path=config_path, translator=GoogleTranslator())
+    ocr_reader = OcrReader(config_path=config_path, translator=GoogleTranslator(config_path=config_path))
     invoice_extractor = OpenAIExtractor(config_path=config_path)
     
     # Image path setup
@@ -0,0 +1,146 @@
+import sys
+sys.path.append("")
+
+import os
+import multiprocessing
+from io import BytesIO
+from typing import List, Union
+from PIL import Image
+from src.Utils.utils import read_config
+from src.Utils.image_buffer import ImageBuffer
+
+# OcrReader owned by the current worker process, created by _init_worker
+_worker_reader = None
+
+
+def _init_worker(config_path: str):
+    """Load a warm OcrReader (CLIP pipeline and Paddle engines) once per child process."""
+    global _worker_reader
+    from src.ocr_reader import OcrReader, GoogleTranslator
+
+    _worker_reader = OcrReader(config_path=config_path, translator=GoogleTranslator(config_path=config_path))
+    print(f"OCR worker {os.getpid()} ready")
+
+
+def _ocr_job(image_bytes: bytes, return_image: bool):
+    return _worker_reader.get_text(image_bytes, return_image=return_image)
+
+
+def _rotate_job(image_bytes: bytes) -> ImageBuffer:
+    return _worker_reader.get_rotated_image(image_bytes)
+
+
+def _to_bytes(input_data: Union[bytes, str, Image.Image, ImageBuffer]) -> bytes:
+    if isinstance(input_data, bytes):
+        return input_data
+    if isinstance(input_data, ImageBuffer):
+        # Forward the original upload, no need to decode it in this process
+        return input_data.source_bytes if input_data.source_bytes is not None else input_data.encode('.png')
+    if isinstance(input_data, str):  # If input_data is a path
+        with open(input_data, "rb") as f:
+            return f.read()
+    if isinstance(input_data, Image.Image):
+        buffer = BytesIO()
+        input_data.save(buffer, format="PNG")
+        return buffer.getvalue()
+    raise ValueError("Unsupported input data type")
+
+
+class OcrProcessPool:
+    """
+    Runs OcrReader in a pool of child processes so several documents are OCR'd in parallel.
+    Each child owns its own OcrReader, jobs are submitted as raw image bytes.
+    Exposes the same get_text/get_texts/get_rotated_image interface as OcrReader.
+
+    The pool is started lazily on first use, so processes are only spawned by the
+    worker that actually OCRs documents and not at import time.
+    """
+    def __init__(self, config_path: str = "config/config.yaml", logger=None):
+        self.config_path = config_path
+        self.config = read_config(path=self.config_path)['ocr']
+        pool_config = self.config.get('process_pool') or {}
+
+        self.processes = pool_config.get('processes') or os.cpu_count()
+        self.max_tasks_per_child = pool_config.get('max_tasks_per_child')
+        self.timeout = pool_config.get('timeout', 600)
+        self.target_language = self.config['target_language']
+        self.logger = logger
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            # Paddle and torch are not fork-safe, start clean interpreters
+            context = multiprocessing.get_context("spawn")
+            self._pool = context.Pool(processes=self.processes,
+                                      initializer=_init_worker,
+                                      initargs=(self.config_path,),
+                                      maxtasksperchild=self.max_tasks_per_child)
+            if self.logger:
+                self.logger.info(f"Started OCR process pool with {self.processes} workers")
+        return self._pool
+
+    def _empty_result(self) -> dict:
+        return {
+                "ori_text": "",
+                "ori_language": "",
+                "text": "",
+                "language": "",
+                "angle": 0,
+            }
+
+    def get_text(self, input_data, return_image: bool = False):
+        return self.get_texts([input_data], return_image=return_image)[0]
+
+    def get_texts(self, inputs: list, return_image: bool = False) -> list:
+        """Submit every document at once and collect the results in input order."""
+        pool = self._get_pool()
+        jobs = []
+        for input_data in inputs:
+            try:
+                jobs.append(pool.apply_async(_ocr_job, (_to_bytes(input_data), return_image)))
+            except Exception as e:
+                print("error", e)
+                jobs.append(None)
+
+        results = []
+        for job in jobs:
+            try:
+                if job is None:
+                    raise ValueError("Document could not be submitted")
+                results.append(job.get(timeout=self.timeout))
+            except Exception as e:
+                print("error", e)
+                if self.logger:
+                    self.logger.debug(f"error: {e}")
+                results.append((self._empty_result(), None) if return_image else self._empty_result())
+        return results
+
+    def get_rotated_image(self, input_data) -> ImageBuffer:
+        return self._get_pool().apply(_rotate_job, (_to_bytes(input_data),))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __getitem__(self, item):
+        if item == "ocr_detector":
+            return 'paddle_ocr'
+        elif item == "translator":
+            # Workers are always created with the GoogleTranslator
+            return 'google'
+        else:
+            raise KeyError(f"No such key: {item}")
+
+
+if __name__ == "__main__":
+    img_path = "fr_1.png"
+
+    ocr_pool = OcrProcessPool(config_path="config/config.yaml")
+    try:
+        results = ocr_pool.get_texts([img_path, img_path])
+        for result in results:
+            print("Recognized Text:", result)
+    finally:
+        ocr_pool.close()
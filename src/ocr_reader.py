@@ -1,55 +1,183 @@
 import sys
 sys.path.append("") 
 
+import re
+import os
 import json
 import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from paddleocr import PaddleOCR
-from transformers import pipeline
+from transformers import pipeline, AutoModel, AutoProcessor
 from PIL import Image
 import torch
 import numpy as np
 import requests
-from src.Utils.utils import timeit, read_config, resize_same_ratio, rotate_image
+from typing import List, Union
+from src.Utils.utils import timeit, read_config, detect_rotation_angle, estimate_text_metrics
+from src.Utils.image_buffer import ImageBuffer
+from src.Utils.cache import create_cache_store, hash_bytes, CacheStats, MemoryCacheStore
+from src.Utils.resilience import Resilience, resilient
+
+
+def split_text(text: str, max_input_length: int) -> List[str]:
+    """
+    Split text into chunks of at most max_input_length characters on sentence boundaries.
+    A sentence longer than the limit is cut at the last space before it.
+    """
+    if len(text) <= max_input_length:
+        return [text]
+
+    chunks = []
+    current = ""
+    for sentence in re.split(r'(?<=[.!?;。！？])\s+', text):
+        while len(sentence) > max_input_length:
+            cut = sentence.rfind(' ', 0, max_input_length)
+            if cut <= 0:
+                cut = max_input_length
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+
+        if current and len(current) + 1 + len(sentence) > max_input_length:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+
+    if current:
+        chunks.append(current)
+    return chunks
 
 
 class GoogleTranslator:
-    def __init__(self):
-        pass
-
-    def translate(self, text, to_lang, max_input_length=4900):
-        url = 'https://translate.googleapis.com/translate_a/single'
-        src_language = None
-
-        def get_translation_chunk(chunk):
-            nonlocal src_language  # Allow modification of src_language within this function
-            params = {
-                'client': 'gtx',
-                'sl': 'auto',
-                'tl': to_lang,
-                'dt': ['t', 'bd'],
-                'dj': '1',
-                'source': 'popup5',
-                'q': chunk
-            }
-            response = requests.get(url, params=params, verify=False).json()
-            sentences = response.get('sentences', [])
-            translated_chunk = ""
-            for sentence in sentences:
-                translated_chunk += sentence.get('trans', "")
-            
-            # Get the source language only once, during the first chunk
-            if src_language is None:
-                src_language = response.get('src', 'unknown')
-            
-            return translated_chunk
-        
-        # Perform the translation in chunks if the text exceeds the max input length
-        translated_text = ""
-        for i in range(0, len(text), max_input_length):
-            chunk = text[i:i + max_input_length]
-            translated_text += get_translation_chunk(chunk) + "\n"
-        
-        return translated_text.strip(), src_language
+    def __init__(self, config_path: str = None):
+        config = read_config(path=config_path).get('translator', {}) if config_path else {}
+
+        self.url = config.get('url', 'https://translate.googleapis.com/translate_a/single')
+        self.mode = config.get('mode', 'sequential')  # sequential | concurrent
+        self.max_input_length = config.get('max_input_length', 4900)
+        self.max_workers = config.get('max_workers', 4)
+        self.timeout = config.get('timeout', None)
+
+        # Keep-alive connections shared by every chunk and every document
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.executor = None
+        if self.mode == 'concurrent':
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        # Memoize translations by (text hash, target language)
+        cache_size = config.get('cache_size', 0)
+        self.cache = MemoryCacheStore(max_size=cache_size) if cache_size else None
+
+        # Backoff, Retry-After and circuit breaker around every chunk request
+        self.resilience = Resilience.from_config("GoogleTranslator", config.get('resilience'))
+
+    def get_retry_metrics(self) -> dict:
+        return self.resilience.get_metrics()
+
+    @resilient
+    def _translate_chunk(self, chunk: str, to_lang: str):
+        params = {
+            'client': 'gtx',
+            'sl': 'auto',
+            'tl': to_lang,
+            'dt': ['t', 'bd'],
+            'dj': '1',
+            'source': 'popup5',
+            'q': chunk
+        }
+        response = self.session.get(self.url, params=params, timeout=self.timeout)
+        # Raise on 429/5xx so the resilience layer sees the status and Retry-After
+        response.raise_for_status()
+        response = response.json()
+        sentences = response.get('sentences', [])
+        translated_chunk = ""
+        for sentence in sentences:
+            translated_chunk += sentence.get('trans', "")
+        return translated_chunk, response.get('src', 'unknown')
+
+    def translate(self, text, to_lang, max_input_length=None):
+        max_input_length = max_input_length or self.max_input_length
+
+        cache_key = hash_bytes(text, to_lang, self.mode, str(max_input_length))
+        if self.cache is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        if self.mode == 'concurrent':
+            # Sentence-aligned chunks translated in parallel, joined back in order
+            chunks = split_text(text, max_input_length)
+            translations = list(self.executor.map(lambda chunk: self._translate_chunk(chunk, to_lang), chunks))
+            translated_text = " ".join(translated for translated, _ in translations)
+        else:
+            # Perform the translation in chunks if the text exceeds the max input length
+            chunks = [text[i:i + max_input_length] for i in range(0, len(text), max_input_length)]
+            translations = [self._translate_chunk(chunk, to_lang) for chunk in chunks]
+            translated_text = "\n".join(translated for translated, _ in translations)
+
+        # Get the source language from the first chunk
+        src_language = translations[0][1] if translations else None
+        result = (translated_text.strip(), src_language)
+
+        if self.cache is not None:
+            self.cache.set(cache_key, result)
+        return result
+
+    def translate_lines(self, lines: list, to_lang: str, max_input_length=None):
+        """
+        Translate lines one to one. The lines are packed into newline separated chunks that
+        never split a line. Returns (None, src_language) when the translator merged or split
+        lines, so the caller can translate the whole text instead.
+        """
+        max_input_length = max_input_length or self.max_input_length
+
+        chunks, chunk = [], []
+        for line in lines:
+            if chunk and len("\n".join(chunk + [line])) > max_input_length:
+                chunks.append(chunk)
+                chunk = []
+            chunk.append(line)
+        if chunk:
+            chunks.append(chunk)
+
+        def translate(chunk):
+            # A packed chunk already fits, it goes to the endpoint as one request. Going through
+            # self.translate would submit to the executor from inside it and could deadlock the pool
+            text = "\n".join(chunk)
+            cache_key = hash_bytes(text, to_lang, "lines")
+            if self.cache is not None:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    return cached
+            result = self._translate_chunk(text, to_lang)
+            if self.cache is not None:
+                self.cache.set(cache_key, result)
+            return result
+
+        if self.mode == 'concurrent' and len(chunks) > 1:
+            translations = list(self.executor.map(translate, chunks))
+        else:
+            translations = [translate(chunk) for chunk in chunks]
+
+        src_language = translations[0][1] if translations else None
+        translated_lines = []
+        for chunk, (translated_text, _) in zip(chunks, translations):
+            chunk_lines = translated_text.split("\n")
+            if len(chunk_lines) != len(chunk):
+                return None, src_language
+            translated_lines.extend(line.strip() for line in chunk_lines)
+        return translated_lines, src_language
     
     def __getitem__(self, item):
         if item == "translator":
@@ -57,6 +185,157 @@ class GoogleTranslator:
         else:
             raise KeyError(f"No such key: {item}")
     
+# PaddleOCR language codes that differ from the ISO codes returned by the translator
+PADDLE_TO_ISO_LANGUAGE = {
+    "german": "de",
+    "japan": "ja",
+    "korean": "ko",
+    "ch": "zh-CN",
+    "chinese_cht": "zh-TW",
+    "rs_latin": "sr",
+    "rs_cyrillic": "sr",
+}
+
+def to_iso_language(language: str) -> str:
+    return PADDLE_TO_ISO_LANGUAGE.get(language, language)
+
+
+class TranslationPolicy:
+    """
+    Decides whether the OCR text of a document has to go through the translator.
+    Returns the path taken: "translated", "skipped_same_language" or "skipped_no_text".
+    With partial, only the OCR lines that have letters are translated, once each. Amounts,
+    dates and codes are kept as recognized.
+    """
+    def __init__(self, target_language: str, skip_same_language: bool = True, min_confidence: float = 0.5,
+                 partial: bool = True):
+        self.target_language = target_language
+        self.skip_same_language = skip_same_language
+        self.min_confidence = min_confidence
+        self.partial = partial
+
+    @staticmethod
+    def lines_to_translate(lines: list) -> list:
+        """The distinct lines with letters, in order."""
+        return list(dict.fromkeys(line for line in lines if re.search(r'[^\W\d_]', line)))
+
+    def decide(self, text: str, detected_language: str, confidence: float) -> str:
+        # Nothing to translate when the text has no letters (only amounts, dates, codes)
+        if not re.search(r'[^\W\d_]', text):
+            return "skipped_no_text"
+
+        # Low scores fall back to 'en' in the detector, only trust a confident detection
+        if (self.skip_same_language 
+            and to_iso_language(detected_language) == to_iso_language(self.target_language)
+            and confidence >= self.min_confidence):
+            return "skipped_same_language"
+
+        return "translated"
+
+
+class ResolutionPolicy:
+    """
+    Chooses the size (longest side) a document is OCR'd at.
+    In fixed mode every document is resized to resize_size. In adaptive mode the character
+    height is estimated on a downscaled probe and the smallest candidate size that keeps
+    characters at least min_char_height pixels tall is used, one size larger for dense pages.
+    The next larger size is tried once when Paddle's mean confidence is below min_confidence.
+    """
+    def __init__(self, mode: str = "fixed", resize_size: int = 1080, candidate_sizes: list = None,
+                 probe_size: int = 800, min_char_height: float = 12, dense_threshold: float = 0.12,
+                 min_confidence: float = 0.7):
+        self.mode = mode
+        self.resize_size = resize_size
+        self.candidate_sizes = sorted(candidate_sizes or [640, 960, 1080, 1440])
+        self.probe_size = probe_size
+        self.min_char_height = min_char_height
+        self.dense_threshold = dense_threshold
+        self.min_confidence = min_confidence
+
+    def choose(self, image: ImageBuffer) -> dict:
+        """Return {"mode", "size", ...text metrics, "probe_time"} for the image."""
+        if self.mode != "adaptive":
+            return {"mode": self.mode, "size": self.resize_size}
+
+        start_time = time.perf_counter()
+        metrics = estimate_text_metrics(image.gray, probe_size=self.probe_size)
+        long_side = max(image.size)
+
+        if not metrics["char_height"]:
+            # Nothing that looks like text, keep the usual size
+            size = self.resize_size
+        else:
+            index = len(self.candidate_sizes) - 1
+            for i, candidate in enumerate(self.candidate_sizes):
+                if metrics["char_height"] * candidate / long_side >= self.min_char_height:
+                    index = i
+                    break
+            # Dense pages have small, tightly packed lines
+            if metrics["density"] >= self.dense_threshold:
+                index = min(index + 1, len(self.candidate_sizes) - 1)
+            size = self.candidate_sizes[index]
+
+        return {"mode": self.mode, "size": size, **metrics,
+                "probe_time": round(time.perf_counter() - start_time, 4)}
+
+    def next_size(self, size: int, confidence: float):
+        """The next larger size to retry at, None when the result is confident enough or no larger size exists."""
+        if self.mode != "adaptive" or confidence >= self.min_confidence:
+            return None
+        return next((candidate for candidate in self.candidate_sizes if candidate > size), None)
+
+
+class PaddleEnginePool:
+    """
+    Keeps warm PaddleOCR engines keyed by language so the detection, angle-classifier
+    and recognition models are loaded from disk only once per language.
+    The least recently used engine is evicted when more than max_languages are resident.
+    """
+    def __init__(self, device, max_languages: int = 4, logger=None):
+        self.device = device
+        self.max_languages = max(1, int(max_languages))
+        self.logger = logger
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve_language(self, language: str) -> str:
+        # Chinese and Japanese models are too heavy on CPU, fall back to the English engine
+        # https://github.com/PaddlePaddle/PaddleOCR/issues/11597
+        if (language in ["zh-CN", "ch", "chinese_cht", "japan"]) and (self.device == 'cpu'):
+            return "en"
+        return language
+
+    def get(self, language: str) -> PaddleOCR:
+        lang = self.resolve_language(language)
+        with self._lock:
+            engine = self._engines.get(lang)
+            if engine is not None:
+                self._engines.move_to_end(lang)
+                return engine
+
+            engine = PaddleOCR(lang=lang, show_log=False, use_angle_cls=True, cls=True)
+            self._engines[lang] = engine
+
+            while len(self._engines) > self.max_languages:
+                evicted_lang, _ = self._engines.popitem(last=False)
+                if self.logger:
+                    self.logger.debug(f"Evicted PaddleOCR engine: {evicted_lang}")
+            return engine
+
+    def preload(self, languages: list):
+        for language in languages[:self.max_languages]:
+            self.get(language)
+        print(f"PaddleOCR engines preloaded: {self.languages}")
+
+    @property
+    def languages(self) -> list:
+        with self._lock:
+            return list(self._engines.keys())
+
+    def __len__(self):
+        return len(self._engines)
+
+
 class OcrReader:
     def __init__(self,  
                  translator=None,
@@ -65,14 +344,29 @@ class OcrReader:
                  ):
         
         self.config_path = config_path
-        self.config = read_config(path = self.config_path)['ocr']
+        full_config = read_config(path = self.config_path)
+        self.config = full_config['ocr']
 
         self.language_dict_path = self.config['language_dict_path']
         self.language_detector = self.config['language_detector']
+        self.language_detector_mode = self.config.get('language_detector_mode', 'pipeline')
         self.language_thresh = self.config['language_thresh']
         self.target_language = self.config['target_language']
         self.resize_size = self.config['resize_size']
 
+        orientation_config = self.config.get('orientation') or {}
+        self.osd_early_exit = orientation_config.get('early_exit', True)
+        self.osd_workers = orientation_config.get('workers', 1)
+
+        resolution_config = self.config.get('resolution') or {}
+        self.resolution_policy = ResolutionPolicy(mode=resolution_config.get('mode', 'fixed'),
+                                                  resize_size=self.resize_size,
+                                                  candidate_sizes=resolution_config.get('candidate_sizes'),
+                                                  probe_size=resolution_config.get('probe_size', 800),
+                                                  min_char_height=resolution_config.get('min_char_height', 12),
+                                                  dense_threshold=resolution_config.get('dense_threshold', 0.12),
+                                                  min_confidence=resolution_config.get('min_confidence', 0.7))
+
         self.logger = logger
 
         # Load language dictionary from JSON file
@@ -90,11 +384,45 @@ class OcrReader:
 
         self.translator = translator
 
+        policy_config = self.config.get('translation_policy') or {}
+        self.translation_policy = TranslationPolicy(target_language=self.target_language,
+                                                    skip_same_language=policy_config.get('skip_same_language', True),
+                                                    min_confidence=policy_config.get('min_confidence', 0.5),
+                                                    partial=policy_config.get('partial', True))
+
+        # PaddleOCR and the CLIP detector are not thread-safe, the callers of one reader
+        # (the extraction workers and the fallback OCR in to_thread) take turns on the models
+        self._model_lock = threading.RLock()
+
+        # Keep warm PaddleOCR engines instead of building one per document
+        engine_pool_config = self.config.get('engine_pool') or {}
+        self.engine_pool = PaddleEnginePool(device=self.device,
+                                            max_languages=engine_pool_config.get('max_languages', 4),
+                                            logger=self.logger)
+        preload_languages = [self.language_dict[name] for name in engine_pool_config.get('preload_languages') or []
+                             if name in self.language_dict]
+        if preload_languages:
+            self.engine_pool.preload(preload_languages)
+
+        # Cache OCR results by image content, re-uploaded scans skip the whole pipeline
+        cache_config = self.config.get('cache') or {}
+        self.cache_store = None
+        self.cache_stats = CacheStats()
+        if cache_config.get('enabled', False):
+            self.cache_store = create_cache_store(cache_config, mongo_config=full_config.get('mongodb'))
+
         # Load zero-shot image classification model
         self.initialize_language_detector()
 
     
     def initialize_language_detector(self):
+        # Candidate labels for language classification, one per language in the dictionary
+        self.candidate_labels = [f"language {key}" for key in self.language_dict]
+
+        if self.language_detector_mode == 'embedding':
+            self._initialize_embedding_detector()
+            return
+
         # Create a dummy image for model initialization
         dummy_image = Image.new("RGB", (224, 224), color=(255, 255, 255))  # White image
         candidate_labels = ["en", "fr"]  # Example labels
@@ -109,107 +437,302 @@ class OcrReader:
         self.image_classifier(dummy_image, candidate_labels=candidate_labels)
         print("Model pipeline initialized with dummy data.")
 
-    def get_image(self, input_data:any) -> Image:
-        if isinstance(input_data, str):  # If input_data is a path
-            image = Image.open(input_data)
-        elif isinstance(input_data, Image.Image):  # If input_data is a PIL image
+    def _initialize_embedding_detector(self):
+        """
+        Encode the label prompts once and keep the normalized text embeddings,
+        so each image only needs an image embedding and a matrix product.
+        """
+        self.detector_processor = AutoProcessor.from_pretrained(self.language_detector)
+        self.detector_model = AutoModel.from_pretrained(self.language_detector).to(self.device)
+        self.detector_model.eval()
+
+        # Same prompt as the zero-shot pipeline so the scores stay comparable
+        prompts = [f"This is a photo of {label}." for label in self.candidate_labels]
+        with torch.no_grad():
+            text_inputs = self.detector_processor(text=prompts, return_tensors="pt", padding=True).to(self.device)
+            text_embeds = self.detector_model.get_text_features(**text_inputs)
+
+        self.label_embeddings = text_embeds / text_embeds.norm(dim=-1, keepdim=True)
+        self.logit_scale = self.detector_model.logit_scale.exp()
+
+        # Perform a dummy inference to warm up the model
+        self.detect_languages([Image.new("RGB", (224, 224), color=(255, 255, 255))])
+        print(f"Label embeddings cached for {len(self.candidate_labels)} languages.")
+
+    def _load_image(self, input_data:any) -> ImageBuffer:
+        if isinstance(input_data, ImageBuffer):  # If input_data is already decoded
             image = input_data
+        elif isinstance(input_data, str):  # If input_data is a path
+            image = ImageBuffer.from_path(input_data)
+        elif isinstance(input_data, bytes):  # If input_data is the raw image file
+            image = ImageBuffer.from_bytes(input_data)
+        elif isinstance(input_data, Image.Image):  # If input_data is a PIL image
+            image = ImageBuffer.from_pil(input_data)
         else:
             raise ValueError("Unsupported input data type")
-        
-        image = resize_same_ratio(image, target_size=self.resize_size)
         return image
-    
-    def _get_lang(self, image: Image.Image) -> str:
-        # Define candidate labels for language classification
-        candidate_labels = [f"language {key}" for key in self.language_dict]
-
-        # Perform inference to classify the language
-        outputs = self.image_classifier(image, candidate_labels=candidate_labels)
-        outputs = [{"score": round(output["score"], 4), "label": output["label"] } for output in outputs]
-        
-        # Extract the language with the highest score
-        language_names = [entry['label'].replace('language ', '') for entry in outputs]
-        scores = [entry['score'] for entry in outputs]
-        abbreviations = [self.language_dict.get(language) for language in language_names]
-        
-        first_abbreviation = abbreviations[0]
-        lang = 'en'  # Default to English
-        
-        if scores[0] > self.language_thresh:
-            lang = first_abbreviation
-
-        return lang
 
-    def get_text(self, input_data) -> dict:
-        # Detect the language of the image
-        try:
-            image = self.get_image(input_data)
-            image, doc_angle = rotate_image(image)
-            
-            src_language = self._get_lang(image)
-
-            if self.logger:
-                self.logger.debug(f"src_language: {src_language}")
-
-            # Initialize the PaddleOCR with the detected language
-            ocr = None
-
-            if (src_language in ["zh-CN","ch", "chinese_cht", "japan"]) and (self.device == 'cpu'):
-                print("src_language", src_language)
-                print("self.device", self.device)
-                ocr = PaddleOCR(lang="en", show_log=False, use_angle_cls=True, 
-                                cls=True,) # ocr_version='PP-OCR2', enable_mkldnn=True) #https://github.com/PaddlePaddle/PaddleOCR/issues/11597
-            else:
-                ocr = PaddleOCR(lang=src_language, show_log=False, use_angle_cls=True, cls=True, )
-            
+    def _prepare_image(self, input_data:any):
+        """Return the image resized for OCR, the full resolution source and the chosen resolution."""
+        source = self._load_image(input_data)
+        resolution = self.resolution_policy.choose(source)
+        return source.resized(resolution["size"]), source, resolution
 
-            result = ocr.ocr(np.array(image))
+    def get_image(self, input_data:any) -> ImageBuffer:
+        image, _, _ = self._prepare_image(input_data)
+        return image
 
-            # Combine the recognized text from the OCR result
-            text = " ".join([line[1][0] for line in result[0]])
+    def _label_to_language(self, label: str, score: float) -> dict:
+        language_name = label.replace('language ', '')
+        lang = 'en'  # Default to English
 
-            # Handle translation if a translator and target language are provided
-            if self.translator and self.target_language:
-                trans_text, src_language = self.translator.translate(text=text, to_lang=self.target_language)
+        if score > self.language_thresh:
+            lang = self.language_dict.get(language_name)
+
+        return {"language": lang, "score": score}
+
+    def detect_languages(self, images: List[Union[Image.Image, ImageBuffer]]) -> List[dict]:
+        """
+        Classify the language of a batch of images in one forward pass.
+
+        Args:
+            images (List[PIL.Image.Image or ImageBuffer]): Images to classify.
+
+        Returns:
+            List[dict]: One {"language", "score"} dict per image, in input order.
+        """
+        if not images:
+            return []
+        images = [image.pil if isinstance(image, ImageBuffer) else image for image in images]
+        with self._model_lock:
+            return self._detect_languages(images)
+
+    def _detect_languages(self, images: List[Image.Image]) -> List[dict]:
+        if self.language_detector_mode == 'embedding':
+            with torch.no_grad():
+                image_inputs = self.detector_processor(images=[image.convert("RGB") for image in images],
+                                                       return_tensors="pt").to(self.device)
+                image_embeds = self.detector_model.get_image_features(**image_inputs)
+                image_embeds = image_embeds / image_embeds.norm(dim=-1, keepdim=True)
+                probs = (self.logit_scale * image_embeds @ self.label_embeddings.T).softmax(dim=-1)
+                scores, indices = probs.max(dim=-1)
+
+            return [self._label_to_language(self.candidate_labels[idx], round(score, 4))
+                    for score, idx in zip(scores.tolist(), indices.tolist())]
+
+        outputs = self.image_classifier(images, candidate_labels=self.candidate_labels)
+        # Outputs are sorted by score, the first entry is the most likely language
+        return [self._label_to_language(output[0]["label"], round(output[0]["score"], 4))
+                for output in outputs]
+    
+    def _get_lang(self, image: Union[Image.Image, ImageBuffer]) -> str:
+        return self.detect_languages([image])[0]["language"]
+
+    def _empty_result(self) -> dict:
+        return {
+                "ori_text": "",
+                "ori_language": "",
+                "text": "",
+                "language": "",
+                "angle": 0,
+            }
 
-                data = {
-                    "ori_text": text,
-                    "ori_language": src_language,
-                    "text": trans_text,
-                    "language": self.target_language,
-                }
+    def _log_error(self, e: Exception):
+        print("error", e)
+        if self.logger:
+            self.logger.debug(f"error: {e}")
+
+    def _recognize(self, ocr: PaddleOCR, image: ImageBuffer):
+        """Run Paddle on the image, return the combined text, the mean line confidence and the lines."""
+        with self._model_lock:
+            result = ocr.ocr(image.array)
+        lines = result[0] or []
+
+        # Combine the recognized text from the OCR result
+        text_lines = [line[1][0] for line in lines]
+        text = " ".join(text_lines)
+        confidence = float(np.mean([line[1][1] for line in lines])) if lines else 0.0
+        return text, confidence, text_lines
+
+    def _read_text(self, image: ImageBuffer, doc_angle: int, detection: dict,
+                   source: ImageBuffer = None, resolution: dict = None) -> dict:
+        src_language = detection["language"]
+        if self.logger:
+            self.logger.debug(f"src_language: {src_language}")
+
+        # Get a warm PaddleOCR engine for the detected language
+        ocr = self.engine_pool.get(src_language)
+
+        resolution = dict(resolution or {"mode": "fixed", "size": self.resize_size})
+        start_time = time.perf_counter()
+        text, confidence, lines = self._recognize(ocr, image)
+        resolution["attempts"] = [resolution["size"]]
+
+        # Only pay for a larger image when Paddle is unsure about the text it found, one step at most
+        next_size = None
+        if source is not None and text:
+            next_size = self.resolution_policy.next_size(resolution["size"], confidence)
+        if next_size:
+            retry_text, retry_confidence, retry_lines = self._recognize(ocr, source.resized(next_size).rotated(doc_angle))
+            resolution["attempts"].append(next_size)
+            if retry_confidence > confidence:
+                text, confidence, lines, resolution["size"] = retry_text, retry_confidence, retry_lines, next_size
+
+        resolution["confidence"] = round(confidence, 4)
+        resolution["ocr_time"] = round(time.perf_counter() - start_time, 4)
+
+        # Handle translation if a translator and target language are provided
+        if self.translator and self.target_language:
+            translation_path = self.translation_policy.decide(text=text, detected_language=src_language,
+                                                              confidence=detection["score"])
+        else:
+            translation_path = "disabled"
+
+        translated_chars = 0
+        if translation_path == "translated" and self.translation_policy.partial:
+            # Only the lines with words, the amounts and dates between them are kept as recognized
+            needed_lines = self.translation_policy.lines_to_translate(lines)
+            translated_lines, src_language = self.translator.translate_lines(needed_lines, to_lang=self.target_language)
+            if translated_lines is not None:
+                translations = dict(zip(needed_lines, translated_lines))
+                trans_text = " ".join(translations.get(line, line) for line in lines)
+                translated_chars = sum(len(line) for line in needed_lines)
+                translation_path = "translated_partial"
             else:
-                # If translation is not required, use the original text and language
-                trans_text, src_language = text, src_language
-                data = {
-                    "ori_text": text,
-                    "ori_language": src_language,
-                    "text": trans_text,
-                    "language": src_language,
-                }
-            data['angle'] = doc_angle
-
-            if self.logger:
-                self.logger.debug(f"ocr_data: {data}")
+                src_language = detection["language"]
 
-        except Exception as e:
-            print("error", e)
+        if translation_path == "translated":
+            trans_text, src_language = self.translator.translate(text=text, to_lang=self.target_language)
+            translated_chars = len(text)
+
+        if translation_path in ("translated", "translated_partial"):
+            data = {
+                "ori_text": text,
+                "ori_language": src_language,
+                "text": trans_text,
+                "language": self.target_language,
+            }
+        elif translation_path == "disabled":
+            # If translation is not required, use the original text and language
+            trans_text, src_language = text, src_language
             data = {
-                    "ori_text": "",
-                    "ori_language": "",
-                    "text": "",
-                    "language": "",
-                    "angle": 0,
-                }
-            if self.logger:
-                self.logger.debug(f"error: {e}")
+                "ori_text": text,
+                "ori_language": src_language,
+                "text": trans_text,
+                "language": src_language,
+            }
+        else:
+            # The text is already usable as is, report the language like the translator would
+            data = {
+                "ori_text": text,
+                "ori_language": to_iso_language(src_language),
+                "text": text,
+                "language": self.target_language,
+            }
+        data['angle'] = doc_angle
+        data['resolution'] = resolution
+        data['translation'] = {
+            "path": translation_path,
+            "detected_language": detection["language"],
+            "confidence": detection["score"],
+            "translated_chars": translated_chars,
+            "total_chars": len(text),
+        }
+
+        if self.logger:
+            self.logger.debug(f"ocr_data: {data}")
         return data
+
+    def _cache_key(self, image: ImageBuffer) -> str:
+        # Decoded pixels plus every setting that changes the OCR output
+        return hash_bytes(image.array.tobytes(), str(image.array.shape),
+                          str(self.resize_size), self.resolution_policy.mode, str(self.target_language),
+                          self.language_detector, self.language_detector_mode, str(self['translator']),
+                          str(self.translation_policy.skip_same_language), str(self.translation_policy.min_confidence),
+                          str(self.translation_policy.partial))
+
+    def get_cache_stats(self) -> dict:
+        stats = self.cache_stats.to_dict()
+        stats['size'] = len(self.cache_store) if self.cache_store is not None else 0
+        return stats
+
+    def _rotate_image(self, image: ImageBuffer, osd_view: ImageBuffer = None):
+        # Tesseract OSD only needs the grayscale view, of at least resize_size when the image was shrunk for OCR
+        osd_view = osd_view if osd_view is not None else image
+        doc_angle = detect_rotation_angle(osd_view.gray, early_exit=self.osd_early_exit, workers=self.osd_workers)
+        return image.rotated(doc_angle), doc_angle
+
+    def _osd_view(self, image: ImageBuffer, source: ImageBuffer) -> ImageBuffer:
+        """The image at resize_size or more, what OSD and the extractor saw before the adaptive resolution."""
+        if max(image.size) >= self.resize_size:
+            return image
+        return source.resized(self.resize_size)
+
+    def get_text(self, input_data, return_image: bool = False):
+        return self.get_texts([input_data], return_image=return_image)[0]
+
+    def get_texts(self, inputs: list, return_image: bool = False) -> list:
+        """
+        OCR a batch of documents. The language of every document is detected
+        in a single forward pass, a failing document only empties its own result.
+        With return_image, each result is a (data, rotated_image) tuple so callers
+        can reuse the corrected ImageBuffer instead of detecting the orientation again;
+        the image is None when the document could not be prepared.
+        """
+        results = [None] * len(inputs)
+        images = [None] * len(inputs)
+
+        prepared = []
+        for i, input_data in enumerate(inputs):
+            try:
+                image, source, resolution = self._prepare_image(input_data)
+                view = self._osd_view(image, source)
+
+                cache_key = None
+                if self.cache_store is not None:
+                    cache_key = self._cache_key(image)
+                    cached = self.cache_store.get(cache_key)
+                    self.cache_stats.record(hit=cached is not None)
+                    if cached is not None:
+                        results[i] = dict(cached)
+                        images[i] = view.rotated(cached['angle'])
+                        continue
+
+                image, doc_angle = self._rotate_image(image, osd_view=view)
+                prepared.append((i, image, doc_angle, cache_key, source, resolution))
+                images[i] = image if view is image else view.rotated(doc_angle)
+            except Exception as e:
+                self._log_error(e)
+                results[i] = self._empty_result()
+
+        # Detect the language of the images
+        try:
+            detections = self.detect_languages([image for _, image, *_ in prepared])
+        except Exception as e:
+            self._log_error(e)
+            detections = []
+            for i, *_ in prepared:
+                results[i] = self._empty_result()
+            prepared = []
+
+        for (i, image, doc_angle, cache_key, source, resolution), detection in zip(prepared, detections):
+            try:
+                results[i] = self._read_text(image, doc_angle, detection=detection,
+                                             source=source, resolution=resolution)
+                if cache_key is not None:
+                    self.cache_store.set(cache_key, results[i])
+            except Exception as e:
+                self._log_error(e)
+                results[i] = self._empty_result()
+
+        if return_image:
+            return list(zip(results, images))
+        return results
     
-    def get_rotated_image(self, input_data):
+    def get_rotated_image(self, input_data) -> ImageBuffer:
         # Detect the language of the image
         image = self.get_image(input_data)
-        rotated_image, doc_angle = rotate_image(image)
+        rotated_image, doc_angle = self._rotate_image(image)
         return rotated_image
 
     
@@ -241,12 +764,92 @@ def load_image(image_path: str):
 
 
 
+def test_google_translator():
+    """Run the concurrent translator against a local stand-in for the Google endpoint."""
+    import tempfile
+    import yaml
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    requests_count = []
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            requests_count.append(query['q'][0])
+            body = json.dumps({"sentences": [{"trans": query['q'][0].upper()}], "src": "fr"}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        yaml.safe_dump({"translator": {"mode": "concurrent", "max_input_length": 40, "max_workers": 4, 
+                                       "cache_size": 8, "url": f"http://127.0.0.1:{server.server_port}/"}}, f)
+
+    try:
+        translator = GoogleTranslator(config_path=f.name)
+        text = "Bonjour tout le monde. Merci pour votre visite! A bientot au magasin? Total 32.00 EUR."
+        translated_text, src_language = translator.translate(text=text, to_lang="en")
+        print("Translated:", translated_text, src_language, f"{len(requests_count)} requests")
+        assert translated_text == text.upper() and src_language == "fr"
+        assert all(len(chunk) <= 40 for chunk in requests_count)
+
+        # The second call is memoized
+        translator.translate(text=text, to_lang="en")
+        assert len(requests_count) == len(split_text(text, 40))
+
+        # Lines are packed without being split and come back one to one
+        lines = ["Bonjour tout le monde", "Merci pour votre visite", "A bientot au magasin"]
+        translated_lines, src_language = translator.translate_lines(lines, to_lang="en")
+        assert translated_lines == [line.upper() for line in lines] and src_language == "fr"
+        assert TranslationPolicy.lines_to_translate(["Total", "32,00", "Total", "12/03/2024"]) == ["Total"]
+
+        # More chunks than workers, the chunks must not wait on the pool they run in
+        lines = [f"Ligne numero {i} de la facture" for i in range(12)]
+        result = translator.executor.submit(translator.translate_lines, lines, "en", 40).result(timeout=10)
+        assert result == ([line.upper() for line in lines], "fr")
+    finally:
+        server.shutdown()
+        os.remove(f.name)
+
+
+def test_resolution_policy(img_path: str = "fr_1.png"):
+    """Check the adaptive size choice and the low confidence fallback order."""
+    image = ImageBuffer.from_path(img_path)
+
+    policy = ResolutionPolicy(mode="adaptive", candidate_sizes=[640, 960, 1080, 1440])
+    resolution = policy.choose(image)
+    print("Adaptive resolution:", resolution)
+    assert resolution["size"] in policy.candidate_sizes
+
+    # Characters grow with the size, so a larger minimum never picks a smaller size
+    strict = ResolutionPolicy(mode="adaptive", candidate_sizes=[640, 960, 1080, 1440], min_char_height=40)
+    assert strict.choose(image)["size"] >= resolution["size"]
+
+    assert policy.next_size(960, confidence=0.5) == 1080
+    assert policy.next_size(960, confidence=0.95) is None
+    # Ordinary scans, around 0.8-0.9 mean line confidence, are not OCR'd again
+    assert policy.next_size(960, confidence=0.8) is None
+    assert policy.next_size(1440, confidence=0.5) is None
+    assert ResolutionPolicy(mode="fixed").choose(image) == {"mode": "fixed", "size": 1080}
+
+
 # Example usage
 if __name__ == "__main__":
+    test_google_translator()
+    test_resolution_policy()
+
     img_path = "test/images/ch_1.png"
     
     #### CI CD test
-    import os
     if os.path.exists(img_path):
         print(f"Image found: {img_path}")
     else:
@@ -259,13 +862,18 @@ if __name__ == "__main__":
 
     ocr_reader = OcrReader(
                             config_path=config_path, 
-                           translator=GoogleTranslator())
+                           translator=GoogleTranslator(config_path=config_path))
 
     recognized_text = ocr_reader.get_text(image)
     print("Recognized Text:", recognized_text)
 
     print(ocr_reader["ocr_detector"], ocr_reader["translator"])
 
+    # The second call reuses the warm engine from the pool, or the cached result
+    recognized_text = ocr_reader.get_text(image)
+    print("Resident PaddleOCR engines:", ocr_reader.engine_pool.languages)
+    print("OCR cache:", ocr_reader.get_cache_stats())
+
 
 
 
@@ -0,0 +1,80 @@
+import sys
+sys.path.append("")
+
+import threading
+from typing import Dict
+
+from src.Utils.utils import read_config, read_txt_file
+
+SYSTEM_PROMPT = (
+    "You are a helpful assistant that responds in JSON format with the invoice information in English. "
+    "Don't add any annotations there. Remember to close any bracket. And just output the field that has value, "
+    "don't return field that are empty. number, price and amount should be number, date should be convert to dd/mm/yyyy, "
+    "time should be convert to HH:mm:ss, currency should be 3 chracters like VND, USD, EUR."
+)
+
+
+class PromptBuilder:
+    """
+    Builds the chat messages of the invoice extraction.
+
+    The system instructions and the template of the invoice type come first. They are the
+    same for every invoice of a type, so the provider caches that prefix and only the OCR
+    text and the image of each document are new input. Templates are read once.
+    """
+    def __init__(self, invoice_dict: Dict[str, str]):
+        self.templates = {invoice_type: read_txt_file(path) for invoice_type, path in invoice_dict.items()}
+
+    @classmethod
+    def from_config_path(cls, config_path: str = "config/config.yaml") -> "PromptBuilder":
+        return get_prompt_builder(read_config(path=config_path))
+
+    def get_template(self, invoice_type: str) -> str:
+        if invoice_type not in self.templates:
+            raise KeyError(f"No template for invoice type: {invoice_type}")
+        return self.templates[invoice_type]
+
+    def system_message(self, invoice_template: str) -> dict:
+        """The static prefix: instructions, then the template."""
+        return {"role": "system", "content": f"{SYSTEM_PROMPT}\nReturn the key names as in the template is a MUST. "
+                                             f"The invoice template:\n{invoice_template}"}
+
+    def build_messages(self, ocr_text: str, image_payload: dict, invoice_template: str) -> list:
+        """
+        Args:
+            image_payload (dict): An ImagePayloadPolicy.encode result, None for a text only prompt.
+        """
+        content = [{"type": "text", "text": f"From the image of the bill and the text from OCR, extract the information. "
+                                            f"The ocr text is: {ocr_text}"}]
+        if image_payload is not None:
+            content.append({"type": "image_url", "image_url": {
+                "url": f"data:{image_payload['mime_type']};base64,{image_payload['base64']}",
+                "detail": image_payload['detail']}})
+        return [self.system_message(invoice_template), {"role": "user", "content": content}]
+
+
+_prompt_builders = {}
+_prompt_builders_lock = threading.Lock()
+
+
+def get_prompt_builder(config: dict) -> PromptBuilder:
+    """The shared PromptBuilder of the templates in config['invoice_dict']."""
+    key = tuple(sorted(config['invoice_dict'].items()))
+    with _prompt_builders_lock:
+        if key not in _prompt_builders:
+            _prompt_builders[key] = PromptBuilder(config['invoice_dict'])
+        return _prompt_builders[key]
+
+
+if __name__ == "__main__":
+    config = read_config(path="config/config.yaml")
+    prompt_builder = get_prompt_builder(config)
+    assert get_prompt_builder(config) is prompt_builder
+
+    image_payload = {"mime_type": "image/jpeg", "base64": "AAAA", "detail": "auto"}
+    first = prompt_builder.build_messages("Glasses 22.00e", image_payload, prompt_builder.get_template("invoice 3"))
+    second = prompt_builder.build_messages("Hats 10.00e", image_payload, prompt_builder.get_template("invoice 3"))
+    # Same prefix for every invoice of a type, only the user message changes
+    assert first[0] == second[0] and first[1] != second[1]
+    print(first[0]['content'][:300])
+    print("Prefix length (chars):", len(first[0]['content']))
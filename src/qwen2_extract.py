@@ -1,13 +1,19 @@
 import sys
 sys.path.append("")
 
+import json
+import time
+import threading
 import numpy as np
-from typing import Union
+from collections import Counter
+from typing import List, Optional, Union
 from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
 from qwen_vl_utils import process_vision_info
 import torch
 from base_extractors import BaseExtractor, InvoicePostProcessing
-from src.Utils.utils import read_config, timeit, retry_on_failure
+from src.Utils.utils import read_config, timeit
+from src.Utils.resilience import resilient
+from src.Utils.json_stream import IncrementalJsonParser, find_invalid_fields, parse_json_answer
 
 
 class Qwen2Extractor(BaseExtractor):
@@ -15,26 +21,48 @@ class Qwen2Extractor(BaseExtractor):
         super().__init__(config_path)
 
         self.post_processor = InvoicePostProcessing(config_path=self.config_path)
+        # How often the Qwen2 answer is used as is, without the post-processing LLM call
+        self.postprocess_stats = Counter()
+        self._stats_lock = threading.Lock()
         # Load the Qwen2 model and processor
         self.config = self.config['qwen2']
+        # Fields an answer must have to be used without the post-processor, by invoice type.
+        # Every key of the template for the types not listed
+        self.required_fields = self.config.get('required_fields') or {}
         self._initialize_model()
         self._load_dummy_data()
     
     def _initialize_model(self):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        print(f"Device used: {self.device}")
+        self.batch_size = self.config.get('batch_size', 1)
+        # Dynamic int8 quantization only runs on CPU
+        self.quantize = self.config.get('quantize', False)
+        self.device = torch.device("cuda" if torch.cuda.is_available() and not self.quantize else "cpu")
+        print(f"Device used: {self.device}, int8 quantized: {self.quantize}")
 
-        self.model = Qwen2VLForConditionalGeneration.from_pretrained(
-            self.config['model_name'],
-            torch_dtype=torch.bfloat16,
-            device_map="auto"
-        )
+        if self.quantize:
+            # Quantize the Linear layers of a float32 model, activations are quantized on the fly
+            model = Qwen2VLForConditionalGeneration.from_pretrained(
+                self.config['model_name'],
+                torch_dtype=torch.float32,
+            )
+            self.model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            torch.set_num_threads(self.config.get('num_threads') or torch.get_num_threads())
+        else:
+            self.model = Qwen2VLForConditionalGeneration.from_pretrained(
+                self.config['model_name'],
+                torch_dtype=torch.bfloat16,
+                device_map="auto"
+            )
+        self.model.eval()
         
         self.processor = AutoProcessor.from_pretrained(
             self.config['model_name'],
             min_pixels=self.config['min_pixels'],
             max_pixels=self.config['max_pixels']
         )
+        # Decoder-only generation needs the padding on the left of a batch
+        self.processor.tokenizer.padding_side = "left"
+        self.last_generation_stats = {}
 
     def _load_dummy_data(self):
         """Load or generate dummy data for testing the model during initialization."""
@@ -53,22 +81,40 @@ class Qwen2Extractor(BaseExtractor):
         except Exception as e:
             print("Error during dummy extraction:", e)
 
-    @timeit
-    def _extract_invoice_llm(self, text, image: Union[str, np.ndarray]):
-        # Prepare the messages for Qwen2
-        messages = [
+    def _build_messages(self, text, image: Union[str, np.ndarray], invoice_template: str = None) -> list:
+        prompt = f"From the image of the bill and the text from OCR, extract the useful information on the invoice. The text is: {text}"
+        if invoice_template:
+            # Key names of the template let the answer skip post-processing
+            prompt += f"\nAnswer in JSON with the key names of this template: {invoice_template}"
+        return [
             {"role": "system", "content": "You are a helpful assistant that help me with invoice"},
             {"role": "user", "content": [
-                {"type": "image", "image": image},
-                {"type": "text", "text": f"From the image of the bill and the text from OCR, extract the useful information on the invoice. The text is: {text}"}
+                # Resize before the processor sees the image, this caps the image tokens
+                {"type": "image", "image": image,
+                 "min_pixels": self.config['min_pixels'], "max_pixels": self.config['max_pixels']},
+                {"type": "text", "text": prompt}
             ]}
         ]
 
+    @timeit
+    def _extract_invoice_llm(self, text, image: Union[str, np.ndarray], invoice_template: str = None):
+        return self._extract_invoices_llm([text], [image], [invoice_template])[0]
+
+    @timeit
+    @torch.inference_mode()
+    def _extract_invoices_llm(self, texts: List[str], images: List[Union[str, np.ndarray]],
+                              invoice_templates: List[str] = None) -> List[str]:
+        """Generate the answers of several invoices in one padded batch."""
+        invoice_templates = invoice_templates or [None] * len(texts)
+        messages = [self._build_messages(text, image, invoice_template)
+                    for text, image, invoice_template in zip(texts, images, invoice_templates)]
+
         # Preparation for inference
-        text_inputs = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        text_inputs = [self.processor.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
+                       for message in messages]
         image_inputs, video_inputs = process_vision_info(messages)
         inputs = self.processor(
-            text=[text_inputs],
+            text=text_inputs,
             images=image_inputs,
             videos=video_inputs,
             padding=True,
@@ -77,18 +123,30 @@ class Qwen2Extractor(BaseExtractor):
         inputs = inputs.to(self.device)
 
         # Inference: Generation of the output
+        start_time = time.perf_counter()
         generated_ids = self.model.generate(**inputs, max_new_tokens=self.config['max_new_tokens'],
                                             temperature=self.config['temperature'],  # Add temperature parameter
                                             top_p=self.config['top_p'],              # Add top_p parameter
                                             top_k=self.config['top_k'],           # Add top_k parameter)
+                                            pad_token_id=self.processor.tokenizer.pad_token_id,
                                             )
-        generated_ids_trimmed = [
-            out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-        ]
+        generate_time = time.perf_counter() - start_time
+        # With left padding every prompt ends at the same position
+        generated_ids_trimmed = generated_ids[:, inputs.input_ids.shape[1]:]
+        new_tokens = int((generated_ids_trimmed != self.processor.tokenizer.pad_token_id).sum())
+        self.last_generation_stats = {
+            "documents": len(texts),
+            "prompt_tokens": int(inputs.attention_mask.sum()),
+            "new_tokens": new_tokens,
+            "generate_time": round(generate_time, 3),
+            "tokens_per_second": round(new_tokens / generate_time, 2) if generate_time else None,
+        }
+        print("Generation stats:", self.last_generation_stats)
+
         output_text = self.processor.batch_decode(
             generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
         )
-        return output_text[0]
+        return output_text
     
     @timeit
     def post_process(self, ocr_text:str, model_text:str, invoice_template:str) -> str:
@@ -96,28 +154,114 @@ class Qwen2Extractor(BaseExtractor):
                                                    ocr_text=ocr_text, model_text=model_text)
         return response
 
+    def _record_postprocess(self, outcome: str):
+        with self._stats_lock:
+            self.postprocess_stats['documents'] += 1
+            self.postprocess_stats[outcome] += 1
+
+    def get_postprocess_stats(self) -> dict:
+        """Documents whose Qwen2 answer was used as is (bypassed), partly or fully post-processed."""
+        with self._stats_lock:
+            stats = dict(self.postprocess_stats)
+        stats['bypass_ratio'] = round(stats.get('bypassed', 0) / stats['documents'], 3) if stats.get('documents') else None
+        return stats
+
+    def to_invoice_info(self, ocr_text: str, model_text: str, invoice_template: str,
+                        response_model = None, invoice_type: str = None) -> dict:
+        """
+        Turn the Qwen2 answer into the invoice info. An answer that is already valid JSON with the
+        key names of the invoice model is used as is, only the fields that fail validation or the
+        required fields it lacks are sent to the post-processor. Anything else is fully post-processed.
+        """
+        invoice_info, invalid_fields = None, None
+        if response_model is not None:
+            required_fields = self.required_fields.get(invoice_type) or \
+                list(response_model.model_fields['invoice_info'].annotation.model_fields)
+            parser = IncrementalJsonParser()
+            parser.feed(model_text)
+            try:
+                invoice_info = parser.result()
+                invalid_fields = find_invalid_fields(invoice_info, response_model, required_fields=required_fields)
+            except ValueError:
+                pass
+
+        if invalid_fields is None:
+            self._record_postprocess('full')
+            pre_invoice_info = self.post_process(ocr_text=ocr_text, model_text=model_text, 
+                                                 invoice_template = invoice_template)
+            return self.extract_json(pre_invoice_info)
+
+        if not invalid_fields:
+            self._record_postprocess('bypassed')
+            return invoice_info
+
+        # Ask the post-processor for the invalid fields only
+        self._record_postprocess('partial')
+        info_model = response_model.model_fields['invoice_info'].annotation
+        partial_template = json.dumps({"invoice_info": info_model().model_dump(include=set(invalid_fields), mode="json")})
+        pre_invoice_info = self.post_process(ocr_text=ocr_text, model_text=model_text,
+                                             invoice_template=partial_template)
+        fixed_fields = self.extract_json(pre_invoice_info).get('invoice_info', {})
+        for field in invalid_fields:
+            if field in fixed_fields:
+                invoice_info['invoice_info'][field] = fixed_fields[field]
+            else:
+                # Fall back on the model default
+                invoice_info['invoice_info'].pop(field, None)
+        return invoice_info
+
     def extract_json(self, text: str) -> dict:
-        start_index = text.find('{')
-        end_index = text.rfind('}') + 1
-        json_string = text[start_index:end_index]
-        json_string = json_string.replace('true', 'True').replace('false', 'False').replace('null', 'None')
-        result = eval(json_string)
-        return result
+        try:
+            # Ollama answers in JSON mode
+            return json.loads(text)
+        except ValueError:
+            pass
+        return parse_json_answer(text)
  
     
     @timeit
-    @retry_on_failure(max_retries=3, delay=1.0)
+    @resilient
     def extract_invoice(self, ocr_text: str, image: Union[str, np.ndarray], 
-                        invoice_template:str) -> dict:
+                        invoice_template:str, response_model = None, invoice_type: str = None) -> dict:
         
         base64_image = self.encode_image(image)  # Assuming encode_image is still applicable
         base64_image = f"data:image;base64,{base64_image}"
-        model_text = self._extract_invoice_llm(ocr_text, base64_image)
-        pre_invoice_info = self.post_process(ocr_text=ocr_text, model_text=model_text, 
-                                             invoice_template = invoice_template)
-        invoice_info = self.extract_json(pre_invoice_info)
-        return invoice_info
-    
+        model_text = self._extract_invoice_llm(ocr_text, base64_image, invoice_template)
+        return self.to_invoice_info(ocr_text=ocr_text, model_text=model_text, invoice_template=invoice_template,
+                                    response_model=response_model, invoice_type=invoice_type)
+
+    @timeit
+    def extract_invoices(self, ocr_texts: List[str], images: List[Union[str, np.ndarray]],
+                         invoice_templates: List[str], response_models: list = None,
+                         invoice_types: List[str] = None) -> List[Union[dict, Exception]]:
+        """
+        extract_invoice for several invoices, generated batch_size at a time.
+        Returns the invoice info of every invoice, or the exception raised for it.
+        """
+        base64_images = [f"data:image;base64,{self.encode_image(image)}" for image in images]
+        response_models = response_models or [None] * len(ocr_texts)
+        invoice_types = invoice_types or [None] * len(ocr_texts)
+        results = []
+        for start in range(0, len(ocr_texts), self.batch_size):
+            end = start + self.batch_size
+            try:
+                model_texts = self.resilience.call(self._extract_invoices_llm, ocr_texts[start:end],
+                                                   base64_images[start:end], invoice_templates[start:end])
+            except Exception as e:
+                results.extend([e] * len(ocr_texts[start:end]))
+                continue
+            for ocr_text, model_text, invoice_template, response_model, invoice_type in zip(
+                    ocr_texts[start:end], model_texts, invoice_templates[start:end], response_models[start:end],
+                    invoice_types[start:end]):
+                try:
+                    results.append(self.to_invoice_info(ocr_text=ocr_text, model_text=model_text,
+                                                        invoice_template=invoice_template,
+                                                        response_model=response_model, invoice_type=invoice_type))
+                except Exception as e:
+                    results.append(e)
+        print("Post-processing stats:", self.get_postprocess_stats())
+        return results
+
     def __getitem__(self, item):
         if item == "llm_extractor":
             return self.config['model_name']
@@ -131,6 +275,31 @@ class Qwen2Extractor(BaseExtractor):
 
 # Note: Integrate the Qwen2Extractor into the main script as needed.
 
+def benchmark_generation(extractor: Qwen2Extractor, ocr_text: str, image: Union[str, np.ndarray],
+                         num_documents: int = 8, batch_sizes: List[int] = [1, 4]) -> List[dict]:
+    """Tokens/s and documents/min of the Qwen2 generation (without post-processing) for each batch size."""
+    base64_image = f"data:image;base64,{extractor.encode_image(image)}"
+    reports = []
+    for batch_size in batch_sizes:
+        new_tokens = 0
+        start_time = time.perf_counter()
+        for start in range(0, num_documents, batch_size):
+            count = min(batch_size, num_documents - start)
+            extractor._extract_invoices_llm([ocr_text] * count, [base64_image] * count)
+            new_tokens += extractor.last_generation_stats['new_tokens']
+        total_time = time.perf_counter() - start_time
+        report = {
+            "device": str(extractor.device),
+            "quantized": extractor.quantize,
+            "batch_size": batch_size,
+            "documents": num_documents,
+            "tokens_per_second": round(new_tokens / total_time, 2),
+            "documents_per_minute": round(num_documents * 60 / total_time, 2),
+        }
+        print("Benchmark:", report)
+        reports.append(report)
+    return reports
+
 if __name__ == "__main__":
     config_path = "config/config.yaml"
     ocr_text = "Géant Casino Annecy Welcome to our Caisse014 Date28/06/28 store, your store welcomes you Monday to Saturday from 8:30 a.m. to 9:30 pm Tel.04.50.88.20.00 Glasses 22.00e Hats 10.00e = Total (2) 32.00E CB EMV 32.00E you had the loyalty card, you would have accumulated 11SMILES Cashier000148/Time 17:46:26 Ticket number: 000130 Speed, comfort of purchase bude and controlled.. Scan'Express is waiting for you!!! Thank you for your visit See you soon"
@@ -146,4 +315,11 @@ if __name__ == "__main__":
                                                          invoice_template =invoice_template)
     print("\nQwen2 Extractor Output:")
     print(qwen2_invoice_data)
-    print(qwen2_extractor['post_processor'], qwen2_extractor['llm_extractor'])
\ No newline at end of file
+    print(qwen2_extractor['post_processor'], qwen2_extractor['llm_extractor'])
+
+    qwen2_invoices = qwen2_extractor.extract_invoices(ocr_texts=[ocr_text] * 2, images=[image_path] * 2,
+                                                      invoice_templates=[invoice_template] * 2)
+    print("\nQwen2 batched Output:", qwen2_invoices)
+
+    benchmark_generation(qwen2_extractor, ocr_text=ocr_text, image=image_path,
+                         num_documents=4, batch_sizes=[1, qwen2_extractor.batch_size])
\ No newline at end of file
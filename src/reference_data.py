@@ -0,0 +1,207 @@
+import sys
+sys.path.append("")
+
+import os
+import json
+import time
+import threading
+from typing import Callable, Tuple
+
+from src.employee_name import EmployeeNames
+from src.Utils.cache import hash_bytes
+from src.Utils.fuzzy_matcher import FuzzyMatcher
+from src.Utils.utils import get_currencies_from_txt, get_land_and_city_list
+
+
+class ReferenceSource:
+    """One reference file, parsed by loader into a snapshot that is replaced when the file changes."""
+    def __init__(self, name: str, path: str, loader: Callable):
+        self.name = name
+        self.path = path
+        self.loader = loader
+        self.value = None
+        self.stat_key = None
+        self.digest = None
+        self.last_check = 0.0
+
+    def _hash_file(self) -> str:
+        with open(self.path, 'rb') as f:
+            return hash_bytes(f.read())
+
+    def refresh(self) -> bool:
+        """Reload when the content changed, mtime and size are checked first, then the hash."""
+        stat = os.stat(self.path)
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        if self.value is not None and stat_key == self.stat_key:
+            return False
+        digest = self._hash_file()
+        if self.value is not None and digest == self.digest:
+            # Touched or copied over with the same content
+            self.stat_key = stat_key
+            return False
+
+        start_time = time.perf_counter()
+        self.value = self.loader(self.path)
+        self.stat_key = stat_key
+        self.digest = digest
+        print(f"Loaded reference data '{self.name}' from {self.path} in {time.perf_counter() - start_time:.2f}s")
+        return True
+
+
+class ReferenceDataService:
+    """
+    Process-wide reference data: currencies, lands and cities, employee names and the frontend
+    field definitions. Each source is parsed once and kept in memory as an immutable snapshot.
+    The files are checked at most every check_interval seconds and reloaded only when their
+    content changed. A reload swaps the snapshot, readers holding the old one are not affected.
+    The currencies, lands and cities are kept as FuzzyMatcher indexes in file order, so equal
+    scores resolve to the same candidate as a linear scan of the file.
+    """
+    def __init__(self, config: dict, check_interval: float = 5.0):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+
+        country_and_city = config['country_and_city']
+        self.sources = {
+            "currencies": ReferenceSource("currencies", config['currencies_path'],
+                                          lambda path: FuzzyMatcher(get_currencies_from_txt(file_path=path))),
+            "lands_and_cities": ReferenceSource(
+                "lands_and_cities", country_and_city['file_path'],
+                lambda path: tuple(FuzzyMatcher(values) for values in get_land_and_city_list(
+                    file_path=path, sheet_name=country_and_city['sheet_name']))),
+            "employees": ReferenceSource("employees", config['excel']['employee_name']['excel_file_path'],
+                                         lambda path: EmployeeNames.from_workbook(config)),
+            "frontend_defines": ReferenceSource("frontend_defines", config['frontend_fields_define_path'],
+                                                self._load_json),
+        }
+
+    @staticmethod
+    def _load_json(path: str):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def get(self, name: str):
+        source = self.sources[name]
+        with self._lock:
+            now = time.monotonic()
+            if source.value is None or now - source.last_check >= self.check_interval:
+                source.last_check = now
+                source.refresh()
+            return source.value
+
+    @property
+    def currency_matcher(self) -> FuzzyMatcher:
+        return self.get("currencies")
+
+    @property
+    def land_matcher(self) -> FuzzyMatcher:
+        return self.get("lands_and_cities")[0]
+
+    @property
+    def city_matcher(self) -> FuzzyMatcher:
+        return self.get("lands_and_cities")[1]
+
+    @property
+    def currencies(self) -> Tuple[str, ...]:
+        return self.currency_matcher.candidates
+
+    @property
+    def lands(self) -> Tuple[str, ...]:
+        return self.land_matcher.candidates
+
+    @property
+    def cities(self) -> Tuple[str, ...]:
+        return self.city_matcher.candidates
+
+    @property
+    def employees(self) -> EmployeeNames:
+        return self.get("employees")
+
+    @property
+    def frontend_defines(self) -> list:
+        """The parsed frontend_fields_define.json, copy it before changing it."""
+        return self.get("frontend_defines")
+
+    def warm_up(self):
+        """Load every source now instead of on the first invoice."""
+        for name in self.sources:
+            self.get(name)
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_reference_data(config: dict) -> ReferenceDataService:
+    """The shared ReferenceDataService of this configuration."""
+    key = (config['currencies_path'], config['country_and_city']['file_path'],
+           config['country_and_city']['sheet_name'], config['excel']['employee_name']['excel_file_path'],
+           config['excel']['employee_name']['sheet_name'], config['frontend_fields_define_path'])
+    with _services_lock:
+        if key not in _services:
+            check_interval = (config.get('reference_data') or {}).get('check_interval', 5.0)
+            _services[key] = ReferenceDataService(config, check_interval=check_interval)
+        return _services[key]
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    from src.Utils.utils import read_config
+
+    config = read_config(path="config/config.yaml")
+    reference_data = get_reference_data(config)
+    assert get_reference_data(config) is reference_data
+
+    start_time = time.perf_counter()
+    reference_data.warm_up()
+    print(f"Warm up: {time.perf_counter() - start_time:.2f}s")
+    print(f"{len(reference_data.currencies)} currencies, {len(reference_data.lands)} lands, "
+          f"{len(reference_data.cities)} cities, {len(reference_data.employees.names)} employees")
+
+    start_time = time.perf_counter()
+    for _ in range(1000):
+        reference_data.currencies, reference_data.cities, reference_data.employees
+    print(f"Cached reads: {(time.perf_counter() - start_time) * 1000:.2f} ms for 1000")
+    print(reference_data.employees.find_best_matching_name("tuuulev dirk"))
+    print(reference_data.city_matcher.match("Tokioo"))
+
+    # Candidates in workbook order: equal scores go to the first one, as the linear fuzz.ratio scan did
+    import random
+    import openpyxl
+    from fuzzywuzzy import fuzz
+
+    workbook = openpyxl.load_workbook(config['country_and_city']['file_path'], keep_vba=True)
+    rows = [row[0].value.strip() for row in workbook[config['country_and_city']['sheet_name']].iter_rows(
+        min_row=4, min_col=1, max_col=1) if row[0].value]
+    workbook.close()
+    workbook_cities = list(dict.fromkeys("Other" if row[1:].strip() == "im Übrigen" else row[1:].strip()
+                                         for row in rows if row.startswith('–')))
+    workbook_lands = list(dict.fromkeys(row for row in rows if not row.startswith('–')))
+    assert list(reference_data.cities) == workbook_cities and list(reference_data.lands) == workbook_lands
+
+    rng = random.Random(0)
+    ties = 0
+    for matcher, candidates in [(reference_data.city_matcher, workbook_cities), (reference_data.land_matcher, workbook_lands)]:
+        queries = [rng.choice(candidates)[:rng.randint(1, 6)] for _ in range(300)]
+        queries += ["".join(rng.choices("aeinorstu", k=rng.randint(2, 5))) for _ in range(300)]
+        for query in queries:
+            scores = [fuzz.ratio(query.lower(), candidate.lower()) for candidate in candidates]
+            best_score = max(scores)
+            ties += scores.count(best_score) > 1
+            expected = (scores.index(best_score), candidates[scores.index(best_score)], best_score) if best_score else (None, None, 0)
+            assert matcher.match(query) == expected, (query, matcher.match(query), expected)
+    print(f"Same matches as the linear scan in workbook order, {ties} queries with tied best scores")
+
+    # A touched file is hashed but not reparsed, a changed file is reloaded
+    with tempfile.TemporaryDirectory() as temp_dir:
+        currencies_path = os.path.join(temp_dir, "currencies.txt")
+        shutil.copy(config['currencies_path'], currencies_path)
+        service = ReferenceDataService({**config, 'currencies_path': currencies_path}, check_interval=0)
+        currencies = service.currencies
+        os.utime(currencies_path, (time.time() + 10, time.time() + 10))
+        assert service.currencies is currencies
+        with open(currencies_path, "a") as f:
+            f.write("\nZZZ\n")
+        assert "ZZZ" in service.currencies and "ZZZ" not in currencies
+    print("ReferenceDataService OK")
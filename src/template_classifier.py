@@ -0,0 +1,193 @@
+import sys
+sys.path.append("")
+
+import os
+import re
+import time
+import threading
+import numpy as np
+from collections import Counter
+from typing import Dict, List, Optional
+from sklearn.feature_extraction.text import CountVectorizer
+
+from src.Utils.utils import read_txt_file
+
+
+def preprocess_text(text: str) -> str:
+    # Remove special characters and digits
+    text = re.sub(r'[^a-zA-Z\s]', '', text)
+    # Convert to lowercase and remove extra whitespace
+    return ' '.join(text.lower().split())
+
+
+class TemplateClassifier:
+    """
+    Finds the text template closest to a document by TF-IDF cosine similarity.
+
+    The scores are the ones of a TfidfVectorizer fitted on the templates plus the document. The
+    template term counts and document frequencies are kept in memory, and the smoothed idf is
+    recomputed with the document counted in: the words of the document get the idf of a
+    document frequency one higher, in the dot product and in the norms. So a document only
+    costs a count transform and a few sparse products. The templates are reloaded when their
+    files change.
+    """
+    def __init__(self, template_paths: Dict[str, str], reload_check_interval: float = 5.0):
+        self.template_paths = dict(template_paths)
+        self.reload_check_interval = reload_check_interval
+        self._lock = threading.Lock()
+        self._last_check = time.monotonic()
+        self._fit()
+
+    def _get_mtimes(self) -> Dict[str, float]:
+        return {path: os.path.getmtime(path) for path in self.template_paths.values()}
+
+    def _fit(self):
+        self.mtimes = self._get_mtimes()
+        self.template_keys = list(self.template_paths.keys())
+        templates = [preprocess_text(read_txt_file(path)) for path in self.template_paths.values()]
+
+        self.vectorizer = CountVectorizer()
+        counts = self.vectorizer.fit_transform(templates).astype(float)
+        self.analyzer = self.vectorizer.build_analyzer()
+
+        # Smooth idf, ln((1 + n) / (1 + df)) + 1, with the document counted in n. Squared, the
+        # weights of a word appear twice in a dot product and in a squared norm
+        num_documents = len(templates) + 1
+        document_frequencies = np.asarray((counts > 0).sum(axis=0)).ravel()
+        idf_without_document = np.log((1 + num_documents) / (1 + document_frequencies)) + 1
+        idf_with_document = np.log((1 + num_documents) / (2 + document_frequencies)) + 1
+        self.document_idf_sq = idf_with_document ** 2
+        # Words only the document has
+        self.unknown_idf_sq = (np.log((1 + num_documents) / 2) + 1) ** 2
+
+        # Dot products only involve the words of the document
+        self.template_weights = counts.multiply(self.document_idf_sq).T.tocsr()
+        # Squared template norms for a document without any template word, and the change
+        # for each word the document has
+        squared_counts = counts.multiply(counts)
+        self.template_norms_sq = np.asarray(squared_counts @ idf_without_document ** 2).ravel()
+        self.template_norm_updates = squared_counts.multiply(self.document_idf_sq - idf_without_document ** 2).T.tocsr()
+
+    def reload_if_changed(self) -> bool:
+        """Refit when a template file changed, checked at most every reload_check_interval seconds."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_check < self.reload_check_interval:
+                return False
+            self._last_check = now
+            if self._get_mtimes() == self.mtimes:
+                return False
+            print("Text templates changed on disk, refitting the template classifier")
+            self._fit()
+            return True
+
+    def similarities(self, texts: List[str]) -> np.ndarray:
+        """Cosine similarity of every text (rows) with every template (columns)."""
+        self.reload_if_changed()
+        preprocessed = [preprocess_text(text) for text in texts]
+        counts = self.vectorizer.transform(preprocessed).astype(float)
+
+        vocabulary = self.vectorizer.vocabulary_
+        unknown_norms_sq = np.array([sum(count ** 2 for word, count in Counter(self.analyzer(text)).items()
+                                         if word not in vocabulary) for text in preprocessed], dtype=float)
+        document_norms_sq = np.asarray(counts.multiply(counts) @ self.document_idf_sq).ravel() \
+            + unknown_norms_sq * self.unknown_idf_sq
+        template_norms_sq = self.template_norms_sq + ((counts > 0).astype(float) @ self.template_norm_updates).toarray()
+
+        scores = (counts @ self.template_weights).toarray()
+        norms = np.sqrt(document_norms_sq[:, None] * template_norms_sq)
+        # 0 for an empty document or template, as cosine_similarity
+        return np.divide(scores, norms, out=np.zeros_like(scores), where=norms > 0)
+
+    def classify_many(self, texts: List[str], threshold: float = 0.3) -> List[Optional[str]]:
+        """The key of the most similar template of each text, None below the threshold."""
+        if not texts:
+            return []
+        similarities = self.similarities(texts)
+        best = similarities.argmax(axis=1)
+        return [self.template_keys[index] if similarities[row, index] >= threshold else None
+                for row, index in enumerate(best)]
+
+    def classify(self, text: str, threshold: float = 0.3) -> Optional[str]:
+        return self.classify_many([text], threshold=threshold)[0]
+
+
+_classifiers = {}
+_classifiers_lock = threading.Lock()
+
+
+def get_template_classifier(template_paths: Dict[str, str]) -> TemplateClassifier:
+    """The shared TemplateClassifier of these templates, fitted on first use."""
+    key = tuple(sorted(template_paths.items()))
+    with _classifiers_lock:
+        if key not in _classifiers:
+            _classifiers[key] = TemplateClassifier(template_paths)
+        return _classifiers[key]
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    from src.Utils.utils import read_config
+
+    config = read_config(path="config/config.yaml")
+    template_paths = config['invoice_txt_template']
+    classifier = get_template_classifier(template_paths)
+    assert get_template_classifier(template_paths) is classifier
+
+    texts = [read_txt_file(path) for path in template_paths.values()] + ["Géant Casino Annecy Total 32.00E"]
+    types = classifier.classify_many(texts, threshold=config['invoice_txt_template_thresh'])
+    print("Types:", types)
+    assert types == list(template_paths.keys()) + [None]
+
+    # Reload when a template file changes
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = {}
+        for invoice_type, path in template_paths.items():
+            paths[invoice_type] = os.path.join(temp_dir, os.path.basename(path))
+            shutil.copy(path, paths[invoice_type])
+        temp_classifier = TemplateClassifier(paths, reload_check_interval=0)
+        with open(paths["invoice 1"], "w", encoding="utf-8") as f:
+            f.write("Géant Casino Annecy Total")
+        os.utime(paths["invoice 1"], (time.time() + 10, time.time() + 10))
+        assert temp_classifier.classify("Géant Casino Annecy Total 32.00E") == "invoice 1"
+
+    # Same scores as the TfidfVectorizer refitted on the templates plus each document
+    import random
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    def refit_similarities(templates, text):
+        matrix = TfidfVectorizer().fit_transform([preprocess_text(template) for template in templates]
+                                                 + [preprocess_text(text)])
+        return cosine_similarity(matrix[-1:], matrix[:-1])[0]
+
+    rng = random.Random(0)
+    templates = [read_txt_file(path) for path in template_paths.values()]
+    words = [word for template in templates for word in template.split()]
+    noisy_texts = ["", "1234 5678", "Géant Casino Annecy Total 32.00E"]
+    for _ in range(500):
+        excerpt = rng.choice(templates).split()
+        start = rng.randrange(len(excerpt))
+        text = excerpt[start:start + rng.randint(1, 200)]
+        # Words of the other templates, OCR garbage and words no template has
+        text += rng.choices(words, k=rng.randint(0, 30))
+        text += ["".join(rng.choices("abcdefghijklmnopqrstuvwxyzäöü0123456789", k=rng.randint(1, 12)))
+                 for _ in range(rng.randint(0, 30))]
+        rng.shuffle(text)
+        noisy_texts.append(" ".join(text))
+
+    similarities = classifier.similarities(noisy_texts)
+    for text, scores in zip(noisy_texts, similarities):
+        expected = refit_similarities(templates, text)
+        assert np.allclose(scores, expected, rtol=0, atol=1e-12), (text, scores, expected)
+    print(f"Same scores as the refit on {len(noisy_texts)} noisy texts")
+
+    start_time = time.perf_counter()
+    for _ in range(100):
+        classifier.classify(texts[0])
+    print(f"Mean classification time: {(time.perf_counter() - start_time) * 10:.3f} ms")
+    start_time = time.perf_counter()
+    for _ in range(100):
+        refit_similarities(templates, texts[0])
+    print(f"Mean refit time: {(time.perf_counter() - start_time) * 10:.3f} ms")
@@ -1,12 +1,14 @@
 import sys
 sys.path.append("") 
 import re
+import threading
+from functools import lru_cache
 from pydantic import BaseModel, Field, model_validator
-from typing import List, Optional, Any, Union
+from typing import Callable, Dict, List, Optional, Any, Union, get_args
 from datetime import date, datetime
-from src.employee_name import EmployeeNameRetriever, get_full_name
-from src.Utils.utils import (read_config, get_currencies_from_txt,
-                              get_land_and_city_list, find_best_match_fuzzy)
+from src.employee_name import get_full_name
+from src.reference_data import get_reference_data
+from src.Utils.utils import read_config
 
 
 def preprocess_name(name: str) -> str:
@@ -28,9 +30,8 @@ def map_name(ocr_name: str, config: dict):
     # Preprocess the OCR name before matching
     ocr_name = preprocess_name(ocr_name)
     
-    # Initialize the processor and matcher
-    processor = EmployeeNameRetriever(config=config)    
-    best_match = processor.find_best_matching_name(name=ocr_name)
+    # Names parsed once from the workbook by the reference data service
+    best_match = get_reference_data(config).employees.find_best_matching_name(name=ocr_name)
     full_name = get_full_name(best_match)
     return full_name
 
@@ -68,10 +69,9 @@ def validate_currency(currency_text: str, config:dict) -> str:
     if not currency_text or currency_text =="":
         return ""
     
-    currencies = get_currencies_from_txt(file_path=config['currencies_path'])
-    best_idx, currency, best_score = find_best_match_fuzzy(string_list=currencies, text=currency_text)
-    # Return the best matching currency or the original currency if no match is found
-    return currency
+    best_idx, currency, best_score = get_reference_data(config).currency_matcher.match(currency_text)
+    # Return the best matching currency, nothing when no currency shares a character with the text
+    return currency if currency is not None else ""
 
 def validate_land(land_text: str, config:dict) -> str:
     land_text_default = config["country_and_city"]["land_text_default"]
@@ -81,10 +81,7 @@ def validate_land(land_text: str, config:dict) -> str:
     if land_text.lower().strip() == "de":
         return land_text_default
     
-    lands, _ = get_land_and_city_list(file_path=config['country_and_city']['file_path'],
-                                                  sheet_name=config['country_and_city']['sheet_name'])
-    
-    _, land, best_score = find_best_match_fuzzy(string_list=lands, text=land_text)
+    _, land, best_score = get_reference_data(config).land_matcher.match(land_text)
     # Return the best matching currency or the original currency if no match is found
     if best_score <= 20:
         return land_text_default
@@ -97,10 +94,7 @@ def validate_city(city_text: str, config:dict) -> str:
     if not city_text or city_text =="":
         return city_text_default
     
-    _, cities = get_land_and_city_list(file_path=config['country_and_city']['file_path'],
-                                                  sheet_name=config['country_and_city']['sheet_name'])
-    
-    _, city, best_score = find_best_match_fuzzy(string_list=cities, text=city_text)
+    _, city, best_score = get_reference_data(config).city_matcher.match(city_text)
     # Return the best matching currency or the original currency if no match is found
     if best_score <= 50:
         return city_text_default
@@ -133,61 +127,24 @@ def check_file_name(file_name: str, invoice_data: dict) -> dict:
 
     return invoice_data
 
-def validate_invoice_3(invoice_data: dict, config:dict) -> dict:
-
-    # Normalize payment card number by removing all non-digit characters
-    def normalize_payment_card_number(value):
-        return re.sub(r'\D', '', value)
-
-    # Normalize percentage to float value
-    def normalize_percentage(value):
-        try:
-            return float(value)
-        except (ValueError, TypeError):
-            return None
-
-    # Normalize phone number by removing all non-digit characters
-    def normalize_phone_number(value):
-        return re.sub(r'\D', '', value)
+# Normalize payment card number by removing all non-digit characters
+def normalize_payment_card_number(value):
+    return re.sub(r'\D', '', value)
 
+# Normalize percentage to float value
+def normalize_percentage(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
 
-    # Recursive function to apply normalizations and validations to the data
-    def validate_and_normalize(data):
-        if isinstance(data, dict):
-            for key, value in data.items():
-                # Strip all string values
-                data[key] = strip_strings(value)
-                
-                # Normalize specific fields
-                if 'payment_card_number' in key:
-                    data[key] = normalize_payment_card_number(data[key])
-                
-                if 'date' in key:
-                    data[key] = normalize_date(data[key])
-
-                if 'time' in key:
-                    data[key] = normalize_time(data[key])
-                
-                if 'percentage' in key:
-                    data[key] = normalize_percentage(data[key])
-                
-                if 'phone' in key:
-                    data[key] = normalize_phone_number(data[key])
-                
-                if 'currency' in key:
-                    data[key] = validate_currency(data[key], config=config)
-                
-                # Recursively normalize nested dictionaries or lists
-                if isinstance(value, dict) or isinstance(value, list):
-                    data[key] = validate_and_normalize(value)
-        
-        elif isinstance(data, list):
-            data = [validate_and_normalize(item) for item in data]
-        
-        return data
+# Normalize phone number by removing all non-digit characters
+def normalize_phone_number(value):
+    return re.sub(r'\D', '', value)
 
-    # Call the validation and normalization function
-    return validate_and_normalize(invoice_data)
+def validate_invoice_3(invoice_data: dict, config:dict) -> dict:
+    # Apply the normalizations and validations of the compiled plan in one pass
+    return get_normalization_plan("invoice 3").apply(invoice_data, config)
 
 # Normalize break_time to float
 def normalize_float(value):
@@ -228,49 +185,33 @@ def validate_invoice_1(invoice_data: dict, config:dict) -> dict:
     if "file_name" in invoice_data['invoice_info']:
         invoice_data = check_file_name(invoice_data['invoice_info']["file_name"], invoice_data)
 
-    # Recursive function to apply normalizations and validations to the data
-    def validate_and_normalize(data: Any, reference_year=None):
-        if isinstance(data, dict):
-            for key, value in data.items():
-                # Strip all string values
-                data[key] = strip_strings(value)
-                
-                if 'date' in key:
-                    data[key] = normalize_date(data[key])
-
-                if 'time' in key:
-                    data[key] = normalize_time(data[key])
-
-                if 'break_time' in key:
-                    data[key] = normalize_float(data[key])
-
-                if key == 'name':
-                    data[key] = map_name(value, config)
-                
-                if key == 'land':
-                    data[key] = validate_land(value, config)
-                
-                if key == 'city':
-                    data[key] = validate_city(value, config)
-
-                if key == 'project_number':
-                    data[key]=validate_project_number(value=value)
-
-                if key == "kw":
-                    data[key]=validate_kw(value=value)
-                
-                # Recursively normalize nested dictionaries or lists
-                if isinstance(value, dict) or isinstance(value, list):
-                    data[key] = validate_and_normalize(value, reference_year)
-        
-        elif isinstance(data, list):
-            data = [validate_and_normalize(item, reference_year) for item in data]
-        
-        return data
-
-    # Call the validation and normalization function
-    return validate_and_normalize(invoice_data)
-
+    # Apply the normalizations and validations of the compiled plan in one pass
+    return get_normalization_plan("invoice 1").apply(invoice_data, config)
+
+
+def normalize_title(title: str) -> str:
+    title_lower = title.lower()
+    if 'hotel' in title_lower:
+        return "Hotel"
+    elif 'fuel' in title_lower or 'tank' in title_lower:
+        return "Fuel"
+    elif 'car' in title_lower or 'mietwagen' in title_lower:
+        return "Rental car"
+    elif 'toll' in title_lower or 'maut' in title_lower:
+        return "Toll"
+    elif 'park' in title_lower:
+        return "Parking fees"
+    return title
+
+def normalize_payment_method(payment_method: str) -> str:
+    payment_method_lower = payment_method.lower()
+    if 'visa' in payment_method_lower or 'credit' in payment_method_lower:
+        return "visa"
+    elif 'invoice' in payment_method_lower:
+        return "invoice"
+    elif 'self' in payment_method_lower:
+        return "self paid"
+    return ""
 
 def validate_invoice_2(invoice_data: dict, config: dict) -> dict:
     fixed_line_titles = config['fixed_line_titles']
@@ -278,28 +219,6 @@ def validate_invoice_2(invoice_data: dict, config: dict) -> dict:
     if "file_name" in invoice_data['invoice_info']:
         invoice_data = check_file_name(invoice_data['invoice_info']["file_name"], invoice_data)
 
-    def normalize_title(title: str) -> str:
-        title_lower = title.lower()
-        if 'hotel' in title_lower:
-            return "Hotel"
-        elif 'fuel' in title_lower or 'tank' in title_lower:
-            return "Fuel"
-        elif 'car' in title_lower or 'mietwagen' in title_lower:
-            return "Rental car"
-        elif 'toll' in title_lower or 'maut' in title_lower:
-            return "Toll"
-        elif 'park' in title_lower:
-            return "Parking fees"
-        return title
-    def normalize_payment_method(payment_method: str) -> str:
-        payment_method_lower = payment_method.lower()
-        if 'visa' in payment_method_lower or 'credit' in payment_method_lower:
-            return "visa"
-        elif 'invoice' in payment_method_lower:
-            return "invoice"
-        elif 'self' in payment_method_lower:
-            return "self paid"
-        return ""
     def validate_and_normalize(data: Any, reference_year=None):
         if isinstance(data, dict):
             for key, value in data.items():
@@ -333,7 +252,7 @@ def validate_invoice_2(invoice_data: dict, config: dict) -> dict:
                             if 'lines' in data:
                                 data['lines'].append(line)
                     data[key] = fixed_lines
-                
+            
                 elif key in ['lines', 'fixed_lines']:
                     for line in value:
                         if 'payment_method' in line:
@@ -534,9 +453,167 @@ class InvoiceInfo3(BaseModel):
 class Invoice3(BaseModel):
     invoice_info: InvoiceInfo3
 
+#######################################################################
+# Normalization plans: the key rules of each invoice type compiled once per field
+
+class Step:
+    """One normalizer of a field, applied to the current value or to the value as extracted."""
+    __slots__ = ("func", "with_config", "from_original")
+
+    def __init__(self, func: Callable, with_config: bool = False, from_original: bool = False):
+        self.func = func
+        self.with_config = with_config
+        self.from_original = from_original
+
+    def __repr__(self):
+        return self.func.__name__
+
+
+class FieldRule:
+    """
+    How the value of one key is normalized. A string is stripped, then the steps run in order.
+    A dict or list value is walked with the rules of its children instead, unless walk is False.
+    The handler, func(data, key, value, config), runs last and may rewrite the dict.
+    """
+    __slots__ = ("steps", "calls", "walk", "handler", "children", "strip_only")
+
+    def __init__(self, steps: List[Step], walk: bool = True, handler: Callable = None):
+        self.steps = tuple(steps)
+        # The steps as plain tuples, the plan runs them inline
+        self.calls = tuple((step.func, step.with_config, step.from_original) for step in self.steps)
+        self.walk = walk
+        self.handler = handler
+        self.children = {}
+        # Most keys have nothing to normalize but the stripping
+        self.strip_only = not self.steps and handler is None
+
+
+def compile_rule_1(key: str) -> FieldRule:
+    steps = []
+    if 'date' in key:
+        steps.append(Step(normalize_date))
+    if 'time' in key:
+        steps.append(Step(normalize_time))
+    if 'break_time' in key:
+        steps.append(Step(normalize_float))
+    if key == 'name':
+        steps.append(Step(map_name, with_config=True, from_original=True))
+    if key == 'land':
+        steps.append(Step(validate_land, with_config=True, from_original=True))
+    if key == 'city':
+        steps.append(Step(validate_city, with_config=True, from_original=True))
+    if key == 'project_number':
+        steps.append(Step(validate_project_number, from_original=True))
+    if key == 'kw':
+        steps.append(Step(validate_kw, from_original=True))
+    return FieldRule(steps)
+
+
+def compile_rule_3(key: str) -> FieldRule:
+    steps = []
+    if 'payment_card_number' in key:
+        steps.append(Step(normalize_payment_card_number))
+    if 'date' in key:
+        steps.append(Step(normalize_date))
+    if 'time' in key:
+        steps.append(Step(normalize_time))
+    if 'percentage' in key:
+        steps.append(Step(normalize_percentage))
+    if 'phone' in key:
+        steps.append(Step(normalize_phone_number))
+    if 'currency' in key:
+        steps.append(Step(validate_currency, with_config=True))
+    return FieldRule(steps)
+
+
+def _nested_models(annotation) -> List[type]:
+    """The models in a field annotation such as List[Union[FixedLine2, HotelLine2]]."""
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return [annotation]
+    return [model for arg in get_args(annotation) for model in _nested_models(arg)]
+
+
+class NormalizationPlan:
+    """
+    The key rules of an invoice type compiled into one FieldRule per field of its schema,
+    the rules of keys the schema doesn't have are kept in a bounded cache. Applying the plan
+    is a single walk over the invoice that normalizes every value once, in the key order of
+    the invoice, dict and list values are not stripped as a copy before they are walked.
+    """
+    def __init__(self, compile_rule: Callable[[str], FieldRule], model: type, max_unknown_keys: int = 512):
+        self.compile_rule = compile_rule
+        self.rules = self._compile_model(model)
+        # The LLM may invent any key, the schema rules stay as compiled
+        self.compile_unknown = lru_cache(maxsize=max_unknown_keys)(compile_rule)
+
+    def _compile_model(self, model: type) -> Dict[str, FieldRule]:
+        rules = {}
+        for key, field in model.model_fields.items():
+            rule = self.compile_rule(key)
+            for nested_model in _nested_models(field.annotation):
+                rule.children.update(self._compile_model(nested_model))
+            rules[key] = rule
+        return rules
+
+    def paths(self, rules: Dict[str, FieldRule] = None, prefix: str = "") -> Dict[str, list]:
+        """Flat view of the plan: field path -> steps, for the fields of the schema."""
+        flat = {}
+        for key, rule in (self.rules if rules is None else rules).items():
+            flat[prefix + key] = list(rule.steps) + ([rule.handler.__name__] if rule.handler else [])
+            flat.update(self.paths(rule.children, prefix=f"{prefix}{key}."))
+        return flat
+
+    def apply(self, data: Any, config: dict) -> Any:
+        return self._normalize(data, self.rules, config)
+
+    def _normalize(self, data: Any, rules: Dict[str, FieldRule], config: dict) -> Any:
+        if isinstance(data, dict):
+            for key, value in data.items():
+                rule = rules.get(key) or self.compile_unknown(key)
+
+                if isinstance(value, str):
+                    current = value.strip()
+                elif rule.walk and isinstance(value, (dict, list)):
+                    data[key] = self._normalize(value, rule.children, config)
+                    continue
+                else:
+                    current = value
+                if rule.strip_only:
+                    data[key] = current
+                    continue
+
+                for func, with_config, from_original in rule.calls:
+                    argument = value if from_original else current
+                    current = func(argument, config) if with_config else func(argument)
+                data[key] = current
+                if rule.handler is not None:
+                    rule.handler(data, key, value, config)
+        elif isinstance(data, list):
+            data = [self._normalize(item, rules, config) for item in data]
+        return data
+
+
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+def get_normalization_plan(invoice_type: str) -> NormalizationPlan:
+    """The NormalizationPlan of an invoice type, compiled on first use."""
+    with _plans_lock:
+        if invoice_type not in _plans:
+            compile_rules = {"invoice 1": (compile_rule_1, Invoice1),
+                             "invoice 3": (compile_rule_3, Invoice3)}
+            if invoice_type not in compile_rules:
+                raise ValueError(f"Invalid invoice type: {invoice_type}")
+            _plans[invoice_type] = NormalizationPlan(*compile_rules[invoice_type])
+        return _plans[invoice_type]
+
+
 #######################################################################
 
 if __name__ == "__main__":
+    from src.Utils.utils import find_best_match_fuzzy
+
     config_path = "config/config.yaml"
     config = read_config(config_path)
     # Example usage
@@ -730,3 +807,200 @@ if __name__ == "__main__":
 
     data = validate_invoice_3(data3, config=config)
     print("\ndata3", data)
+
+    # Text that matches no reference value at all, the matchers return (None, None, 0)
+    assert find_best_match_fuzzy(["EUR", "USD"], "1234") == (None, None, 0)
+    assert validate_currency("1234", config=config) == ""
+    assert validate_land("#1234", config=config) == config["country_and_city"]["land_text_default"]
+    assert validate_city("#1234", config=config) == config["country_and_city"]["city_text_default"]
+    assert map_name("1234", config=config) == ""
+
+    # Differential test: the compiled plans against the recursive functions they replace
+    import copy
+    import random
+    import time
+    from functools import partial
+
+    # walk_containers: what the plan does with a dict or list under a key that has normalizers,
+    # it is walked with the child rules instead of going to the normalizers, which raised here
+    def legacy_validate_invoice_3(invoice_data: dict, config:dict, walk_containers: bool = False) -> dict:
+
+        # Recursive function to apply normalizations and validations to the data
+        def validate_and_normalize(data):
+            if isinstance(data, dict):
+                for key, value in data.items():
+                    if walk_containers and isinstance(value, (dict, list)):
+                        data[key] = validate_and_normalize(value)
+                        continue
+
+                    # Strip all string values
+                    data[key] = strip_strings(value)
+                
+                    # Normalize specific fields
+                    if 'payment_card_number' in key:
+                        data[key] = normalize_payment_card_number(data[key])
+                
+                    if 'date' in key:
+                        data[key] = normalize_date(data[key])
+
+                    if 'time' in key:
+                        data[key] = normalize_time(data[key])
+                
+                    if 'percentage' in key:
+                        data[key] = normalize_percentage(data[key])
+                
+                    if 'phone' in key:
+                        data[key] = normalize_phone_number(data[key])
+                
+                    if 'currency' in key:
+                        data[key] = validate_currency(data[key], config=config)
+                
+                    # Recursively normalize nested dictionaries or lists
+                    if isinstance(value, dict) or isinstance(value, list):
+                        data[key] = validate_and_normalize(value)
+        
+            elif isinstance(data, list):
+                data = [validate_and_normalize(item) for item in data]
+        
+            return data
+
+        # Call the validation and normalization function
+        return validate_and_normalize(invoice_data)
+
+    def legacy_validate_invoice_1(invoice_data: dict, config:dict, walk_containers: bool = False) -> dict:
+        if "file_name" in invoice_data['invoice_info']:
+            invoice_data = check_file_name(invoice_data['invoice_info']["file_name"], invoice_data)
+
+        # Recursive function to apply normalizations and validations to the data
+        def validate_and_normalize(data: Any, reference_year=None):
+            if isinstance(data, dict):
+                for key, value in data.items():
+                    if walk_containers and isinstance(value, (dict, list)):
+                        data[key] = validate_and_normalize(value)
+                        continue
+
+                    # Strip all string values
+                    data[key] = strip_strings(value)
+                
+                    if 'date' in key:
+                        data[key] = normalize_date(data[key])
+
+                    if 'time' in key:
+                        data[key] = normalize_time(data[key])
+
+                    if 'break_time' in key:
+                        data[key] = normalize_float(data[key])
+
+                    if key == 'name':
+                        data[key] = map_name(value, config)
+                
+                    if key == 'land':
+                        data[key] = validate_land(value, config)
+                
+                    if key == 'city':
+                        data[key] = validate_city(value, config)
+
+                    if key == 'project_number':
+                        data[key]=validate_project_number(value=value)
+
+                    if key == "kw":
+                        data[key]=validate_kw(value=value)
+                
+                    # Recursively normalize nested dictionaries or lists
+                    if isinstance(value, dict) or isinstance(value, list):
+                        data[key] = validate_and_normalize(value, reference_year)
+        
+            elif isinstance(data, list):
+                data = [validate_and_normalize(item, reference_year) for item in data]
+        
+            return data
+
+        # Call the validation and normalization function
+        return validate_and_normalize(invoice_data)
+
+    # Invoice 2 keeps its recursive function, a plan measured no faster for it
+    legacy_functions = {"invoice 1": legacy_validate_invoice_1, "invoice 3": legacy_validate_invoice_3}
+    functions = {"invoice 1": validate_invoice_1, "invoice 3": validate_invoice_3}
+    print("\ninvoice 3 plan", {path: steps for path, steps in get_normalization_plan("invoice 3").paths().items() if steps})
+
+    rng = random.Random(0)
+
+    def model_keys(model):
+        return {key for key in model.model_fields} | {key for field in model.model_fields.values()
+                                                       for nested in _nested_models(field.annotation)
+                                                       for key in model_keys(nested)}
+
+    schema_keys = sorted(model_keys(Invoice1) | model_keys(Invoice2) | model_keys(Invoice3) - {"file_name"})
+    extra_keys = ["notes", "meal_date", "total_amount", "currency_code", "time_zone", "phone_list", "stamp"]
+    strings = ["", "  17:46 ", "07:30", "07/08/2024 ", "13/8/24", " EURk", "usd", "Tümmler, Dirk", "Schmidt Timo ",
+               "V1 230 23", " 0,5 ", "12.5", "visa pay", "invoice to self pay", "Hotelahha", "Tankstelle", "Maut",
+               "+49 (0)123-45", "4111 1111 1111 1111", "19%", "VietNa", "Othe", "Berlin ", " KW 12"]
+
+    def random_value(key, depth):
+        if key in ("fixed_lines", "lines", "lineitems", "vatitems") and depth < 3:
+            return [random_line(depth + 1) for _ in range(rng.randint(0, 4))]
+        kind = rng.random()
+        if depth < 3 and kind < 0.1:
+            return {k: random_value(k, depth + 1) for k in rng.sample(schema_keys + extra_keys, rng.randint(0, 4))}
+        if depth < 3 and kind < 0.15:
+            return [rng.choice(strings + [1, None]) for _ in range(rng.randint(0, 3))]
+        return rng.choice(strings + [None, 0, 1, 2.5, 240045, True, date(2008, 6, 28)])
+
+    def random_line(depth):
+        line = {k: random_value(k, depth) for k in rng.sample(schema_keys + extra_keys, rng.randint(0, 5))}
+        line['title'] = rng.choice(strings)
+        if rng.random() < 0.7:
+            line['payment_method'] = rng.choice(strings)
+        return line
+
+    def run(function, invoice_data):
+        try:
+            return function(invoice_data, config=config)
+        except Exception as e:
+            return type(e)
+
+    cases, raised = 0, 0
+    for invoice_type, function in functions.items():
+        invoices = []
+        for _ in range(1000):
+            keys = rng.sample(schema_keys + extra_keys, rng.randint(1, 12))
+            invoices.append({'invoice_info': {key: random_value(key, 1) for key in keys}})
+
+        for invoice_data in invoices:
+            expected = run(legacy_functions[invoice_type], copy.deepcopy(invoice_data))
+            result = run(function, copy.deepcopy(invoice_data))
+            cases += 1
+            if isinstance(expected, type):
+                # A container under a key with normalizers, the plan walks it and normalizes the other fields
+                raised += 1
+                expected = run(partial(legacy_functions[invoice_type], walk_containers=True), copy.deepcopy(invoice_data))
+            assert result == expected, (invoice_type, invoice_data, result, expected)
+
+        # Rounds of both functions interleaved, the median is steadier than a single run
+        times = {"legacy": [], "plan": []}
+        for _ in range(7):
+            for name, timed_function in [("legacy", legacy_functions[invoice_type]), ("plan", function)]:
+                batch = copy.deepcopy(invoices)
+                start_time = time.perf_counter()
+                for invoice_data in batch:
+                    run(timed_function, invoice_data)
+                times[name].append(time.perf_counter() - start_time)
+        legacy_time, plan_time = sorted(times["legacy"])[3], sorted(times["plan"])[3]
+        print(f"{invoice_type}: legacy {legacy_time:.3f}s, plan {plan_time:.3f}s for 1000 invoices "
+              f"(median of 7, {legacy_time / plan_time:.2f}x)")
+
+    for invoice_type, data in [("invoice 1", data1), ("invoice 3", data3)]:
+        assert run(functions[invoice_type], copy.deepcopy(data)) == run(legacy_functions[invoice_type], copy.deepcopy(data))
+    # The recursive function raises on a dict under the currency, the plan walks it and normalizes the other fields
+    invoice_data = {'invoice_info': {'currency': {'note': ' usd '}, 'merchant_name': ' shop ', 'purchasedate': '07/08/2024'}}
+    assert run(legacy_validate_invoice_3, copy.deepcopy(invoice_data)) is AttributeError
+    assert validate_invoice_3(invoice_data, config=config) == \
+        {'invoice_info': {'currency': {'note': 'usd'}, 'merchant_name': 'shop', 'purchasedate': date(2024, 8, 7)}}
+    # Unknown keys don't grow the plans
+    for invoice_type, model in [("invoice 1", Invoice1), ("invoice 3", Invoice3)]:
+        plan = get_normalization_plan(invoice_type)
+        assert set(plan.rules) == set(model.model_fields) and set(plan.rules['invoice_info'].children) == \
+            set(model.model_fields['invoice_info'].annotation.model_fields)
+        assert plan.compile_unknown.cache_info().currsize <= plan.compile_unknown.cache_info().maxsize
+    print(f"Normalization plans identical to the recursive functions on {cases - raised} invoices, "
+          f"and to them walking the containers on the {raised} invoices they raised on")